@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Load the BDII client path of gridutils with concurrent queries.
+
+--concurrency threads run --queries gridutils.query_bdii() calls in total,
+each one going through get_working_ldap(), the search and the parsing of the
+answer, against a local fake BDII (or --ldap-url). The throughput and the
+latency percentiles are reported. The fake BDII can delay its answers and
+drop connections, and --dead unreachable BDIIs can be listed before it to
+exercise the failover:
+
+    ./benchmarks/bench_bdii_load.py --concurrency 32 --queries 2000
+    ./benchmarks/bench_bdii_load.py --query vo --sites 500 --glue 2
+    ./benchmarks/bench_bdii_load.py --delay 0.05 --drop 0.05 --dead 2
+    ./benchmarks/bench_bdii_load.py --query vo --sites 500 --page-size 100
+"""
+
+import argparse
+import concurrent.futures
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import gridutils  # noqa: E402
+from fakebdii import FakeBDII, glue13_fixture, glue2_fixture  # noqa: E402
+
+# GetSURLs queries of the probe, for one storage element or the whole VO
+GLUE13_FILTER = (
+    "(|(&(GlueChunkKey=GlueSEUniqueID=%(host)s)(|(GlueSAAccessControlBaseRule=%(vo)s)"
+    "(GlueSAAccessControlBaseRule=VO:%(vo)s)))"
+    "(&(GlueChunkKey=GlueSEUniqueID=%(host)s)(|(GlueVOInfoAccessControlBaseRule=%(vo)s)"
+    "(GlueVOInfoAccessControlBaseRule=VO:%(vo)s)))"
+    "(&(GlueServiceUniqueID=*://%(host)s*)(GlueServiceVersion=2.*)"
+    "(GlueServiceType=srm*)))"
+)
+GLUE13_ATTRS = ["GlueServiceEndpoint", "GlueSAPath", "GlueVOInfoPath", "GlueChunkKey"]
+GLUE2_FILTER = (
+    "(|(&(objectClass=GLUE2Endpoint)(GLUE2EndpointInterfaceName=SRM)"
+    "(GLUE2EndpointURL=*://%(host)s*))"
+    "(&(objectClass=GLUE2MappingPolicy)(GLUE2PolicyRule=VO:%(vo)s)"
+    "(GLUE2MappingPolicyShareForeignKey=%(share)s))"
+    "(&(objectClass=GLUE2StorageShare)(GLUE2ShareID=%(share)s)))"
+)
+GLUE2_ATTRS = [
+    "GLUE2EndpointURL",
+    "GLUE2MappingPolicyShareForeignKey",
+    "GLUE2ShareID",
+    "GLUE2StorageSharePath",
+]
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def closed_port_url():
+    "URL of a local port nothing listens on"
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "ldap://127.0.0.1:%d" % port
+
+
+def make_query(args):
+    """Function running one query, returning C{(rc, entries)}, see
+    gridutils.query_bdii()."""
+    glue2 = args.glue == 2
+    base = glue2 and "o=glue" or "o=grid"
+    template = glue2 and GLUE2_FILTER or GLUE13_FILTER
+    attrs = glue2 and GLUE2_ATTRS or GLUE13_ATTRS
+    rnd = random.Random(0)
+
+    def query():
+        if args.query == "vo":
+            host, share = "*", "*"
+        else:
+            host = "se%03d.example.org" % rnd.randrange(args.sites)
+            share = "%s/%s/*" % (host, args.vo)
+        rc, qres = gridutils.query_bdii(
+            template % {"host": host, "vo": args.vo, "share": share},
+            attrs,
+            args.urls,
+            ldap_base=base,
+            net_timeout=args.timeout,
+            ldap_client=args.client,
+            sizelimit=args.sizelimit,
+            page_size=args.page_size,
+        )
+        return rc, rc and len(qres) or 0
+
+    return query
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument(
+        "--query",
+        choices=("host", "vo"),
+        default="host",
+        help="query one random storage element or all of the VO",
+    )
+    parser.add_argument("--glue", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--sites", type=int, default=100, help="fake BDII size")
+    parser.add_argument("--paths-per-vo", type=int, default=1)
+    parser.add_argument("--delay", type=float, default=0, help="seconds per search")
+    parser.add_argument(
+        "--drop", type=float, default=0, help="probability to drop a connection"
+    )
+    parser.add_argument(
+        "--dead", type=int, default=0, help="unreachable BDIIs listed first"
+    )
+    parser.add_argument("--client", choices=gridutils.LDAP_CLIENTS, default="api")
+    parser.add_argument("--timeout", type=int, default=5, help="network timeout")
+    parser.add_argument("--sizelimit", type=int, default=0, help="entries per query")
+    parser.add_argument(
+        "--page-size", type=int, default=0, help="entries per page (paged results)"
+    )
+    parser.add_argument("--ldap-url", help="use this BDII instead of a fake one")
+    parser.add_argument("--vo", default="dteam")
+    args = parser.parse_args()
+
+    server = None
+    if args.ldap_url:
+        url = args.ldap_url
+    else:
+        fixture = args.glue == 2 and glue2_fixture or glue13_fixture
+        server = FakeBDII(
+            fixture(args.sites, paths_per_vo=args.paths_per_vo),
+            delay=args.delay,
+            drop=args.drop,
+        ).start()
+        url = server.url
+    args.urls = ",".join([closed_port_url() for _ in range(args.dead)] + [url])
+
+    query = make_query(args)
+    timings = []
+    failures = 0
+    truncated = 0
+    entries = 0
+
+    def timed_query():
+        start = time.monotonic()
+        rc, n = query()
+        return rc, n, time.monotonic() - start
+
+    try:
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            futures = [pool.submit(timed_query) for _ in range(args.queries)]
+            for future in concurrent.futures.as_completed(futures):
+                rc, n, elapsed = future.result()
+                timings.append(elapsed)
+                entries = max(entries, n)
+                failures += not rc
+                truncated += rc == 2
+        wall = time.monotonic() - start
+    finally:
+        if server:
+            server.stop()
+
+    timings.sort()
+    print(
+        "%d queries (%s, GLUE %d, up to %d entries), %d concurrent: "
+        "%.1f queries/s, %d failed, %d truncated"
+        % (
+            args.queries,
+            args.query,
+            args.glue,
+            entries,
+            args.concurrency,
+            args.queries / wall,
+            failures,
+            truncated,
+        )
+    )
+    if server:
+        print(
+            "fake BDII: %d searches (pages), %d abandoned"
+            % (server.stats["searches"], server.stats["abandoned"])
+        )
+    print("%10s %10s %10s %10s %10s" % ("mean", "p50", "p95", "p99", "max"))
+    print(
+        "%8.2fms %8.2fms %8.2fms %8.2fms %8.2fms"
+        % (
+            sum(timings) / len(timings) * 1000,
+            percentile(timings, 50) * 1000,
+            percentile(timings, 95) * 1000,
+            percentile(timings, 99) * 1000,
+            timings[-1] * 1000,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Compare the native LDAP client with the ldapsearch CLI in gridutils.
+
+Both clients run the probe's GetSURLs query through gridutils.query_bdii()
+against a local fake BDII (or --ldap-url) and the per-query latency is
+reported. The CLI client is skipped if ldapsearch is not installed.
+
+    ./benchmarks/bench_ldap.py --queries 200 --sites 500
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import gridutils  # noqa: E402
+from fakebdii import FakeBDII, glue13_fixture  # noqa: E402
+
+FILTER = (
+    "(|(&(GlueChunkKey=GlueSEUniqueID=%(host)s)(|(GlueSAAccessControlBaseRule=%(vo)s)"
+    "(GlueSAAccessControlBaseRule=VO:%(vo)s)))"
+    "(&(GlueChunkKey=GlueSEUniqueID=%(host)s)(|(GlueVOInfoAccessControlBaseRule=%(vo)s)"
+    "(GlueVOInfoAccessControlBaseRule=VO:%(vo)s)))"
+    "(&(GlueServiceUniqueID=*://%(host)s*)(GlueServiceVersion=2.*)"
+    "(GlueServiceType=srm*)))"
+)
+ATTRS = ["GlueServiceEndpoint", "GlueSAPath", "GlueVOInfoPath"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run(client, ldap_url, queries, host, vo):
+    timings = []
+    entries = 0
+    for _ in range(queries):
+        start = time.monotonic()
+        rc, qres = gridutils.query_bdii(
+            FILTER % {"host": host, "vo": vo}, ATTRS, ldap_url, ldap_client=client
+        )
+        timings.append(time.monotonic() - start)
+        if not rc:
+            raise SystemExit("%s query failed: %s" % (client, qres[1]))
+        entries = len(qres)
+    return timings, entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--sites", type=int, default=100, help="fake BDII size")
+    parser.add_argument("--ldap-url", help="use this BDII instead of a fake one")
+    parser.add_argument("--host", default="se000.example.org")
+    parser.add_argument("--vo", default="dteam")
+    args = parser.parse_args()
+
+    server = None
+    ldap_url = args.ldap_url
+    if not ldap_url:
+        server = FakeBDII(glue13_fixture(args.sites)).start()
+        ldap_url = server.url
+
+    clients = ["api"]
+    if shutil.which("ldapsearch"):
+        clients.append("cli")
+    else:
+        print("ldapsearch not found, skipping the CLI client")
+
+    print("%-4s %8s %10s %10s %10s %10s" % ("", "entries", "mean", "p50", "p95", "max"))
+    try:
+        for client in clients:
+            timings, entries = run(client, ldap_url, args.queries, args.host, args.vo)
+            print(
+                "%-4s %8d %9.2fms %9.2fms %9.2fms %9.2fms"
+                % (
+                    client,
+                    entries,
+                    1000 * sum(timings) / len(timings),
+                    1000 * percentile(timings, 50),
+                    1000 * percentile(timings, 95),
+                    1000 * max(timings),
+                )
+            )
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark gridutils.parse_ldif() against the previous in-memory parser.
+
+A multi-megabyte ldapsearch-like LDIF fixture (folded lines, base64 values,
+multi-valued attributes) is generated in a temporary file and parsed from
+the file stream, as ldapsearch output is parsed from its pipe. Wall time,
+peak Python memory and the number of entries found are reported.
+
+    ./benchmarks/bench_ldif.py --size-mb 20
+"""
+
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import gridutils  # noqa: E402
+
+
+def fold(line, width=78):
+    """Fold a line the way ldapsearch does."""
+    out = [line[:width]]
+    line = line[width:]
+    while line:
+        out.append(" " + line[: width - 1])
+        line = line[width - 1 :]
+    return "\n".join(out)
+
+
+def write_fixture(fp, size):
+    """Write LDIF entries to C{fp} until C{size} bytes; return entry count."""
+    n = 0
+    written = 0
+    while written < size:
+        host = "se%06d.example.org" % n
+        path = "/pnfs/example.org/data/dteam/dn: %d" % n
+        lines = [
+            "dn: GlueVOInfoLocalID=dteam:%d,GlueSALocalID=dteam,GlueSEUniqueID=%s,"
+            "Mds-Vo-name=SITE,Mds-Vo-name=local,o=grid" % (n, host),
+            "objectClass: GlueSATop",
+            "objectClass: GlueVOInfo",
+            "GlueVOInfoPath:: %s" % base64.b64encode(path.encode()).decode(),
+            "GlueVOInfoAccessControlBaseRule: VO:dteam",
+            "GlueVOInfoName: dteam path for dn: %s" % host,
+            "GlueChunkKey: GlueSALocalID=dteam",
+            "GlueChunkKey: GlueSEUniqueID=%s" % host,
+            "GlueSchemaVersionMajor: 1",
+        ]
+        text = "\n".join(fold(x) for x in lines) + "\n\n"
+        fp.write(text.encode())
+        written += len(text)
+        n += 1
+    return n
+
+
+def legacy_parse(res):
+    """Parser used by __ldap_CLI() before parse_ldif(), for comparison."""
+    res = res.replace("\n ", "").strip()
+    entries = []
+    res = res.split("dn: ")
+    for dn in res:
+        if dn:
+            dl = dn.splitlines()
+            for i, v in enumerate(dl):
+                if not v:
+                    del dl[i]
+            d = {}
+            for x in dl[1:]:
+                t = x.split(":", 1)
+                t[0] = t[0].strip()
+                t[1] = t[1].strip()
+                if t[0] in d:
+                    d[t[0]].append(t[1])
+                else:
+                    d[t[0]] = [t[1]]
+            entries.append((dl[0], d))
+    return entries
+
+
+def measure(name, function):
+    # timed and memory traced in separate runs, tracemalloc slows down parsing
+    start = time.monotonic()
+    entries = function()
+    elapsed = time.monotonic() - start
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-28s %8.2fs %10.1fMiB %10d" % (name, elapsed, peak / 2.0**20, entries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryFile() as fp:
+        n = write_fixture(fp, int(args.size_mb * 2**20))
+        print("%d entries, %.1f MiB of LDIF" % (n, fp.tell() / 2.0**20))
+        print("%-28s %9s %13s %10s" % ("", "time", "peak mem", "entries"))
+
+        def legacy():
+            fp.seek(0)
+            return len(legacy_parse(fp.read().decode("utf-8")))
+
+        def streaming(attrlist=None):
+            fp.seek(0)
+            count = 0
+            for _ in gridutils.parse_ldif(fp, attrlist):
+                count += 1
+            return count
+
+        measure("legacy (read + split)", legacy)
+        measure("parse_ldif", streaming)
+        measure("parse_ldif (1 attribute)", lambda: streaming(["GlueVOInfoPath"]))
+
+
+if __name__ == "__main__":
+    main()
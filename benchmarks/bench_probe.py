@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Measure the probe's own overhead offline, with a fake gfal2 and BDII.
+
+gfal2 is replaced by benchmarks/fakegfal2.py and gridutils.query_bdii() by
+GLUE 1.3 fixture data (see fakebdii.py), both with optional injected
+latencies and errors, so no grid is needed. The probe checks one storage
+element --runs times, then --hosts storage elements in batch mode, and the
+wall time, the time of every metric less the injected latency (with
+--path-workers 1, so that latencies add up) and the memory peak are
+reported. The exit code is 1 if a check isn't OK while no error is injected,
+if VOLsDir didn't call gfal2 on every storage path, or if the median single
+check takes longer than --budget-ms:
+
+    ./benchmarks/bench_probe.py --runs 20 --paths 3 --budget-ms 50
+    ./benchmarks/bench_probe.py --latency filecopy=0.05 --errors stat=0.1
+
+nap must be importable (PYTHONPATH) as for the probe itself.
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import os
+import re
+import resource
+import shlex
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import fakegfal2  # noqa: E402
+import gridutils  # noqa: E402
+from fakebdii import glue13_fixture  # noqa: E402
+
+VO = "dteam"
+
+# gfal2 call VOLsDir makes in every --lsdir-mode
+LSDIR_CALLS = {"listdir": "listdir", "stream": "opendir", "stat": "stat"}
+
+
+def parse_rates(value):
+    "'op=value,...' to {op: float}"
+    rates = {}
+    for item in value.split(","):
+        if item:
+            name, _, rate = item.partition("=")
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def fake_query_bdii(entries, latency):
+    """gridutils.query_bdii() answering from fixture C{entries}, for the
+    storage element in the filter or all of them."""
+    by_host = {}
+    for dn, attrs in entries:
+        host = re.search(r"se\d+\.example\.org", dn).group(0)
+        by_host.setdefault(host, []).append((dn, attrs))
+
+    def query_bdii(ldap_filter, ldap_attrlist, ldap_url="", **kwargs):
+        if latency:
+            time.sleep(latency)
+        host = re.search(r"GlueSEUniqueID=([^)]*)\)", ldap_filter).group(1)
+        found = entries if host == "*" else by_host.get(host.lower(), [])
+        if not found:
+            return 0, (gridutils.LDAP_QE_EMPTYSET, "No entries", "")
+        return 1, [
+            (dn, dict((a, v) for a, v in attrs.items() if a in ldap_attrlist))
+            for dn, attrs in found
+        ]
+
+    return query_bdii
+
+
+class MetricTimer(object):
+    """Wraps the probe metrics to time them, less the latency injected by
+    the fake gfal2, while C{enabled}. Only meaningful for one check at a
+    time."""
+
+    def __init__(self, app):
+        self.enabled = False
+        self.times = {}
+        self.names = []
+        for n, (function, name, passive) in enumerate(app.sequence):
+            self.names.append(name)
+            app.sequence[n] = (self.wrap(function, name), name, passive)
+
+    def wrap(self, function, name):
+        @functools.wraps(function)
+        def timed(args, io):
+            if not self.enabled:
+                return function(args, io)
+            injected = fakegfal2.injected()
+            start = time.perf_counter()
+            try:
+                return function(args, io)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.times.setdefault(name, []).append(
+                    elapsed - (fakegfal2.injected() - injected)
+                )
+
+        return timed
+
+
+def memory_peak(function):
+    "Run C{function}, return its result and its Python memory peak in bytes"
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--paths", type=int, default=1, help="storage paths per SE")
+    parser.add_argument("--hosts", type=int, default=50, help="SEs in batch mode")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=parse_rates, default={}, help="gfal2 op=seconds,..."
+    )
+    parser.add_argument(
+        "--errors", type=parse_rates, default={}, help="gfal2 op=probability,..."
+    )
+    parser.add_argument("--bdii-latency", type=float, default=0)
+    parser.add_argument(
+        "--probe-args", default="", help="more probe options, e.g. '--verify stream'"
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        help="maximum median wall time of one check, less injected latencies",
+    )
+    args = parser.parse_args()
+
+    fakegfal2.install(args.latency, args.errors)
+    entries = glue13_fixture(max(args.hosts, 1), (VO,), args.paths)
+    gridutils.query_bdii = fake_query_bdii(entries, args.bdii_latency)
+    import srm_probe
+
+    timer = MetricTimer(srm_probe.app)
+    workdir = tempfile.mkdtemp()
+    probe_argv = [
+        "--dry-run",
+        "--cache-dir",
+        workdir,
+        "--bdii-cache-ttl",
+        "0",
+        "-VO",
+        VO,
+        "--path-workers",
+        "1",
+    ] + shlex.split(args.probe_args)
+    host = "se000.example.org"
+
+    def check():
+        probe_args = srm_probe.app._parser.parse_args(["-H", host] + probe_argv)
+        return srm_probe.check_storage_element(probe_args, host)
+
+    targets = os.path.join(workdir, "targets")
+    with open(targets, "w") as fp:
+        fp.write("".join("se%03d.example.org\n" % n for n in range(args.hosts)))
+    batch_argv = probe_argv + ["--batch", targets, "--workers", str(args.workers)]
+
+    def batch():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return srm_probe.run_batch(srm_probe.app._parser.parse_args(batch_argv))
+
+    failed = False
+    try:
+        statuses = []
+        walls = []
+        lsdir_mode = srm_probe.app._parser.parse_args(probe_argv).lsdir_mode
+        lsdir_calls = fakegfal2.CALLS.get(LSDIR_CALLS[lsdir_mode], 0)
+        timer.enabled = True
+        for _ in range(args.runs):
+            injected = fakegfal2.injected()
+            start = time.perf_counter()
+            statuses.append(check())
+            walls.append(
+                time.perf_counter() - start - (fakegfal2.injected() - injected)
+            )
+        timer.enabled = False
+        lsdir_calls = fakegfal2.CALLS.get(LSDIR_CALLS[lsdir_mode], 0) - lsdir_calls
+        _, check_peak = memory_peak(check)
+
+        start = time.perf_counter()
+        batch()
+        batch_wall = time.perf_counter() - start
+        _, batch_peak = memory_peak(batch)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("%-24s %10s %10s %10s" % ("", "median", "p95", "max"))
+    for name in timer.names:
+        times = sorted(timer.times.get(name, [0]))
+        print(
+            "%-24s %8.2fms %8.2fms %8.2fms"
+            % (
+                name,
+                statistics.median(times) * 1000,
+                times[int(0.95 * (len(times) - 1))] * 1000,
+                times[-1] * 1000,
+            )
+        )
+    walls.sort()
+    median = statistics.median(walls) * 1000
+    print(
+        "%-24s %8.2fms %8.2fms %8.2fms"
+        % (
+            "single check",
+            median,
+            walls[int(0.95 * (len(walls) - 1))] * 1000,
+            walls[-1] * 1000,
+        )
+    )
+    print(
+        "%-24s %8.2fms (%d SEs, %d workers, %.1f checks/s)"
+        % (
+            "batch",
+            batch_wall * 1000,
+            args.hosts,
+            args.workers,
+            args.hosts / batch_wall,
+        )
+    )
+    print(
+        "memory peak: %.1f KiB single check, %.1f KiB batch, max RSS %.1f MiB"
+        % (
+            check_peak / 1024.0,
+            batch_peak / 1024.0,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        )
+    )
+
+    not_ok = len([st for st in statuses if st != srm_probe.nap.OK])
+    if not_ok:
+        print("%d of %d checks not OK" % (not_ok, len(statuses)))
+        if not args.errors:
+            failed = True
+    # every check must really reach the storage in VOLsDir
+    if lsdir_calls < args.runs * args.paths:
+        print(
+            "VOLsDir made %d gfal2 %s() calls in %d checks of %d paths"
+            % (lsdir_calls, LSDIR_CALLS[lsdir_mode], args.runs, args.paths)
+        )
+        failed = True
+    if args.budget_ms is not None and median > args.budget_ms:
+        print("median single check over budget (%.0fms)" % args.budget_ms)
+        failed = True
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Measure the probe start-up cost and check it against a budget.
+
+'import srm_probe' is timed with 'python -X importtime', and the probe is run
+with --help, --version and an invalid argument, each in fresh interpreters;
+the median of the runs is reported. The modules the probe imports only when
+it checks a storage element (gfal2 above all) must not be loaded by these
+runs. The exit code is 1 if one of them is, or if the import takes longer
+than --budget-ms, so the script can be used as a regression test:
+
+    ./benchmarks/bench_startup.py --runs 20 --budget-ms 150
+
+gfal2 and nap must be importable (PYTHONPATH) as for the probe itself.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PLUGINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+PROBE = os.path.join(PLUGINS, "srm_probe.py")
+
+# imported on use only, see the top of srm_probe.py
+LAZY_MODULES = (
+    "gfal2",
+    "datetime",
+    "filecmp",
+    "tempfile",
+    "hashlib",
+    "concurrent.futures",
+)
+
+# runs the probe in-process, then lists the lazy modules it loaded
+LOADED = """
+import sys
+sys.argv[1:] = %r
+try:
+    exec(compile(open(%r).read(), "srm_probe.py", "exec"), {"__name__": "__main__"})
+except SystemExit:
+    pass
+print("loaded: " + " ".join(m for m in %r if m in sys.modules))
+"""
+
+
+def python(*argv):
+    return subprocess.run(
+        (sys.executable,) + argv,
+        cwd=PLUGINS,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+def import_time(runs):
+    """Median cumulative 'import srm_probe' time in ms."""
+    times = []
+    for _ in range(runs):
+        proc = python("-X", "importtime", "-c", "import srm_probe")
+        for line in proc.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "srm_probe":
+                times.append(int(fields[1]) / 1000.0)
+        if proc.returncode:
+            sys.exit("import srm_probe failed:\n" + proc.stderr)
+    return statistics.median(times)
+
+
+def run_time(runs, argv):
+    """Median wall time in ms of the probe run with C{argv}."""
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        python(PROBE, *argv)
+        times.append((time.monotonic() - start) * 1000)
+    return statistics.median(times)
+
+
+def loaded_modules(argv):
+    """Lazy modules loaded once the probe ran with C{argv}."""
+    proc = python("-c", LOADED % (list(argv), PROBE, LAZY_MODULES))
+    return proc.stdout.splitlines()[-1].split()[1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=150,
+        help="maximum median time to import srm_probe",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    elapsed = import_time(args.runs)
+    print(
+        "%-24s %8.1fms (budget %.0fms)" % ("import srm_probe", elapsed, args.budget_ms)
+    )
+    if elapsed > args.budget_ms:
+        failed = True
+
+    for argv in (["--help"], ["--version"], ["--srmv"]):
+        loaded = loaded_modules(argv)
+        print(
+            "%-24s %8.1fms %s"
+            % (
+                "srm_probe.py " + " ".join(argv),
+                run_time(args.runs, argv),
+                loaded and "loaded: " + " ".join(loaded) or "",
+            )
+        )
+        if loaded:
+            failed = True
+
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == "__main__":
+    main()
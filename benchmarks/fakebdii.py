@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Fake BDII: a small in-process LDAPv3 server serving GLUE fixture entries.
+
+It understands anonymous bind, search (with filter evaluation, size limit
+and RFC 2696 paged results), abandon and unbind, which is all the probe
+needs. GLUE 1.3 entries are served
+under o=grid and GLUE 2 ones under o=glue; searches can be delayed and
+connections dropped at random to see how clients cope. Run it standalone to
+point a probe or ldapsearch at it:
+
+    ./benchmarks/fakebdii.py --port 2170 --sites 50 --glue 1,2 --delay 0.2
+"""
+
+import argparse
+import os
+import random
+import re
+import select
+import time
+import socket
+import socketserver
+import sys
+import threading
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import ldapclient as lc  # noqa: E402
+
+
+def glue13_fixture(sites=10, vos=("ops", "dteam"), paths_per_vo=1):
+    """GLUE 1.3 entries for C{sites} storage elements se<N>.example.org."""
+    entries = []
+    for n in range(sites):
+        host = "se%03d.example.org" % n
+        site = "Mds-Vo-name=SITE%03d,Mds-Vo-name=local,o=grid" % n
+        entries.append(
+            (
+                "GlueServiceUniqueID=httpg://%s:8446/srm/managerv2,%s" % (host, site),
+                {
+                    "objectClass": ["GlueTop", "GlueService"],
+                    "GlueServiceUniqueID": ["httpg://%s:8446/srm/managerv2" % host],
+                    "GlueServiceType": ["srm"],
+                    "GlueServiceVersion": ["2.2.0"],
+                    "GlueServiceEndpoint": ["httpg://%s:8446/srm/managerv2" % host],
+                },
+            )
+        )
+        for vo in vos:
+            entries.append(
+                (
+                    "GlueSALocalID=%s,GlueSEUniqueID=%s,%s" % (vo, host, site),
+                    {
+                        "objectClass": ["GlueSATop", "GlueSA"],
+                        "GlueSALocalID": [vo],
+                        "GlueSAPath": ["/dpm/example.org/home/%s" % vo],
+                        "GlueSAAccessControlBaseRule": ["VO:%s" % vo],
+                        "GlueChunkKey": ["GlueSEUniqueID=%s" % host],
+                    },
+                )
+            )
+            for p in range(paths_per_vo):
+                entries.append(
+                    (
+                        "GlueVOInfoLocalID=%s:%d,GlueSALocalID=%s,GlueSEUniqueID=%s,%s"
+                        % (vo, p, vo, host, site),
+                        {
+                            "objectClass": ["GlueSATop", "GlueVOInfo"],
+                            "GlueVOInfoLocalID": ["%s:%d" % (vo, p)],
+                            "GlueVOInfoPath": ["/dpm/example.org/home/%s/%d" % (vo, p)],
+                            "GlueVOInfoAccessControlBaseRule": ["VO:%s" % vo],
+                            "GlueChunkKey": [
+                                "GlueSALocalID=%s" % vo,
+                                "GlueSEUniqueID=%s" % host,
+                            ],
+                        },
+                    )
+                )
+    return entries
+
+
+def glue2_fixture(sites=10, vos=("ops", "dteam"), paths_per_vo=1):
+    """GLUE 2 entries for C{sites} storage elements se<N>.example.org: an SRM
+    endpoint, and a share with its VO mapping policy per storage path."""
+    entries = []
+    for n in range(sites):
+        host = "se%03d.example.org" % n
+        service_id = "urn:ogf:StorageService:%s" % host
+        service = "GLUE2ServiceID=%s,GLUE2GroupID=resource,o=glue" % service_id
+        entries.append(
+            (
+                service,
+                {
+                    "objectClass": ["GLUE2Service", "GLUE2StorageService"],
+                    "GLUE2ServiceID": [service_id],
+                    "GLUE2ServiceType": ["srm"],
+                    "GLUE2ServiceAdminDomainForeignKey": ["SITE%03d" % n],
+                },
+            )
+        )
+        entries.append(
+            (
+                "GLUE2EndpointID=%s/srm/2.2.0,%s" % (host, service),
+                {
+                    "objectClass": ["GLUE2Endpoint"],
+                    "GLUE2EndpointID": ["%s/srm/2.2.0" % host],
+                    "GLUE2EndpointURL": ["httpg://%s:8446/srm/managerv2" % host],
+                    "GLUE2EndpointInterfaceName": ["SRM"],
+                    "GLUE2EndpointInterfaceVersion": ["2.2.0"],
+                    "GLUE2EndpointServiceForeignKey": [service_id],
+                },
+            )
+        )
+        for vo in vos:
+            for p in range(paths_per_vo):
+                share_id = "%s/%s/%d" % (host, vo, p)
+                share = "GLUE2ShareID=%s,%s" % (share_id, service)
+                entries.append(
+                    (
+                        share,
+                        {
+                            "objectClass": ["GLUE2Share", "GLUE2StorageShare"],
+                            "GLUE2ShareID": [share_id],
+                            "GLUE2StorageSharePath": [
+                                "/dpm/example.org/home/%s/%d" % (vo, p)
+                            ],
+                            "GLUE2ShareServiceForeignKey": [service_id],
+                        },
+                    )
+                )
+                entries.append(
+                    (
+                        "GLUE2PolicyID=%s/policy,%s" % (share_id, share),
+                        {
+                            "objectClass": ["GLUE2Policy", "GLUE2MappingPolicy"],
+                            "GLUE2PolicyID": ["%s/policy" % share_id],
+                            "GLUE2PolicyRule": ["VO:%s" % vo],
+                            "GLUE2PolicyUserDomainForeignKey": [vo],
+                            "GLUE2MappingPolicyShareForeignKey": [share_id],
+                        },
+                    )
+                )
+    return entries
+
+
+# ########################################################################### #
+# Filter evaluation
+
+
+def _values(entry, attr):
+    for name, values in entry.items():
+        if name.lower() == attr:
+            return [v.lower() for v in values]
+    return []
+
+
+def compile_filter(tag, content):
+    """Turn BER encoded filter into a predicate on entries (case-insensitive)."""
+    if tag in (lc.FILTER_AND, lc.FILTER_OR):
+        preds = [compile_filter(t, c) for t, c in lc.ber_decode_all(content)]
+        if tag == lc.FILTER_AND:
+            return lambda entry: all(p(entry) for p in preds)
+        return lambda entry: any(p(entry) for p in preds)
+    if tag == lc.FILTER_NOT:
+        t, c, _ = lc.ber_decode(content)
+        pred = compile_filter(t, c)
+        return lambda entry: not pred(entry)
+    if tag == lc.FILTER_PRESENT:
+        attr = content.decode("utf-8").lower()
+        return lambda entry: bool(_values(entry, attr))
+    items = lc.ber_decode_all(content)
+    attr = items[0][1].decode("utf-8").lower()
+    if tag == lc.FILTER_SUBSTRINGS:
+        initial, final, middle = "", "", []
+        for t, c in lc.ber_decode_all(items[1][1]):
+            part = c.decode("utf-8").lower()
+            if t == lc.SUBSTRING_INITIAL:
+                initial = part
+            elif t == lc.SUBSTRING_ANY:
+                middle.append(part)
+            else:
+                final = part
+        tokens = [initial] + middle + [final]
+        rx = re.compile("^%s$" % ".*".join(re.escape(t) for t in tokens), re.S)
+        return lambda entry: any(rx.match(v) for v in _values(entry, attr))
+    assertion = items[1][1].decode("utf-8").lower()
+    if tag in (lc.FILTER_EQUALITY, lc.FILTER_APPROX):
+        return lambda entry: assertion in _values(entry, attr)
+    if tag == lc.FILTER_GREATER_OR_EQUAL:
+        return lambda entry: any(v >= assertion for v in _values(entry, attr))
+    if tag == lc.FILTER_LESS_OR_EQUAL:
+        return lambda entry: any(v <= assertion for v in _values(entry, attr))
+    return lambda entry: False
+
+
+def encode_entry(dn, entry, attrs):
+    """Encode SearchResultEntry keeping only C{attrs} (all if empty)."""
+    wanted = set(a.lower() for a in attrs)
+    attributes = []
+    for name, values in entry.items():
+        if wanted and name.lower() not in wanted:
+            continue
+        attributes.append(
+            lc.ber_sequence(
+                [
+                    lc.ber_string(name),
+                    lc.ber_sequence([lc.ber_string(v) for v in values], lc.TAG_SET),
+                ]
+            )
+        )
+    return lc.ber_sequence(
+        [lc.ber_string(dn), lc.ber_sequence(attributes)], lc.OP_SEARCH_RESULT_ENTRY
+    )
+
+
+def ldap_result(op, code=lc.RESULT_SUCCESS, message=""):
+    return lc.ber_sequence(
+        [lc.ber_enumerated(code), lc.ber_string(""), lc.ber_string(message)], op
+    )
+
+
+# ########################################################################### #
+# Server
+
+
+def _paged_results(controls):
+    "C{(size, cookie)} of the paged results control in C{controls}, or None"
+    for _, control in lc.ber_decode_all(controls):
+        items = lc.ber_decode_all(control)
+        if items and items[0][1].decode("utf-8") == lc.CONTROL_PAGED_RESULTS:
+            _, value, _ = lc.ber_decode(items[-1][1])
+            size, cookie = lc.ber_decode_all(value)
+            return lc.ber_to_int(size[1]), cookie[1]
+    return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def _send(self, msgid, op, controls=None):
+        items = [lc.ber_integer(msgid), op]
+        if controls:
+            items.append(lc.ber_sequence(controls, lc.TAG_CONTROLS))
+        self.request.sendall(lc.ber_sequence(items))
+
+    def _receive(self, block=True):
+        """Next request C{(msgid, tag, op, controls)}, None if C{block} is
+        False and none is waiting.
+
+        @raises EOFError: the connection was closed.
+        """
+        while True:
+            length = lc.ber_message_length(self.buf)
+            if length is not None and len(self.buf) >= length:
+                break
+            if not block and not select.select([self.request], [], [], 0)[0]:
+                return None
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                raise EOFError()
+            if not chunk:
+                raise EOFError()
+            self.buf.extend(chunk)
+        message = bytes(self.buf[:length])
+        del self.buf[:length]
+        _, content, _ = lc.ber_decode(message)
+        items = lc.ber_decode_all(content)
+        controls = len(items) > 2 and items[2][1] or b""
+        return lc.ber_to_int(items[0][1]), items[1][0], items[1][1], controls
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = bytearray()
+        # requests received while answering a search
+        self.pending = []
+        try:
+            while True:
+                if self.pending:
+                    msgid, tag, op, controls = self.pending.pop(0)
+                else:
+                    msgid, tag, op, controls = self._receive()
+                if self.server.drop_connection():
+                    return
+                if tag == lc.OP_UNBIND_REQUEST:
+                    return
+                if tag == lc.OP_BIND_REQUEST:
+                    self._send(msgid, ldap_result(lc.OP_BIND_RESPONSE))
+                elif tag == lc.OP_SEARCH_REQUEST:
+                    self.search(msgid, op, controls)
+        except (EOFError, OSError):
+            # closed by the client, maybe while answering
+            return
+
+    def abandoned(self, msgid):
+        "Whether the client abandoned the search C{msgid} in the meantime"
+        while True:
+            request = self._receive(block=False)
+            if request is None:
+                return False
+            if request[1] == lc.OP_ABANDON_REQUEST:
+                if lc.ber_to_int(request[2]) == msgid:
+                    self.server.count("abandoned")
+                    return True
+            else:
+                self.pending.append(request)
+
+    def search(self, msgid, op, controls):
+        fields = lc.ber_decode_all(op)
+        base = fields[0][1].decode("utf-8").lower()
+        sizelimit = lc.ber_to_int(fields[3][1])
+        match = compile_filter(*fields[6])
+        attrs = [a.decode("utf-8") for _, a in lc.ber_decode_all(fields[7][1])]
+        paged = _paged_results(controls)
+        # the cookie is the number of entries sent in the previous pages
+        page_size, offset = 0, 0
+        if paged:
+            page_size, offset = paged[0], int(paged[1] or 0)
+        self.server.count("searches")
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        matched = 0
+        for dn, entry in self.server.entries:
+            if base and not dn.lower().endswith(base):
+                continue
+            if not match(entry):
+                continue
+            matched += 1
+            if matched <= offset:
+                continue
+            if sizelimit and matched > sizelimit:
+                self._send(
+                    msgid,
+                    ldap_result(lc.OP_SEARCH_RESULT_DONE, lc.RESULT_SIZELIMIT_EXCEEDED),
+                )
+                return
+            if page_size and matched > offset + page_size:
+                self._send(
+                    msgid,
+                    ldap_result(lc.OP_SEARCH_RESULT_DONE),
+                    [lc.paged_results_control(0, b"%d" % (offset + page_size))],
+                )
+                return
+            # look for an abandon request now and then, not to slow down answers
+            if matched % 32 == 0 and self.abandoned(msgid):
+                return
+            self._send(msgid, encode_entry(dn, entry, attrs))
+        self._send(
+            msgid,
+            ldap_result(lc.OP_SEARCH_RESULT_DONE),
+            paged and [lc.paged_results_control(0)],
+        )
+
+
+class FakeBDII(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Threaded fake BDII serving C{entries} (list of C{(dn, attrs)}).
+
+    Searches are answered after C{delay} seconds, and every request closes
+    the connection instead with probability C{drop}. Searches are counted in
+    C{stats}, as well as those the client abandoned before their end.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, entries, host="127.0.0.1", port=0, delay=0, drop=0, seed=0):
+        socketserver.TCPServer.__init__(self, (host, port), _Handler)
+        self.entries = entries
+        self.delay = delay
+        self.drop = drop
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        # searches (or pages of paged ones) answered and searches abandoned
+        self.stats = {"searches": 0, "abandoned": 0}
+
+    def count(self, name):
+        with self._random_lock:
+            self.stats[name] += 1
+
+    def drop_connection(self):
+        if not self.drop:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.drop
+
+    @property
+    def url(self):
+        return "ldap://%s:%d" % self.server_address
+
+    def start(self):
+        """Serve in a background thread, return self."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2170)
+    parser.add_argument("--sites", type=int, default=10)
+    parser.add_argument("--paths-per-vo", type=int, default=1)
+    parser.add_argument("--glue", default="1", help="GLUE versions served: 1, 2 or 1,2")
+    parser.add_argument("--delay", type=float, default=0, help="seconds per search")
+    parser.add_argument(
+        "--drop", type=float, default=0, help="probability to drop a connection"
+    )
+    args = parser.parse_args()
+    entries = []
+    if "1" in args.glue.split(","):
+        entries += glue13_fixture(args.sites, paths_per_vo=args.paths_per_vo)
+    if "2" in args.glue.split(","):
+        entries += glue2_fixture(args.sites, paths_per_vo=args.paths_per_vo)
+    server = FakeBDII(entries, args.host, args.port, args.delay, args.drop)
+    print("Serving %d entries on %s" % (len(server.entries), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Fake gfal2: an in-process stand-in for the gfal2 module, for benchmarks.
+
+It implements the part of the gfal2 API the probe uses (listdir,
+opendir/read, filecopy, stat, getxattr, unlink, bulk unlink, checksum,
+open/read/write, transfer_parameters and the credential and option setters)
+on an in-memory storage, with latencies and errors injected per operation.
+L{install} makes 'import gfal2' return it:
+
+    import fakegfal2
+    fakegfal2.install(latency={"filecopy": 0.05}, errors={"stat": 0.1})
+"""
+
+import random
+import sys
+import threading
+import time
+import zlib
+
+# seconds every operation sleeps, and probability it fails, by method name
+LATENCY = {}
+ERRORS = {}
+
+# calls of every operation since the last reset(), by method name
+CALLS = {}
+
+_random = random.Random(0)
+_lock = threading.Lock()
+_injected = [0.0]
+
+# files, {surl: bytes}
+_storage = {}
+
+
+class verbose_level(object):
+    normal = 0
+    verbose = 1
+    debug = 2
+    trace = 3
+
+
+class GError(Exception):
+    def __init__(self, message, code=5):
+        Exception.__init__(self, message)
+        self.message = message
+        self.code = code
+
+
+def set_verbose(level):
+    pass
+
+
+def get_version():
+    return "2.0.0-fake"
+
+
+def install(latency=None, errors=None, seed=0):
+    """Make 'import gfal2' return this module, with per-operation
+    C{latency} (seconds) and C{errors} (failure probability)."""
+    LATENCY.clear()
+    LATENCY.update(latency or {})
+    ERRORS.clear()
+    ERRORS.update(errors or {})
+    _random.seed(seed)
+    reset()
+    sys.modules["gfal2"] = sys.modules[__name__]
+
+
+def reset():
+    "Empty the storage, the call counters and the injected latency counter"
+    with _lock:
+        _storage.clear()
+        CALLS.clear()
+        _injected[0] = 0.0
+
+
+def injected():
+    "Total seconds slept in injected latencies so far"
+    return _injected[0]
+
+
+def _operation(name, surl=""):
+    with _lock:
+        CALLS[name] = CALLS.get(name, 0) + 1
+    delay = LATENCY.get(name, 0)
+    if delay:
+        time.sleep(delay)
+        with _lock:
+            _injected[0] += delay
+    if ERRORS.get(name, 0) > 0:
+        with _lock:
+            fail = _random.random() < ERRORS[name]
+        if fail:
+            raise GError("%s: injected error on %s" % (name, surl), 5)
+
+
+class TransferParameters(object):
+    def __init__(self):
+        self.timeout = 0
+        self.create_parent = False
+        self.overwrite = False
+        self.checksum_check = False
+        self.event_callback = None
+
+
+class TransferEvent(object):
+    def __init__(self, stage):
+        self.stage = stage
+        self.timestamp = int(time.time() * 1000)
+        self.side = 0
+        self.domain = "fake"
+        self.description = ""
+
+
+class Stat(object):
+    def __init__(self, size):
+        self.st_size = size
+        self.st_mode = 0o100644
+
+
+class FileDescriptor(object):
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def read(self, size):
+        data = self._data[self._pos : self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def write(self, data):
+        self._data.extend(data)
+        return len(data)
+
+
+class Dirent(object):
+    def __init__(self, name):
+        self.d_name = name
+
+
+class Directory(object):
+    def __init__(self, names):
+        self._names = iter(names)
+
+    def read(self):
+        name = next(self._names, None)
+        return name is not None and Dirent(name) or None
+
+
+class Context(object):
+    def __init__(self):
+        self.options = {}
+
+    def cred_new(self, kind, path):
+        return (kind, path)
+
+    def cred_set(self, prefix, cred):
+        pass
+
+    def set_opt_string_list(self, group, key, values):
+        self.options[(group, key)] = values
+
+    def set_opt_integer(self, group, key, value):
+        self.options[(group, key)] = value
+
+    def set_opt_string(self, group, key, value):
+        self.options[(group, key)] = value
+
+    def transfer_parameters(self):
+        return TransferParameters()
+
+    def listdir(self, surl):
+        _operation("listdir", surl)
+        prefix = surl.rstrip("/") + "/"
+        return [s[len(prefix) :] for s in list(_storage) if s.startswith(prefix)]
+
+    def opendir(self, surl):
+        _operation("opendir", surl)
+        prefix = surl.rstrip("/") + "/"
+        return Directory(
+            [s[len(prefix) :] for s in list(_storage) if s.startswith(prefix)]
+        )
+
+    def filecopy(self, params, src, dst):
+        _operation("filecopy", dst)
+        if params.event_callback:
+            params.event_callback(TransferEvent("TRANSFER:ENTER"))
+        if src.startswith("file://"):
+            with open(src[len("file://") :], "rb") as fp:
+                _storage[dst] = fp.read()
+        else:
+            try:
+                data = _storage[src]
+            except KeyError:
+                raise GError("%s: No such file or directory" % src, 2)
+            with open(dst[len("file://") :], "wb") as fp:
+                fp.write(data)
+        if params.event_callback:
+            params.event_callback(TransferEvent("TRANSFER:EXIT"))
+
+    def stat(self, surl):
+        _operation("stat", surl)
+        try:
+            return Stat(len(_storage[surl]))
+        except KeyError:
+            raise GError("%s: No such file or directory" % surl, 2)
+
+    def getxattr(self, surl, name):
+        _operation("getxattr", surl)
+        if surl not in _storage:
+            raise GError("%s: No such file or directory" % surl, 2)
+        protocols = self.options.get(("SRM PLUGIN", "TURL_PROTOCOLS"), ["gsiftp"])
+        return "%s://fake/%s" % (protocols[0], surl.split("SFN=", 1)[-1])
+
+    def checksum(self, surl, algorithm):
+        _operation("checksum", surl)
+        try:
+            data = _storage[surl]
+        except KeyError:
+            raise GError("%s: No such file or directory" % surl, 2)
+        if algorithm.upper() == "ADLER32":
+            return "%08x" % (zlib.adler32(data) & 0xFFFFFFFF)
+        import hashlib
+
+        return hashlib.md5(data).hexdigest()
+
+    def open(self, surl, mode):
+        _operation("open", surl)
+        if "w" in mode:
+            _storage[surl] = bytearray()
+            return FileDescriptor(_storage[surl])
+        try:
+            return FileDescriptor(_storage[surl])
+        except KeyError:
+            raise GError("%s: No such file or directory" % surl, 2)
+
+    def unlink(self, surl):
+        if isinstance(surl, list):
+            errors = []
+            for one in surl:
+                try:
+                    self.unlink(one)
+                    errors.append(None)
+                except GError as e:
+                    errors.append(e)
+            return errors
+        _operation("unlink", surl)
+        if _storage.pop(surl, None) is None:
+            raise GError("%s: No such file or directory" % surl, 2)
+
+
+def creat_context():
+    return Context()
@@ -41,6 +41,7 @@ This package provides the nagios probes for SRM.
 make install DESTDIR=%{buildroot}
 mkdir -p %{buildroot}%{_libdir}/nagios/plugins/srm
 cp --preserve=timestamps plugins/*.py %{buildroot}%{_libdir}/nagios/plugins/srm
+mkdir -p %{buildroot}%{_localstatedir}/cache/%{name}
 
 %clean
 rm -rf %{buildroot}
@@ -48,6 +49,7 @@ rm -rf %{buildroot}
 %files
 %defattr(-,root,root,-)
 %{nagios_plugins_dir}/srm
+%dir %attr(0755,nagios,nagios) %{_localstatedir}/cache/%{name}
 %doc LICENSE README.md
 
 %changelog
@@ -27,23 +27,69 @@ Grid utility functions.
 """
 
 import sys
+import os
 import re
+import json
+import base64
+import itertools
+import time
 import subprocess
+import signal
 import socket
+import threading
+import queue
 from random import choice
 
+import ldapclient
+
 LDAP_TIMEOUT_NETWORK = 20
 LDAP_TIMELIMIT_SEARCH = 20
 
+# LDAP client used when none is given: 'api' (native LDAPv3 client, see
+# ldapclient module) or 'cli' (ldapsearch)
+LDAP_CLIENT = "api"
+LDAP_CLIENTS = ("api", "cli")
+
+# Most entries returned by a BDII query (0: no limit), and entries asked for
+# at a time with the RFC 2696 paged results control (0: no paging)
+LDAP_SIZELIMIT = 0
+LDAP_PAGE_SIZE = 0
+
+# Delay between starting concurrent liveness probes of BDII endpoints
+LDAP_PROBE_STAGGER = 0.25
+
+# Directory for the BDII endpoints health scoreboard (None: not persisted)
+# and how long a failed endpoint is tried after the others
+LDAP_HEALTH_CACHE_DIR = None
+LDAP_HEALTH_WINDOW = 3600
+
+# Seconds DNS answers are cached, and failed lookups (negative caching): the
+# resolver doesn't give the TTL of the records, these are used instead. 0
+# disables the cache
+DNS_CACHE_TTL = 300
+DNS_NEGATIVE_TTL = 60
+
+# Directory where DNS answers are persisted between runs (None: in memory only)
+DNS_CACHE_DIR = None
+
+# Reverse DNS lookups of IP addresses only used in messages
+DNS_REVERSE_LOOKUPS = False
+
 
 class ErrLDAPTimeout(Exception):
     """LDAP timeout exception."""
 
 
+class ErrLDAPQuery(Exception):
+    """BDII query failure, the arguments being C{(N, summary, detmsg)} as
+    returned by L{query_bdii()} on failure."""
+
+
 # Return codes in case of LDAP query errors
 LDAP_QE_EMPTYSET = 0
 LDAP_QE_LDAP = 1
 LDAP_QE_TIMEOUT = 2
+LDAP_QE_SIZELIMIT = 4
 LDAP_QE_OTHER = 7
 
 
@@ -54,10 +100,14 @@ def query_bdii(
     ldap_base="o=grid",
     ldap_timelimit=LDAP_TIMELIMIT_SEARCH,
     net_timeout=LDAP_TIMEOUT_NETWORK,
+    ldap_client=None,
+    sizelimit=None,
+    page_size=None,
 ):
     """Query BDII (LDAP based).
 
-    Depending on availability uses either LDAP API or CLI.
+    Depending on C{ldap_client} uses either LDAP API or CLI. With the API the
+    liveness check of the BDII and the search share one connection.
 
     @param ldap_filter: non-empty filter.
     @type ldap_filter: L{str}
@@ -70,6 +120,14 @@ def query_bdii(
     @type ldap_timelimit: L{int}
     @param net_timeout: connection timeout (default: L{LDAP_TIMEOUT_NETWORK}).
     @type net_timeout: L{int}
+    @param ldap_client: 'api' or 'cli' (default: L{LDAP_CLIENT}).
+    @type ldap_client: L{str}
+    @param sizelimit: most entries returned, 0 for no limit (default:
+      L{LDAP_SIZELIMIT}).
+    @type sizelimit: L{int}
+    @param page_size: entries asked for at a time with the paged results
+      control, 0 for no paging (default: L{LDAP_PAGE_SIZE}).
+    @type page_size: L{int}
 
     @return:
       - on success:
@@ -77,6 +135,10 @@ def query_bdii(
             C{('<LDAPnameSpace>', {'<attribute>': ['<value>',..],..})}. Eg.:
               - ('GlueSALocalID=ops,...,Mds-Vo-name=local,o=grid',
                 {'GlueSAStateAvailableSpace': ['197000000000']})
+      - on truncation:
+          - (2, [entries]) - the entries received before the size limit
+            (C{sizelimit} or the BDII's own) was reached, the answer is
+            incomplete.
       - on failure:
           - (0, (N, summary, detmsg))
               - N - 0 : query returned empty set
@@ -84,112 +146,357 @@ def query_bdii(
               - N - 2 : timeout
     @rtype: L{tuple}
     """
+    entries = []
+    try:
+        for entry in query_bdii_iter(
+            ldap_filter,
+            ldap_attrlist,
+            ldap_url,
+            ldap_base,
+            ldap_timelimit,
+            net_timeout,
+            ldap_client,
+            sizelimit,
+            page_size,
+        ):
+            entries.append(entry)
+    except ErrLDAPQuery as e:
+        if e.args[0] == LDAP_QE_SIZELIMIT and entries:
+            return 2, entries
+        return 0, e.args
+    return 1, entries
+
+
+def query_bdii_iter(
+    ldap_filter,
+    ldap_attrlist,
+    ldap_url="",
+    ldap_base="o=grid",
+    ldap_timelimit=LDAP_TIMELIMIT_SEARCH,
+    net_timeout=LDAP_TIMEOUT_NETWORK,
+    ldap_client=None,
+    sizelimit=None,
+    page_size=None,
+):
+    """Query BDII (LDAP based), yielding the entries as they are received.
+
+    The answer is never held in memory as a whole, whatever its size. When
+    the caller stops iterating (the generator is closed), the search is
+    abandoned, or ldapsearch is killed with the CLI.
+
+    For parameters see L{query_bdii()}.
+
+    @return: generator of C{('<LDAPnameSpace>', {'<attribute>': ['<value>',..],..})}
+    @raises ErrLDAPQuery: the query failed or returned an empty set, with
+      the C{(N, summary, detmsg)} of L{query_bdii()} as arguments. N is
+      L{LDAP_QE_SIZELIMIT} if the answer was truncated at the size limit,
+      raised after its last entry.
+    """
     if not ldap_filter:
         msg = "ldap_filer must be specified (%s())" % sys._getframe(1).f_code.co_name
-        return 0, (LDAP_QE_OTHER, msg, msg)
+        raise ErrLDAPQuery(LDAP_QE_OTHER, msg, msg)
 
     if not isinstance(ldap_attrlist, list):
         msg = (
             "attributes list should be a list object (%s())"
             % sys._getframe(1).f_code.co_name
         )
-        return (0, (LDAP_QE_OTHER, msg, msg))
+        raise ErrLDAPQuery(LDAP_QE_OTHER, msg, msg)
 
+    ldap_client = ldap_client or LDAP_CLIENT
+    if sizelimit is None:
+        sizelimit = LDAP_SIZELIMIT
+    if page_size is None:
+        page_size = LDAP_PAGE_SIZE
     ldaps = (
-        ldap_url and ldap_url.split(",") or sys.get_env("LCG_GFAL_INFOSYS").split(",")
+        ldap_url
+        and ldap_url.split(",")
+        or os.environ.get("LCG_GFAL_INFOSYS", "").split(",")
     )
     try:
-        ldap_url = get_working_ldap(ldaps)  # IP address
+        ldap_url, conn = __get_working_ldap(
+            ldaps, net_timeout, ldap_client
+        )  # IP address
     except (TypeError, ValueError, LookupError) as e:
-        return 0, (
+        raise ErrLDAPQuery(
             LDAP_QE_OTHER,
             "Failed to get working BDII from [%s]." % ",".join(ldaps),
             str(e),
         )
+    entries = None
     try:
-
-        return __ldap_CLI(
-            ldap_filter, ldap_attrlist, ldap_url, ldap_base, ldap_timelimit, net_timeout
-        )
+        if conn:
+            entries = __ldap_API(
+                conn,
+                ldap_filter,
+                ldap_attrlist,
+                ldap_url,
+                ldap_base,
+                ldap_timelimit,
+                sizelimit,
+                page_size,
+            )
+        else:
+            entries = __ldap_CLI(
+                ldap_filter,
+                ldap_attrlist,
+                ldap_url,
+                ldap_base,
+                ldap_timelimit,
+                net_timeout,
+                sizelimit,
+                page_size,
+            )
+        empty = True
+        for entry in entries:
+            empty = False
+            yield entry
+        if empty:
+            raise ErrLDAPQuery(
+                *__return_query_failed_emtpy_set(
+                    ldap_url, ldap_attrlist, ldap_filter, ldap_base
+                )[1]
+            )
+    except ErrLDAPQuery:
+        raise
     except Exception as e:
-        return 0, (
+        raise ErrLDAPQuery(
             LDAP_QE_OTHER,
             "Exception while querying BDII [%s]" % ldap_url,
             str(e),
         )
+    finally:
+        if entries is not None:
+            entries.close()
+        if conn:
+            conn.close()
+
+
+def __ldap_API(
+    conn,
+    ldap_filter,
+    ldap_attrlist,
+    ldap_url,
+    ldap_base,
+    ldap_timelimit,
+    sizelimit,
+    page_size,
+):
+    """Query LDAP using the native client on an already bound connection.
+
+    For signature see L{query_bdii_iter()}
+    """
+    bdii = to_full_bdii_url(ldap_url)
+    entries = conn.search(
+        ldap_base,
+        ldap_filter,
+        ldap_attrlist,
+        sizelimit=sizelimit,
+        timelimit=ldap_timelimit,
+        page_size=page_size,
+    )
+    returned = 0
+    try:
+        for entry in entries:
+            returned += 1
+            yield entry
+    except ldapclient.LDAPTimeout:
+        stsmsg = detmsg = "LDAP search timed out after %i sec. %s" % (
+            ldap_timelimit,
+            bdii,
+        )
+        raise ErrLDAPQuery(LDAP_QE_TIMEOUT, stsmsg, detmsg)
+    except ldapclient.LDAPError as e:
+        stsmsg = "%s %s" % (str(e).strip(), bdii)
+        detmsg = "search -b %s %s %s\n%s" % (
+            ldap_base,
+            ldap_filter,
+            " ".join(ldap_attrlist),
+            stsmsg,
+        )
+        raise ErrLDAPQuery(LDAP_QE_LDAP, stsmsg, detmsg)
+    finally:
+        entries.close()
+    if conn.truncated:
+        raise ErrLDAPQuery(*__query_truncated(returned, bdii))
 
 
 def __ldap_CLI(
-    ldap_filter, ldap_attrlist, ldap_url, ldap_base, ldap_timelimit, net_timetout
+    ldap_filter,
+    ldap_attrlist,
+    ldap_url,
+    ldap_base,
+    ldap_timelimit,
+    net_timetout,
+    sizelimit,
+    page_size,
 ):
     """Query LDAP using CLI.
 
-    For signature see L{query_bdii()}
+    For signature see L{query_bdii_iter()}
     """
 
     if not isinstance(ldap_attrlist, list):
         stsmsg = detmsg = (
             "Error invoking LDAP search CPI: attributes " + "list should be a list."
         )
-        return (0, (LDAP_QE_OTHER, stsmsg, detmsg))
+        raise ErrLDAPQuery(LDAP_QE_OTHER, stsmsg, detmsg)
 
     bdii = to_full_bdii_url(ldap_url)
 
-    cmd = "ldapsearch -l %i -x -LLL -h %s -b %s %s %s" % (
-        ldap_timelimit,
-        bdii,
+    cmd = [
+        "ldapsearch",
+        "-l",
+        "%i" % ldap_timelimit,
+        "-o",
+        "nettimeout=%i" % net_timetout,
+        "-x",
+        "-LLL",
+        "-H",
+        to_full_ldap_url(ldap_url),
+        "-b",
         ldap_base,
-        ldap_filter,
-        " ".join([x for x in ldap_attrlist]),
-    )
+    ]
+    if sizelimit:
+        cmd += ["-z", "%i" % sizelimit]
+    if page_size:
+        # non critical, all pages without prompting
+        cmd += ["-E", "pr=%i/noprompt" % page_size]
+    cmd += [ldap_filter] + ldap_attrlist
 
-    res = ""
     try:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            start_new_session=True,
+        )
+    except Exception as e:
+        stsmsg = "%s %s" % (str(e).strip(), bdii)
+        detmsg = "%s\n%s" % (" ".join(cmd), stsmsg)
+        raise ErrLDAPQuery(LDAP_QE_LDAP, stsmsg, detmsg)
 
-        res = subprocess.check_output(cmd.split(" "))
-        res = res.decode(encoding="utf-8", errors="strict")
-
-    except ErrLDAPTimeout:
+    # ldapsearch may not honour the time limit if the server is stuck
+    killer = threading.Timer(
+        ldap_timelimit + net_timetout, _kill_process_group, (proc,)
+    )
+    killer.daemon = True
+    killer.start()
+    try:
+        returned = 0
+        truncated = False
+        for entry in parse_ldif(proc.stdout, ldap_attrlist):
+            if sizelimit and returned >= sizelimit:
+                # ldapsearch doesn't honour the size limit
+                truncated = True
+                _kill_process_group(proc)
+                break
+            returned += 1
+            yield entry
+        stderr = proc.stderr.read().decode("utf-8", "replace")
+        rc = proc.wait()
+    finally:
+        killer.cancel()
+        if proc.poll() is None:
+            # the caller stopped reading
+            _kill_process_group(proc)
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if truncated or rc == 4:  # sizeLimitExceeded (4)
+        raise ErrLDAPQuery(*__query_truncated(returned, bdii))
+    if rc in (-9, 3):  # killed by us or timeLimitExceeded (3)
         stsmsg = detmsg = "LDAP search timed out after %i sec. %s" % (
             ldap_timelimit,
             bdii,
         )
-        return (0, (LDAP_QE_TIMEOUT, stsmsg, detmsg))
-    except Exception as e:
-        stsmsg = "%s %s" % (str(e).strip(), bdii)
-        detmsg = "%s\n%s" % (cmd, stsmsg)
-        return (0, (LDAP_QE_LDAP, stsmsg, detmsg))
-
-    if res:
-        # remove line foldings made by ldapsearch
-        res = res.replace("\n ", "").strip()
-        entries = []
-        res = res.split("dn: ")
-        # loop through values in "dn:"
-        for dn in res:
-            if dn:
-                dl = dn.splitlines()
-                # remove empty lines
-                for i, v in enumerate(dl):
-                    if not v:
-                        del dl[i]
-                # make dict key/value pairs out
-                # of Glue "Attribute: Value" pairs
-                d = {}
-                for x in dl[1:]:
-                    t = x.split(":", 1)
-                    t[0] = t[0].strip()
-                    t[1] = t[1].strip()
-                    if t[0] in d:
-                        d[t[0]].append(t[1])
+        raise ErrLDAPQuery(LDAP_QE_TIMEOUT, stsmsg, detmsg)
+    if rc not in (0, 32):  # No such object (32)
+        stsmsg = "%s %s" % (stderr.strip() or "ldapsearch exit code %i" % rc, bdii)
+        detmsg = "%s\n%s" % (" ".join(cmd), stsmsg)
+        raise ErrLDAPQuery(LDAP_QE_LDAP, stsmsg, detmsg)
+
+
+def __query_truncated(returned, bdii):
+    """Error arguments of an answer truncated at the size limit."""
+    stsmsg = detmsg = "LDAP search size limit reached after %i entries %s" % (
+        returned,
+        bdii,
+    )
+    return LDAP_QE_SIZELIMIT, stsmsg, detmsg
+
+
+def _kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _ldif_value(line, sep):
+    """Decode value of LDIF C{attr: value} / C{attr:: base64} line."""
+    if line[sep + 1 : sep + 2] not in (":", "<"):
+        return line[sep + 1 :].lstrip(" ")
+    if line[sep + 1 : sep + 2] == ":":
+        value = base64.b64decode(line[sep + 2 :].strip())
+        return value.decode("utf-8", "replace")
+    # 'attr:< URL' values are returned as the URL
+    if line[sep + 1 : sep + 2] == "<":
+        sep += 1
+    return line[sep + 1 :].lstrip(" ")
+
+
+def parse_ldif(stream, attrlist=None):
+    """Parse LDIF incrementally, yielding entries as they are read.
+
+    Handles line folding, comments, base64 encoded (C{attr:: value}) and
+    multi-valued attributes.
+
+    @param stream: iterable of LDIF lines (C{bytes} or C{str}), e.g. a file
+      or the stdout pipe of ldapsearch.
+    @param attrlist: if given, only these attributes (case-insensitive) are
+      kept in the entries.
+    @type attrlist: L{list}
+
+    @return: generator of C{('<dn>', {'<attribute>': ['<value>',..],..})}
+    """
+    wanted = attrlist and set(a.lower() for a in attrlist) or None
+    dn = None
+    entry = {}
+    pending = None  # logical line being unfolded
+    # the trailing empty line flushes the last entry
+    for line in itertools.chain(stream, ("",)):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        if line[:1] == " ":
+            # continuation of a folded line
+            if pending is not None:
+                pending += line[1:].rstrip("\r\n")
+            continue
+        if pending is not None:
+            sep = pending.find(":")
+            if sep > 0:
+                name = pending[:sep]
+                lname = name.lower()
+                if lname == "dn":
+                    dn = _ldif_value(pending, sep)
+                elif dn is not None and (wanted is None or lname in wanted):
+                    value = _ldif_value(pending, sep)
+                    if name in entry:
+                        entry[name].append(value)
                     else:
-                        d[t[0]] = [t[1]]
-                entries.append((dl[0], d))
-        return (1, (entries))
-    else:
-        return __return_query_failed_emtpy_set(
-            ldap_url, ldap_attrlist, ldap_filter, ldap_base
-        )
+                        entry[name] = [value]
+            pending = None
+        line = line.rstrip("\r\n")
+        if not line:
+            if dn is not None:
+                yield dn, entry
+            dn = None
+            entry = {}
+        elif line[:1] != "#":
+            pending = line
 
 
 def __return_query_failed_emtpy_set(ldap_url, ldap_attrlist, ldap_filter, ldap_base):
@@ -205,16 +512,21 @@ def __return_query_failed_emtpy_set(ldap_url, ldap_attrlist, ldap_filter, ldap_b
     return (0, (LDAP_QE_EMPTYSET, stsmsg, detmsg))
 
 
-def get_working_ldap(ldaps, net_timeout=LDAP_TIMEOUT_NETWORK):
+def get_working_ldap(ldaps, net_timeout=LDAP_TIMEOUT_NETWORK, ldap_client=None):
     """Test given list of LDAP servers and return a first working one as IP
     address.
 
-    Depending on availability uses either LDAP API or CLI.
+    Depending on C{ldap_client} uses either LDAP API or CLI. Hostnames are
+    resolved and their addresses probed concurrently (see
+    L{_first_working_ldap()}); addresses which failed recently, according to
+    the scoreboard kept in L{LDAP_HEALTH_CACHE_DIR}, are probed last.
 
     @param  ldaps: list of LDAP endpoints (ldap://<hostname>:[<port>]).
     @type ldaps: L{list}
     @param net_timeout: connection timeout (default: L{LDAP_TIMEOUT_NETWORK}).
     @type net_timeout: L{int}
+    @param ldap_client: 'api' or 'cli' (default: L{LDAP_CLIENT}).
+    @type ldap_client: L{str}
 
     @return:
       - on success:
@@ -226,6 +538,21 @@ def get_working_ldap(ldaps, net_timeout=LDAP_TIMEOUT_NETWORK):
       - TypeError - L{ldaps} must be a list object.
       - ValueError - list of empty endpoints or empty list is given.
     """
+    ldap_url, conn = __get_working_ldap(ldaps, net_timeout, ldap_client or LDAP_CLIENT)
+    if conn:
+        conn.close()
+    return ldap_url
+
+
+def __get_working_ldap(ldaps, net_timeout, ldap_client):
+    """Find first working LDAP server.
+
+    For parameters and exceptions see L{get_working_ldap()}.
+
+    @return: C{(endpoint, connection)} - connection is a bound
+      L{ldapclient.LDAPConnection} for the 'api' client, None for 'cli'.
+    @rtype: L{tuple}
+    """
 
     if not isinstance(ldaps, list):
         raise TypeError("ldaps should be a list object.")
@@ -245,29 +572,206 @@ def get_working_ldap(ldaps, net_timeout=LDAP_TIMEOUT_NETWORK):
                 % sys._getframe(0).f_code.co_name
             )
     failed_ldaps = {}
+
+    # resolve all hostnames concurrently
+    hosts = []
     for ldap_url in ldaps:
         proto, hostname, port = parse_uri3(ldap_url)
-        try:
-            ips = dns_lookup_forward(hostname)
-        except IOError as e:
+        hosts.append((ldap_url, proto, hostname, port))
+    resolved = _run_concurrently(
+        [(dns_lookup_forward, (h[2],)) for h in hosts], net_timeout
+    )
+    candidates = []
+    for (ldap_url, proto, hostname, port), (done, ips, error) in zip(hosts, resolved):
+        if not done:
+            failed_ldaps[ldap_url] = "DNS lookup timed out after %s sec." % net_timeout
+        elif error:
             # Forward DNS resolution failed. Continue with the next host.
-            failed_ldaps[ldap_url] = str(e)
-            continue
+            failed_ldaps[ldap_url] = str(error)
         else:
             for ip in ips:
-                ldap_url_ip = "%s%s:%s" % (proto or "", ip, port)
+                candidates.append("%s%s:%s" % (proto or "", ip, port))
+
+    # endpoints which failed recently are tried last
+    health = _ldap_health_load()
+    candidates.sort(key=lambda url: _ldap_health_failed_recently(health.get(url)))
+
+    if ldap_client == "cli":
+        bind = __ldap_bind_CLI
+    else:
+        bind = __ldap_bind_API
+    ldap_url_ip, conn, errors = _first_working_ldap(candidates, bind, net_timeout)
+    for url, error in errors.items():
+        failed_ldaps[ldap_url2hostname_ip(url)] = error
+    _ldap_health_update(errors.keys(), ldap_url_ip)
+    if ldap_url_ip:
+        return ldap_url_ip, conn
 
-                rc, error = __ldap_bind_CLI(ldap_url_ip, net_timeout)
-                if rc:
-                    return ldap_url_ip
-                host_ip = ldap_url2hostname_ip(ldap_url_ip)
-                failed_ldaps[host_ip] = error
     msg = ""
     for k, v in failed_ldaps.items():
         msg = "%s* %s: %s" % (msg and msg + "\n" or "", k, v)
     raise LookupError(msg)
 
 
+def _run_concurrently(calls, timeout):
+    """Run C{[(function, args),..]} in daemon threads and wait for all of them
+    at most C{timeout} seconds.
+
+    @return: list of C{(done, result, exception)}, in order of C{calls}.
+    @rtype: L{list}
+    """
+    results = [(False, None, None)] * len(calls)
+
+    def call(i, function, args):
+        try:
+            results[i] = (True, function(*args), None)
+        except Exception as e:
+            results[i] = (True, None, e)
+
+    threads = []
+    for i, (function, args) in enumerate(calls):
+        thread = threading.Thread(target=call, args=(i, function, args))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return list(results)
+
+
+def _first_working_ldap(urls, bind, net_timeout):
+    """Probe LDAP endpoints concurrently and return the first working one.
+
+    Attempts are started in the order of C{urls}, C{LDAP_PROBE_STAGGER}
+    seconds apart unless an earlier attempt finished already, so that
+    preferred endpoints win when they are healthy while a dead endpoint
+    can't stall the others. Once an endpoint answers, attempts not started
+    yet are dropped and connections of attempts still running are closed
+    as soon as they finish.
+
+    @param bind: L{__ldap_bind_API} or L{__ldap_bind_CLI}.
+    @return: C{(url, connection, {failed_url: error})}, url is None if no
+      endpoint works. Attempts which did not finish before the working one
+      are not in the errors: they were only slower.
+    @rtype: L{tuple}
+    """
+    answers = queue.Queue()
+    lock = threading.Lock()
+    state = {"done": False}
+
+    def attempt(url):
+        try:
+            res = bind(url, net_timeout)
+        except Exception as e:
+            res = (0, str(e) or e.__class__.__name__)
+        rc, error, conn = res[0], res[1], len(res) > 2 and res[2] or None
+        with lock:
+            if state["done"]:
+                if conn:
+                    conn.close()
+                return
+            answers.put((url, rc, error, conn))
+
+    errors = {}
+    pending = list(urls)
+    running = []
+    while pending or running:
+        if pending and (not running or answers.empty()):
+            url = pending.pop(0)
+            thread = threading.Thread(target=attempt, args=(url,))
+            thread.daemon = True
+            thread.start()
+            running.append(url)
+        try:
+            wait = pending and LDAP_PROBE_STAGGER or net_timeout + 1
+            url, rc, error, conn = answers.get(timeout=wait)
+        except queue.Empty:
+            if pending:
+                continue
+            # remaining attempts overran their own timeout
+            for url in running:
+                errors[url] = "timed out after %s sec." % net_timeout
+            url, conn = None, None
+            break
+        running.remove(url)
+        if rc:
+            # attempts still running are only slower than this one
+            break
+        errors[url] = error
+    else:
+        url, conn = None, None
+    with lock:
+        state["done"] = True
+    while not answers.empty():
+        late = answers.get()
+        if late[3]:
+            late[3].close()
+    return url, conn, errors
+
+
+def _ldap_health_load():
+    """Load the LDAP endpoints health scoreboard.
+
+    @return: C{{url: {'failure': timestamp, 'success': timestamp}}}
+    @rtype: L{dict}
+    """
+    if not LDAP_HEALTH_CACHE_DIR:
+        return {}
+    _, health = FileCache(LDAP_HEALTH_CACHE_DIR, "ldap-health").load("endpoints")
+    return health or {}
+
+
+def _ldap_health_failed_recently(entry):
+    if not entry or not entry.get("failure"):
+        return False
+    if entry["failure"] < time.time() - LDAP_HEALTH_WINDOW:
+        return False
+    return entry["failure"] > entry.get("success", 0)
+
+
+def _ldap_health_update(failed, succeeded):
+    """Record failed and successful endpoints in the health scoreboard."""
+    if not LDAP_HEALTH_CACHE_DIR or not (failed or succeeded):
+        return
+    now = time.time()
+    health = _ldap_health_load()
+    for url in failed:
+        health.setdefault(url, {})["failure"] = now
+    if succeeded:
+        health.setdefault(succeeded, {})["success"] = now
+    # forget about endpoints not seen for a long time
+    for url in list(health.keys()):
+        if max(health[url].values()) < now - 10 * LDAP_HEALTH_WINDOW:
+            del health[url]
+    FileCache(LDAP_HEALTH_CACHE_DIR, "ldap-health").store("endpoints", health)
+
+
+def __ldap_bind_API(url, net_timeout):
+    """Bind to LDAP using the native client.
+
+    @param url: LDAP URI (ldap://<hostname>:[<port>]).
+    @type url: L{str}
+    @param net_timeout: network timeout
+    @type net_timeout: L{int}
+
+    @return:
+      - on success: C{(1, '', connection)}
+      - on failure: C{(0, 'error message', None)}
+    @rtype: L{tuple}
+    """
+    host, port = parse_uri(to_full_bdii_url(url))
+    conn = None
+    try:
+        conn = ldapclient.LDAPConnection(host, port, net_timeout)
+        conn.bind()
+    except ldapclient.LDAPError as e:
+        if conn:
+            conn.close()
+        return 0, str(e), None
+    return 1, "", conn
+
+
 def __ldap_bind_CLI(url, net_timeout):
     """Bind to LDAP using CLI.
 
@@ -281,9 +785,15 @@ def __ldap_bind_CLI(url, net_timeout):
       - on failure: C{(0, 'error message')}
     @rtype: L{tuple}
     """
-    cmd = "ldapsearch -xLLL -h %s" % (to_full_bdii_url(url))
+    cmd = "ldapsearch -xLLL -o nettimeout=%i -H %s" % (
+        net_timeout,
+        to_full_ldap_url(url),
+    )
 
-    rc = subprocess.call(cmd.split(" "))
+    try:
+        rc = subprocess.call(cmd.split(" "), timeout=net_timeout)
+    except subprocess.TimeoutExpired:
+        return 0, "timed out after %i sec." % net_timeout
 
     if rc not in (0, 32):  # No such object (32)
         return 0, "%i" % (rc)
@@ -315,8 +825,70 @@ def to_full_bdii_url(url, port="2170"):
     return "%s:%s" % (hp[0], hp[1])
 
 
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+
+
+def _dns_cached(kind, name, resolve):
+    """Answer of ``resolve(name)`` from the DNS cache, in memory then in
+    `DNS_CACHE_DIR`, or resolved and cached for `DNS_CACHE_TTL` seconds,
+    `DNS_NEGATIVE_TTL` seconds if it raises IOError.
+
+    :param kind: lookup type, ``forward`` or ``reverse``
+    :raises IOError: the lookup failed, now or when the cached error was
+    """
+    if DNS_CACHE_TTL <= 0:
+        return resolve(name)
+    key = (kind, name.lower())
+    now = time.time()
+    with _dns_cache_lock:
+        entry = _dns_cache.get(key)
+    if entry is None and DNS_CACHE_DIR:
+        timestamp, value = FileCache(DNS_CACHE_DIR, "dns").load(key)
+        if isinstance(value, list) and len(value) == 2:
+            entry = (timestamp, value[0], value[1])
+    if entry is not None:
+        timestamp, ok, value = entry
+        ttl = ok and DNS_CACHE_TTL or min(DNS_NEGATIVE_TTL, DNS_CACHE_TTL)
+        if now - ttl <= timestamp <= now:
+            with _dns_cache_lock:
+                _dns_cache[key] = entry
+            if not ok:
+                raise IOError(value)
+            return value
+    try:
+        value = resolve(name)
+        ok = True
+    except IOError as e:
+        value = str(e)
+        ok = False
+    with _dns_cache_lock:
+        _dns_cache[key] = (now, ok, value)
+    if DNS_CACHE_DIR:
+        FileCache(DNS_CACHE_DIR, "dns").store(key, [ok, value], now)
+    if not ok:
+        raise IOError(value)
+    return value
+
+
+def _gethostbyaddr(ip):
+    try:
+        hostname, _, _ = socket.gethostbyaddr(ip)
+    except (socket.gaierror, socket.herror) as e:
+        raise IOError(str(e))
+    return hostname
+
+
+def _gethostbyname(hostname):
+    try:
+        _, _, ips = socket.gethostbyname_ex(hostname)
+    except (socket.gaierror, socket.herror) as e:
+        raise IOError(str(e))
+    return ips
+
+
 def dns_lookup_reverse(ip):
-    """Reverse DNS lookup.
+    """Reverse DNS lookup, cached (see `_dns_cached()`).
 
     :param ip: valid IP as string
     :type ip: `str`
@@ -330,11 +902,7 @@ def dns_lookup_reverse(ip):
         socket.inet_aton(ip)
     except socket.error:
         raise ValueError("Not valid IP address given: %r" % ip)
-    try:
-        hostname, _, _ = socket.gethostbyaddr(ip)
-    except (socket.gaierror, socket.herror) as e:
-        raise IOError(str(e))
-    return hostname
+    return _dns_cached("reverse", ip, _gethostbyaddr)
 
 
 def ldap_url2hostname_ip(ldap_url):
@@ -342,20 +910,24 @@ def ldap_url2hostname_ip(ldap_url):
       - [ldap://hostname:port [ip]] - if ldap_url based on IP address
       - [ldap://hostname:port] - in other cases
 
+    The IP address is only resolved if `DNS_REVERSE_LOOKUPS` is set.
+
     :rtype: `str`
     """
     host, port = parse_uri2(ldap_url)
-    try:
-        socket.inet_aton(host)
-        hostname = dns_lookup_reverse(host)
-    except (socket.error, IOError):
-        return "[ldap://%s%s]" % (host, port and ":" + port or "")
-    else:
-        return "[ldap://%s%s [%s]]" % (hostname, port and ":" + port or "", host)
+    if DNS_REVERSE_LOOKUPS:
+        try:
+            socket.inet_aton(host)
+            hostname = dns_lookup_reverse(host)
+        except (socket.error, IOError):
+            pass
+        else:
+            return "[ldap://%s%s [%s]]" % (hostname, port and ":" + port or "", host)
+    return "[ldap://%s%s]" % (host, port and ":" + port or "")
 
 
 def dns_lookup_forward(hostname):
-    """Forward DNS lookup.
+    """Forward DNS lookup, cached (see `_dns_cached()`).
 
     :param hostname: hostname
     :type hostname: `str`
@@ -367,11 +939,7 @@ def dns_lookup_forward(hostname):
     """
     if not hostname:
         raise ValueError("Empty hostname provided.")
-    try:
-        _, _, ips = socket.gethostbyname_ex(hostname)
-    except (socket.gaierror, socket.herror) as e:
-        raise IOError(str(e))
-    return ips
+    return list(_dns_cached("forward", hostname, _gethostbyname))
 
 
 def parse_uri(uri):
@@ -418,3 +986,73 @@ def parse_uri3(uri):
     """
     m = re.match(r"([a-zA-Z0-9_]*://)?([^/:$]*):?(\d+)?/?", uri)
     return [m.group(1), m.group(2), m.group(3)]
+
+
+class FileCache(object):
+    """Small on-disk cache of JSON serialisable values.
+
+    Every key is stored in its own file under C{directory}/C{namespace}. Files
+    are written to a temporary name and atomically renamed into place, so any
+    number of probe processes can read and update the cache concurrently
+    without locking: readers see either the old or the new entry, never a
+    partial one, and the last writer wins.
+    """
+
+    def __init__(self, directory, namespace):
+        self.path = os.path.join(directory, namespace)
+
+    def _filename(self, key):
+        import hashlib
+
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest + ".json")
+
+    def load(self, key):
+        """Return C{(timestamp, value)} stored for C{key}.
+
+        @return: C{(None, None)} if there is no (readable) entry.
+        @rtype: L{tuple}
+        """
+        try:
+            with open(self._filename(key)) as fp:
+                entry = json.load(fp)
+            if entry["key"] != repr(key):
+                return None, None
+            return entry["timestamp"], entry["value"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def store(self, key, value, timestamp=None):
+        """Store C{value} for C{key}.
+
+        @return: True on success, False if the cache is not writable.
+        @rtype: L{bool}
+        """
+        entry = {
+            "key": repr(key),
+            "timestamp": timestamp or time.time(),
+            "value": value,
+        }
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                return False
+        try:
+            import tempfile
+
+            fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(entry, fp)
+            os.rename(tmpname, self._filename(key))
+        except (IOError, OSError, TypeError, ValueError):
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return False
+        return True
@@ -0,0 +1,239 @@
+##############################################################################
+#
+# NAME:        history.py
+#
+# FACILITY:    SAM (Service Availability Monitoring)
+#
+# COPYRIGHT:
+#         Licensed under the Apache License, Version 2.0.
+#         http://www.apache.org/licenses/LICENSE-2.0
+#         This software is provided "as is", without warranties
+#         or conditions of any kind, either express or implied.
+#
+# DESCRIPTION:
+#
+#         Local history of probe results, kept in a SQLite database so that
+#         latency trends and failure rates are available without going
+#         through Nagios.
+#
+##############################################################################
+
+"""
+Local history of probe results.
+
+Every run stores the status of each metric and the timings of the storage
+operations, keyed by endpoint, in a SQLite database in WAL mode: many probe
+processes can write at once, each in one short transaction, while readers
+are never blocked.
+
+A latency baseline of every timing is also kept up to date incrementally,
+see L{ewma_update}, so that thresholds can be derived from it without going
+through the history.
+"""
+
+import math
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    ts REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    status INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_ts ON results (ts);
+CREATE INDEX IF NOT EXISTS results_endpoint ON results (endpoint, ts);
+CREATE TABLE IF NOT EXISTS timings (
+    ts REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    label TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timings_ts ON timings (ts);
+CREATE INDEX IF NOT EXISTS timings_endpoint ON timings (endpoint, ts);
+CREATE TABLE IF NOT EXISTS baselines (
+    endpoint TEXT NOT NULL,
+    label TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    mad REAL NOT NULL,
+    ts REAL NOT NULL,
+    PRIMARY KEY (endpoint, label)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Statuses counted as failures (nagios CRITICAL and UNKNOWN)
+FAILED_STATUSES = (2, 3)
+
+# Seconds between two prunings of the database
+PRUNE_INTERVAL = 3600
+
+
+def percentile(values, p):
+    """Nearest-rank C{p} percentile of sorted C{values}.
+
+    @rtype: L{float}
+    """
+    if not values:
+        return None
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def ewma_update(baseline, value, alpha):
+    """Add C{value} to C{baseline}, an exponentially weighted moving average
+    of the values and of their absolute deviation from it (a moving mean
+    absolute deviation), in constant time and space.
+
+    The first values are averaged with equal weights, until there are enough
+    of them for the weight C{alpha} of the new value.
+
+    @param baseline: C{(n, mean, mad)}, or None if there are no values yet.
+    @return: the updated C{(n, mean, mad)}.
+    @rtype: L{tuple}
+    """
+    if baseline is None:
+        return 1, value, 0.0
+    n, mean, mad = baseline
+    weight = max(alpha, 1.0 / (n + 1))
+    deviation = abs(value - mean)
+    return n + 1, mean + weight * (value - mean), mad + weight * (deviation - mad)
+
+
+class History(object):
+    """Results history in the SQLite database C{path}, created if needed.
+
+    A writer waits up to C{timeout} seconds for another one to finish. The
+    connection can only be used by the thread which opened it.
+    """
+
+    def __init__(self, path, timeout=10.0):
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode a crash can lose the last commits, not corrupt the base
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def record(self, endpoint, statuses, timings, timestamp=None):
+        """Store the results of one run of the probe against C{endpoint}.
+
+        @param statuses: list of C{(metric, status)}.
+        @param timings: dictionary C{{label: seconds}}.
+        """
+        ts = timestamp or time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO results VALUES (?, ?, ?, ?)",
+                [(ts, endpoint, metric, status) for metric, status in statuses],
+            )
+            self.conn.executemany(
+                "INSERT INTO timings VALUES (?, ?, ?, ?)",
+                [(ts, endpoint, label, s) for label, s in sorted(timings.items())],
+            )
+
+    def baselines(self, endpoint):
+        """Latency baselines of every timing of C{endpoint}.
+
+        @return: dictionary C{{label: (n, mean, mad)}}.
+        """
+        rows = self.conn.execute(
+            "SELECT label, n, mean, mad FROM baselines WHERE endpoint = ?",
+            (endpoint,),
+        )
+        return dict((label, (n, mean, mad)) for label, n, mean, mad in rows)
+
+    def update_baselines(self, endpoint, timings, alpha, timestamp=None):
+        """Add the C{timings} of one run against C{endpoint} to its baselines,
+        see L{ewma_update}.
+
+        @param timings: dictionary C{{label: seconds}}.
+        """
+        ts = timestamp or time.time()
+        with self.conn:
+            # read and written under the write lock, no update is lost
+            self.conn.execute("BEGIN IMMEDIATE")
+            baselines = self.baselines(endpoint)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO baselines VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (endpoint, label)
+                    + ewma_update(baselines.get(label), seconds, alpha)
+                    + (ts,)
+                    for label, seconds in sorted(timings.items())
+                ],
+            )
+
+    def prune(self, retention, now=None):
+        """Delete results older than C{retention} seconds, at most once every
+        L{PRUNE_INTERVAL} seconds whichever process asks for it.
+
+        @return: True if the database was pruned.
+        """
+        now = now or time.time()
+        with self.conn:
+            # the write lock is taken first, only one process prunes
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'pruned'"
+            ).fetchone()
+            if row and now - row[0] < PRUNE_INTERVAL:
+                return False
+            self.conn.execute("DELETE FROM results WHERE ts < ?", (now - retention,))
+            self.conn.execute("DELETE FROM timings WHERE ts < ?", (now - retention,))
+            self.conn.execute("DELETE FROM baselines WHERE ts < ?", (now - retention,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('pruned', ?)", (now,)
+            )
+        return True
+
+    def _where(self, since, endpoint):
+        if endpoint is None:
+            return "ts >= ?", (since,)
+        return "endpoint = ? AND ts >= ?", (endpoint, since)
+
+    def failure_rates(self, since, endpoint=None):
+        """Runs and failures of every metric since C{since}.
+
+        @return: dictionary C{{(endpoint, metric): (runs, failures)}}.
+        """
+        where, params = self._where(since, endpoint)
+        rows = self.conn.execute(
+            "SELECT endpoint, metric, COUNT(*), SUM(status IN (%s)) FROM results "
+            "WHERE %s GROUP BY endpoint, metric"
+            % (", ".join(str(s) for s in FAILED_STATUSES), where),
+            params,
+        )
+        return dict(((e, m), (runs, failures)) for e, m, runs, failures in rows)
+
+    def percentiles(self, since, endpoint=None, ps=(50, 95, 99)):
+        """Percentiles C{ps} of every timing since C{since}.
+
+        @return: dictionary C{{(endpoint, label): (count, [percentiles])}}.
+        """
+        where, params = self._where(since, endpoint)
+        rows = self.conn.execute(
+            "SELECT endpoint, label, seconds FROM timings WHERE %s "
+            "ORDER BY endpoint, label, seconds" % where,
+            params,
+        )
+        values = {}
+        for e, label, seconds in rows:
+            values.setdefault((e, label), []).append(seconds)
+        return dict(
+            (key, (len(v), [percentile(v, p) for p in ps])) for key, v in values.items()
+        )
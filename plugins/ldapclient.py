@@ -0,0 +1,585 @@
+##############################################################################
+#
+# NAME:        ldapclient.py
+#
+# FACILITY:    SAM (Service Availability Monitoring)
+#
+# COPYRIGHT:
+#         Licensed under the Apache License, Version 2.0.
+#         http://www.apache.org/licenses/LICENSE-2.0
+#         This software is provided "as is", without warranties
+#         or conditions of any kind, either express or implied.
+#
+# DESCRIPTION:
+#
+#         Minimal LDAPv3 client (anonymous bind and search) speaking BER
+#         directly over a socket, used to query the BDII without forking
+#         ldapsearch.
+#
+##############################################################################
+
+"""
+Minimal LDAPv3 search client.
+
+Only what is needed to query a BDII is implemented: anonymous simple bind,
+search with an RFC 4515 string filter and RFC 2696 paged results, abandon,
+and unbind.
+"""
+
+import re
+import socket
+import time
+
+LDAP_PORT = 389
+LDAP_VERSION = 3
+
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+# LDAP result codes the client cares about
+RESULT_SUCCESS = 0
+RESULT_TIMELIMIT_EXCEEDED = 3
+RESULT_SIZELIMIT_EXCEEDED = 4
+RESULT_NO_SUCH_OBJECT = 32
+
+# BER universal tags
+TAG_BOOLEAN = 0x01
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_ENUMERATED = 0x0A
+TAG_SEQUENCE = 0x30
+TAG_SET = 0x31
+
+# LDAP protocol operations (RFC 4511, APPLICATION class)
+OP_BIND_REQUEST = 0x60
+OP_BIND_RESPONSE = 0x61
+OP_UNBIND_REQUEST = 0x42
+OP_ABANDON_REQUEST = 0x50
+OP_SEARCH_REQUEST = 0x63
+OP_SEARCH_RESULT_ENTRY = 0x64
+OP_SEARCH_RESULT_DONE = 0x65
+OP_SEARCH_RESULT_REFERENCE = 0x73
+
+# Controls
+TAG_CONTROLS = 0xA0
+CONTROL_PAGED_RESULTS = "1.2.840.113556.1.4.319"
+
+# Search filter choices (RFC 4511, context-specific class)
+FILTER_AND = 0xA0
+FILTER_OR = 0xA1
+FILTER_NOT = 0xA2
+FILTER_EQUALITY = 0xA3
+FILTER_SUBSTRINGS = 0xA4
+FILTER_GREATER_OR_EQUAL = 0xA5
+FILTER_LESS_OR_EQUAL = 0xA6
+FILTER_PRESENT = 0x87
+FILTER_APPROX = 0xA8
+SUBSTRING_INITIAL = 0x80
+SUBSTRING_ANY = 0x81
+SUBSTRING_FINAL = 0x82
+
+
+class LDAPError(Exception):
+    """LDAP protocol or server error.
+
+    C{result_code} is the LDAP result code returned by the server, or None
+    for protocol and connection errors.
+    """
+
+    def __init__(self, message, result_code=None):
+        Exception.__init__(self, message)
+        self.result_code = result_code
+
+
+class LDAPTimeout(LDAPError):
+    """Network or search time limit exceeded."""
+
+
+# ########################################################################### #
+# BER encoding
+
+
+def ber_length(length):
+    """Encode BER definite length."""
+    if length < 0x80:
+        return bytes([length])
+    octets = []
+    while length:
+        octets.insert(0, length & 0xFF)
+        length >>= 8
+    return bytes([0x80 | len(octets)] + octets)
+
+
+def ber_tlv(tag, content):
+    """Encode tag, length and C{content} (bytes)."""
+    return bytes([tag]) + ber_length(len(content)) + content
+
+
+def ber_integer(value, tag=TAG_INTEGER):
+    """Encode a (non-negative) integer."""
+    octets = [value & 0xFF]
+    value >>= 8
+    while value:
+        octets.insert(0, value & 0xFF)
+        value >>= 8
+    if octets[0] & 0x80:
+        octets.insert(0, 0)
+    return ber_tlv(tag, bytes(octets))
+
+
+def ber_enumerated(value):
+    return ber_integer(value, TAG_ENUMERATED)
+
+
+def ber_boolean(value):
+    return ber_tlv(TAG_BOOLEAN, value and b"\xff" or b"\x00")
+
+
+def ber_string(value, tag=TAG_OCTET_STRING):
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return ber_tlv(tag, value)
+
+
+def ber_sequence(items, tag=TAG_SEQUENCE):
+    return ber_tlv(tag, b"".join(items))
+
+
+# ########################################################################### #
+# BER decoding
+
+
+def ber_decode(data, offset=0):
+    """Decode one TLV from C{data} starting at C{offset}.
+
+    @return: C{(tag, content, next_offset)}
+    @rtype: L{tuple}
+    @raises LDAPError: on truncated or malformed data.
+    """
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            n = length & 0x7F
+            if not n or n > 4:
+                raise LDAPError("Unsupported BER length encoding")
+            length = int.from_bytes(data[offset : offset + n], "big")
+            offset += n
+    except IndexError:
+        raise LDAPError("Truncated BER data")
+    end = offset + length
+    if end > len(data):
+        raise LDAPError("Truncated BER data")
+    return tag, data[offset:end], end
+
+
+def ber_decode_all(data):
+    """Decode all TLVs contained in C{data}.
+
+    @return: list of C{(tag, content)}
+    @rtype: L{list}
+    """
+    items = []
+    offset = 0
+    while offset < len(data):
+        tag, content, offset = ber_decode(data, offset)
+        items.append((tag, content))
+    return items
+
+
+def ber_to_int(content):
+    return int.from_bytes(content, "big", signed=True) if content else 0
+
+
+def ber_message_length(data):
+    """Return full length of the TLV at the beginning of C{data}.
+
+    @return: length in bytes or None if C{data} does not hold the complete
+      tag and length octets yet.
+    """
+    if len(data) < 2:
+        return None
+    length = data[1]
+    if not length & 0x80:
+        return 2 + length
+    n = length & 0x7F
+    if not n or n > 4:
+        raise LDAPError("Unsupported BER length encoding")
+    if len(data) < 2 + n:
+        return None
+    return 2 + n + int.from_bytes(data[2 : 2 + n], "big")
+
+
+# ########################################################################### #
+# Search filters (RFC 4515)
+
+_filter_escape_re = re.compile(rb"\\([0-9a-fA-F]{2})")
+
+
+def _filter_unescape(value):
+    """Resolve C{\\XX} escapes in an assertion value."""
+    return _filter_escape_re.sub(
+        lambda m: bytes([int(m.group(1), 16)]), value.encode("utf-8")
+    )
+
+
+def _filter_item(item):
+    """Encode a simple filter item, e.g. C{attr=val*ue}."""
+    m = re.match(r"^([^=~<>()]+)(=|~=|>=|<=)(.*)$", item, re.S)
+    if not m:
+        raise LDAPError("Bad search filter component: (%s)" % item)
+    attr, op, value = m.group(1).strip(), m.group(2), m.group(3)
+    if op == "~=":
+        return ber_sequence(
+            [ber_string(attr), ber_string(_filter_unescape(value))], FILTER_APPROX
+        )
+    if op == ">=":
+        return ber_sequence(
+            [ber_string(attr), ber_string(_filter_unescape(value))],
+            FILTER_GREATER_OR_EQUAL,
+        )
+    if op == "<=":
+        return ber_sequence(
+            [ber_string(attr), ber_string(_filter_unescape(value))],
+            FILTER_LESS_OR_EQUAL,
+        )
+    if value == "*":
+        return ber_string(attr, FILTER_PRESENT)
+    if "*" not in value:
+        return ber_sequence(
+            [ber_string(attr), ber_string(_filter_unescape(value))], FILTER_EQUALITY
+        )
+    parts = value.split("*")
+    substrings = []
+    if parts[0]:
+        substrings.append(ber_string(_filter_unescape(parts[0]), SUBSTRING_INITIAL))
+    for part in parts[1:-1]:
+        if part:
+            substrings.append(ber_string(_filter_unescape(part), SUBSTRING_ANY))
+    if parts[-1]:
+        substrings.append(ber_string(_filter_unescape(parts[-1]), SUBSTRING_FINAL))
+    return ber_sequence([ber_string(attr), ber_sequence(substrings)], FILTER_SUBSTRINGS)
+
+
+def _filter_parse(text, pos):
+    """Parse filter starting at C{text[pos]} == '('.
+
+    @return: C{(encoded_filter, next_pos)}
+    """
+    if pos >= len(text) or text[pos] != "(":
+        raise LDAPError("Bad search filter: %s" % text)
+    pos += 1
+    if pos >= len(text):
+        raise LDAPError("Bad search filter: %s" % text)
+    op = text[pos]
+    if op in "&|!":
+        pos += 1
+        components = []
+        while pos < len(text) and text[pos] == "(":
+            component, pos = _filter_parse(text, pos)
+            components.append(component)
+        if pos >= len(text) or text[pos] != ")" or not components:
+            raise LDAPError("Bad search filter: %s" % text)
+        if op == "!":
+            if len(components) != 1:
+                raise LDAPError("Bad search filter: %s" % text)
+            return ber_tlv(FILTER_NOT, components[0]), pos + 1
+        tag = op == "&" and FILTER_AND or FILTER_OR
+        return ber_sequence(components, tag), pos + 1
+    end = text.find(")", pos)
+    if end < 0:
+        raise LDAPError("Bad search filter: %s" % text)
+    return _filter_item(text[pos:end]), end + 1
+
+
+def encode_filter(text):
+    """Encode RFC 4515 string filter into BER.
+
+    A filter without enclosing parentheses (e.g. C{objectClass=*}) is
+    accepted as well.
+    """
+    text = text.strip()
+    if not text.startswith("("):
+        text = "(%s)" % text
+    encoded, pos = _filter_parse(text, 0)
+    if pos != len(text):
+        raise LDAPError("Bad search filter: %s" % text)
+    return encoded
+
+
+# ########################################################################### #
+# Client
+
+
+def _decode_result(content):
+    """Decode LDAPResult.
+
+    @return: C{(result_code, matched_dn, diagnostic_message)}
+    """
+    items = ber_decode_all(content)
+    if len(items) < 3:
+        raise LDAPError("Malformed LDAPResult")
+    return (
+        ber_to_int(items[0][1]),
+        items[1][1].decode("utf-8", "replace"),
+        items[2][1].decode("utf-8", "replace"),
+    )
+
+
+def paged_results_control(size, cookie=b""):
+    """Encode the RFC 2696 paged results control, not critical: servers which
+    don't support it send all the entries at once."""
+    value = ber_sequence([ber_integer(size), ber_string(cookie)])
+    return ber_sequence(
+        [ber_string(CONTROL_PAGED_RESULTS), ber_boolean(False), ber_string(value)]
+    )
+
+
+def decode_paged_results_cookie(controls):
+    """Cookie of the paged results control in the C{controls} of a message.
+
+    @return: the cookie, empty if there are no more pages.
+    @rtype: L{bytes}
+    """
+    for _, control in ber_decode_all(controls):
+        items = ber_decode_all(control)
+        if items and items[0][1].decode("utf-8", "replace") == CONTROL_PAGED_RESULTS:
+            _, value, _ = ber_decode(items[-1][1])
+            return ber_decode_all(value)[1][1]
+    return b""
+
+
+def decode_entry(content, attrs=None):
+    """Decode SearchResultEntry.
+
+    @param attrs: if given, only attributes in this (lower-case) set are kept.
+    @return: C{(dn, {'<attribute>': ['<value>',..],..})}
+    """
+    _, dn, offset = ber_decode(content)
+    _, attr_list, _ = ber_decode(content, offset)
+    entry = {}
+    for _, attribute in ber_decode_all(attr_list):
+        _, name, offset = ber_decode(attribute)
+        name = name.decode("utf-8", "replace")
+        if attrs is not None and name.lower() not in attrs:
+            continue
+        _, values, _ = ber_decode(attribute, offset)
+        entry.setdefault(name, []).extend(
+            [v.decode("utf-8", "replace") for _, v in ber_decode_all(values)]
+        )
+    return dn.decode("utf-8", "replace"), entry
+
+
+class LDAPConnection(object):
+    """Single connection to an LDAP server.
+
+    @param host: hostname or IP address.
+    @param port: LDAP port.
+    @param timeout: network timeout in seconds, used for the connection and
+      for every read from the server.
+    """
+
+    def __init__(self, host, port=LDAP_PORT, timeout=None):
+        self.host = host
+        self.port = int(port or LDAP_PORT)
+        self.timeout = timeout
+        # whether the last search was cut at its size limit
+        self.truncated = False
+        self._msgid = 0
+        self._buffer = bytearray()
+        try:
+            self._sock = socket.create_connection((host, self.port), timeout)
+        except socket.timeout:
+            raise LDAPTimeout(
+                "Connection to %s:%s timed out after %s sec."
+                % (host, self.port, timeout)
+            )
+        except (socket.error, OSError) as e:
+            raise LDAPError("Can't contact LDAP server %s:%s (%s)" % (host, port, e))
+
+    def _send(self, op, controls=None):
+        self._msgid += 1
+        items = [ber_integer(self._msgid), op]
+        if controls:
+            items.append(ber_sequence(controls, TAG_CONTROLS))
+        try:
+            self._sock.sendall(ber_sequence(items))
+        except socket.timeout:
+            raise LDAPTimeout("Sending to %s:%s timed out" % (self.host, self.port))
+        except (socket.error, OSError) as e:
+            raise LDAPError("Error sending to %s:%s (%s)" % (self.host, self.port, e))
+        return self._msgid
+
+    def _recv(self, deadline=None):
+        """Receive one LDAPMessage.
+
+        @return: C{(msgid, op_tag, op_content, controls)}
+        """
+        while True:
+            length = ber_message_length(self._buffer)
+            if length is not None and len(self._buffer) >= length:
+                break
+            timeout = self.timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LDAPTimeout("LDAP search timed out")
+                timeout = timeout and min(timeout, remaining) or remaining
+            self._sock.settimeout(timeout)
+            try:
+                chunk = self._sock.recv(65536)
+            except socket.timeout:
+                raise LDAPTimeout(
+                    "Reading from %s:%s timed out" % (self.host, self.port)
+                )
+            except (socket.error, OSError) as e:
+                raise LDAPError(
+                    "Error reading from %s:%s (%s)" % (self.host, self.port, e)
+                )
+            if not chunk:
+                raise LDAPError("Connection closed by %s:%s" % (self.host, self.port))
+            self._buffer.extend(chunk)
+        message = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        _, content, _ = ber_decode(message)
+        items = ber_decode_all(content)
+        if len(items) < 2:
+            raise LDAPError("Malformed LDAPMessage")
+        controls = len(items) > 2 and items[2][1] or b""
+        return ber_to_int(items[0][1]), items[1][0], items[1][1], controls
+
+    def bind(self):
+        """Anonymous simple bind.
+
+        @raises LDAPError: if the server refused the bind.
+        """
+        op = ber_sequence(
+            [ber_integer(LDAP_VERSION), ber_string(""), ber_string("", 0x80)],
+            OP_BIND_REQUEST,
+        )
+        msgid = self._send(op)
+        while True:
+            rmsgid, tag, content, _ = self._recv()
+            if rmsgid == msgid and tag == OP_BIND_RESPONSE:
+                break
+        code, _, message = _decode_result(content)
+        if code != RESULT_SUCCESS:
+            raise LDAPError("Bind failed: %s (%i)" % (message, code), code)
+
+    def search(
+        self,
+        base,
+        ldap_filter,
+        attrlist=None,
+        scope=SCOPE_SUBTREE,
+        sizelimit=0,
+        timelimit=0,
+        page_size=0,
+    ):
+        """Search and yield entries as they arrive.
+
+        The client gives up C{timelimit} + C{timeout} seconds after the
+        request was sent, even if the server does not honour the time limit.
+        Likewise no more than C{sizelimit} entries are returned, and
+        C{truncated} is set once the search ends if there were more. With
+        C{page_size}, the entries are asked for C{page_size} at a time with
+        the paged results control. A search left before its end (the
+        generator is closed) is abandoned.
+
+        @return: generator of C{(dn, {'<attribute>': ['<value>',..],..})}
+        @raises LDAPTimeout: on time limit exceeded.
+        @raises LDAPError: on other errors; C{result_code} is set if the
+          server returned an error.
+        """
+        attrlist = attrlist or []
+        op = ber_sequence(
+            [
+                ber_string(base),
+                ber_enumerated(scope),
+                ber_enumerated(0),  # never dereference aliases
+                ber_integer(sizelimit),
+                ber_integer(timelimit),
+                ber_boolean(False),
+                encode_filter(ldap_filter),
+                ber_sequence([ber_string(a) for a in attrlist]),
+            ],
+            OP_SEARCH_REQUEST,
+        )
+        wanted = attrlist and set(a.lower() for a in attrlist) or None
+        deadline = None
+        if timelimit:
+            deadline = time.time() + timelimit + (self.timeout or 0)
+        returned = 0
+        cookie = b""
+        msgid = None
+        self.truncated = False
+        try:
+            while True:
+                controls = page_size and [paged_results_control(page_size, cookie)]
+                msgid = self._send(op, controls)
+                while True:
+                    rmsgid, tag, content, controls = self._recv(deadline)
+                    if rmsgid != msgid:
+                        continue
+                    if tag == OP_SEARCH_RESULT_ENTRY:
+                        if sizelimit and returned >= sizelimit:
+                            # the server doesn't honour the size limit
+                            self.truncated = True
+                            return
+                        returned += 1
+                        yield decode_entry(content, wanted)
+                    elif tag == OP_SEARCH_RESULT_DONE:
+                        msgid = None
+                        break
+                    # search result references are not followed
+                code, _, message = _decode_result(content)
+                if code == RESULT_TIMELIMIT_EXCEEDED:
+                    raise LDAPTimeout(
+                        "LDAP search timed out after %i sec." % timelimit, code
+                    )
+                if code not in (
+                    RESULT_SUCCESS,
+                    RESULT_SIZELIMIT_EXCEEDED,
+                    RESULT_NO_SUCH_OBJECT,
+                ):
+                    raise LDAPError("%s (%i)" % (message or "LDAP error", code), code)
+                if code == RESULT_SIZELIMIT_EXCEEDED:
+                    self.truncated = True
+                    return
+                cookie = page_size and decode_paged_results_cookie(controls)
+                if code != RESULT_SUCCESS or not cookie:
+                    return
+                if sizelimit and returned >= sizelimit:
+                    # the next pages would be over the limit
+                    self.truncated = True
+                    return
+        finally:
+            if msgid is not None:
+                self.abandon(msgid)
+
+    def abandon(self, msgid):
+        """Ask the server to stop processing the request C{msgid}, there is
+        no response."""
+        try:
+            self._send(ber_integer(msgid, OP_ABANDON_REQUEST))
+        except LDAPError:
+            pass
+
+    def close(self):
+        """Unbind and close the connection."""
+        try:
+            self._send(ber_tlv(OP_UNBIND_REQUEST, b""))
+        except LDAPError:
+            pass
+        try:
+            self._sock.close()
+        except (socket.error, OSError):
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -8,16 +8,21 @@ new SRM probe, using gfal2, NAP, and compatible with python3
 
 """
 
+# Modules not needed by every run (gfal2 above all, but also datetime,
+# filecmp, shutil, tempfile, ...) are imported where they are used, so that
+# --help, --version and argument errors start fast.
 import sys
 import time
 import gridutils
-import tempfile
-import datetime
-import filecmp
-import gfal2
 import nap.core
-import shutil
 import os
+import re
+import signal
+import zlib
+import io as _io
+import argparse
+import logging
+import threading
 
 try:
     from urlparse import urlparse
@@ -28,6 +33,30 @@ except BaseException:
 PROBE_VERSION = "v0.0.5"
 
 
+def parse_size(value):
+    "argparse type for sizes: bytes, or with a K, M, G or T (binary) suffix"
+    m = re.match(r"^\s*(\d+)\s*([KMGT]?)(i?B)?\s*$", value, re.IGNORECASE)
+    if not m or int(m.group(1)) <= 0:
+        raise argparse.ArgumentTypeError("invalid size: %r" % value)
+    return int(m.group(1)) * 1024 ** "_KMGT".index(m.group(2).upper() or "_")
+
+
+VERIFY_METHODS = ("diff", "checksum", "stream")
+
+
+def parse_verify(value):
+    "argparse type for --verify: comma separated VERIFY_METHODS"
+    methods = [m.strip() for m in value.split(",") if m.strip()]
+    for m in methods:
+        if m not in VERIFY_METHODS:
+            raise argparse.ArgumentTypeError("invalid verification method: %r" % m)
+    if not methods:
+        raise argparse.ArgumentTypeError("no verification method given")
+    if "diff" in methods and "stream" in methods:
+        raise argparse.ArgumentTypeError("diff and stream both download the file")
+    return methods
+
+
 # ########################################################################### #
 app = nap.core.Plugin(description="NAGIOS SRM probe", version=PROBE_VERSION)
 app.add_argument("-E", "--endpoint", help="SRM base SURL to test")
@@ -42,36 +71,975 @@ app.add_argument(
     dest="ldap_url",
     default="ldap://lcg-bdii.egi.eu:2170",
 )
+app.add_argument(
+    "--ldap-client",
+    dest="ldap_client",
+    choices=gridutils.LDAP_CLIENTS,
+    help="LDAP client used to query the BDII: native LDAPv3 client (api) or "
+    "ldapsearch (cli)",
+    default=gridutils.LDAP_CLIENT,
+)
+app.add_argument(
+    "--glue",
+    choices=("auto", "1", "2"),
+    help="information schema the SURLs are discovered from in the BDII: GLUE "
+    "1.3 (1), GLUE 2 (2), or GLUE 1.3 then GLUE 2 if the storage element isn't "
+    "published in GLUE 1.3, remembering per storage element which one worked "
+    "(auto)",
+    default="auto",
+)
 app.add_argument(
     "--se-timeout",
     dest="se_timeout",
     type=int,
-    help="storage operations timeout",
+    help="storage operations timeout, less if the -t budget of the run ends " "before",
     default=60,
 )
+app.add_argument(
+    "--cache-dir",
+    dest="cache_dir",
+    help="directory for data cached between probe runs",
+    default="/var/cache/nagios-plugins-srm",
+)
+app.add_argument(
+    "--bdii-cache-ttl",
+    dest="bdii_cache_ttl",
+    type=int,
+    help="seconds a cached BDII answer is used without querying the BDII "
+    "(0 disables the cache)",
+    default=3600,
+)
+app.add_argument(
+    "--bdii-sizelimit",
+    dest="bdii_sizelimit",
+    type=int,
+    help="most entries read from a BDII answer, the rest is dropped (0 for no "
+    "limit)",
+    default=gridutils.LDAP_SIZELIMIT,
+)
+app.add_argument(
+    "--bdii-page-size",
+    dest="bdii_page_size",
+    type=int,
+    help="entries asked for at a time to the BDII with the LDAP paged results "
+    "control (0 for no paging)",
+    default=gridutils.LDAP_PAGE_SIZE,
+)
+app.add_argument(
+    "--dns-cache-ttl",
+    dest="dns_cache_ttl",
+    type=int,
+    help="seconds a DNS answer is cached in memory and in --cache-dir, failed "
+    "lookups at most %d seconds (0 disables the cache)" % gridutils.DNS_NEGATIVE_TTL,
+    default=gridutils.DNS_CACHE_TTL,
+)
+app.add_argument(
+    "--batch",
+    help="check all storage elements listed in this file ('-' for stdin), one "
+    "'HOSTNAME [ENDPOINT]' per line, and submit passive results for each of them",
+)
+app.add_argument(
+    "--no-bdii-prefetch",
+    dest="bdii_prefetch",
+    action="store_false",
+    help="in batch mode, query the BDII per storage element instead of once for "
+    "all storage elements of the VO",
+)
+app.add_argument(
+    "--daemon",
+    action="store_true",
+    help="keep checking the storage elements listed in the --batch file on a "
+    "schedule, submitting passive results, until terminated",
+)
+app.add_argument(
+    "--interval",
+    type=int,
+    help="in daemon mode, seconds between two checks of a storage element, "
+    "unless set per storage element with 'interval=SECONDS'",
+    default=300,
+)
+app.add_argument(
+    "--jitter",
+    type=int,
+    help="in daemon mode, up to this many seconds are randomly added to every "
+    "check interval, to spread the checks",
+    default=30,
+)
+app.add_argument(
+    "--workers",
+    type=int,
+    help="number of storage elements checked concurrently in batch mode",
+    default=10,
+)
+app.add_argument(
+    "--payload-size",
+    dest="payload_size",
+    type=parse_size,
+    help="size of the test file copied to and from the storage, e.g. 1M or 10G, "
+    "to measure throughput (raise --se-timeout accordingly); by default a "
+    "20 bytes file",
+)
+app.add_argument(
+    "--payload-io",
+    dest="payload_io",
+    choices=("file", "memory"),
+    help="how the test file is written and read: local files copied with "
+    "gfal2 filecopy (file), or streamed from memory with gfal2 open/write/read, "
+    "no local file at all (memory)",
+    default="file",
+)
+app.add_argument(
+    "--verify",
+    type=parse_verify,
+    help="how VOGet verifies the file on the storage, comma separated: diff "
+    "(download and compare with the local file), checksum (compare the "
+    "checksum computed by the storage, no download), stream (checksum the "
+    "file while reading it, no local copy)",
+    default="diff",
+)
+app.add_argument(
+    "--checksum-type",
+    dest="checksum_type",
+    choices=("ADLER32", "MD5"),
+    help="checksum used by the checksum and stream verification methods",
+    default="ADLER32",
+)
+app.add_argument(
+    "--lsdir-mode",
+    dest="lsdir_mode",
+    choices=("listdir", "stream", "stat"),
+    help="how VOLsDir checks the storage paths: list the whole directory with "
+    "gfal2 listdir (listdir), read up to --lsdir-limit entries with gfal2 "
+    "opendir/read (stream), or only stat the directory (stat)",
+    default="listdir",
+)
+app.add_argument(
+    "--lsdir-limit",
+    dest="lsdir_limit",
+    type=int,
+    help="entries read in VOLsDir with --lsdir-mode stream, 1 to stop at the "
+    "first entry, 0 to read them all",
+    default=100,
+)
+app.add_argument(
+    "--turl-matrix",
+    dest="turl_matrix",
+    action="store_true",
+    help="in VOGetTurl, ask for a TURL for every transfer protocol separately "
+    "and report which ones work and how fast",
+)
+app.add_argument(
+    "--turl-timeout",
+    dest="turl_timeout",
+    type=int,
+    help="timeout of the TURL request of every protocol with --turl-matrix",
+    default=30,
+)
+app.add_argument(
+    "--history-db",
+    dest="history_db",
+    help="SQLite database keeping the results history, by default "
+    "history.sqlite in --cache-dir",
+)
+app.add_argument(
+    "--history-retention",
+    dest="history_retention",
+    type=int,
+    help="days of results kept in the history (0 disables the history)",
+    default=30,
+)
+app.add_argument(
+    "--history-query",
+    dest="history_query",
+    action="store_true",
+    help="print the failure rate of every metric and the p50/p95/p99 of every "
+    "timing in the history, for the -H host or all of them, and exit",
+)
+app.add_argument(
+    "--history-window",
+    dest="history_window",
+    type=int,
+    help="seconds of history used by --history-query",
+    default=86400,
+)
+app.add_argument(
+    "--adaptive",
+    dest="adaptive",
+    action="store_true",
+    help="also derive the latency thresholds of every storage operation from "
+    "its baseline in the results history, see --adaptive-warning",
+)
+app.add_argument(
+    "--adaptive-warning",
+    dest="adaptive_warning",
+    type=float,
+    help="with --adaptive, mean absolute deviations above its baseline an "
+    "operation turns WARNING",
+    default=4.0,
+)
+app.add_argument(
+    "--adaptive-critical",
+    dest="adaptive_critical",
+    type=float,
+    help="with --adaptive, mean absolute deviations above its baseline an "
+    "operation turns CRITICAL",
+    default=8.0,
+)
+app.add_argument(
+    "--breaker-threshold",
+    dest="breaker_threshold",
+    type=int,
+    help="consecutive runs with timed out storage operations after which the "
+    "circuit of the storage element opens (0 disables the circuit breaker)",
+    default=3,
+)
+app.add_argument(
+    "--breaker-timeout",
+    dest="breaker_timeout",
+    type=int,
+    help="storage operations timeout while the circuit is open, until one "
+    "works and closes it",
+    default=10,
+)
+app.add_argument(
+    "--sweep",
+    dest="sweep",
+    action="store_true",
+    help="delete the test files of the probe left on the storage of the -H "
+    "host, older than --sweep-age, and exit",
+)
+app.add_argument(
+    "--sweep-age",
+    dest="sweep_age",
+    type=int,
+    help="age in seconds of the test files deleted by --sweep",
+    default=86400,
+)
+app.add_argument(
+    "--sweep-batch",
+    dest="sweep_batch",
+    type=int,
+    help="test files deleted per bulk unlink by --sweep",
+    default=100,
+)
+app.add_argument(
+    "--sweep-rate",
+    dest="sweep_rate",
+    type=float,
+    help="maximum test files deleted per second by --sweep",
+    default=50,
+)
+app.add_argument(
+    "--sweep-dry-run",
+    dest="sweep_dry_run",
+    action="store_true",
+    help="with --sweep, only count the stale test files, delete none",
+)
+app.add_argument(
+    "--path-workers",
+    dest="path_workers",
+    type=int,
+    help="number of storage paths of one storage element checked concurrently",
+    default=4,
+)
 
 # Reasonable defaults for timeouts
 LCG_GFAL_BDII_TIMEOUT = 10
 
-gfal2.set_verbose(gfal2.verbose_level.normal)
+# Stale BDII answers older than this are not used even if the BDII is down
+BDII_CACHE_MAX_STALE = 7 * 24 * 3600
+
+# GLUE 1.3 attributes the SURLs are built from
+BDII_SURL_ATTRS = ["GlueServiceEndpoint", "GlueSAPath", "GlueVOInfoPath"]
+
+# GLUE 1.3 SRM services, and storage areas and VO info of the VO, see
+# glue13_filter()
+BDII_GLUE13_FILTER = (
+    "(|(&(GlueChunkKey=GlueSEUniqueID=%(host)s)"
+    "(|(GlueSAAccessControlBaseRule=%(vo)s)(GlueSAAccessControlBaseRule=VO:%(vo)s)))"
+    "(&(GlueChunkKey=GlueSEUniqueID=%(host)s)"
+    "(|(GlueVOInfoAccessControlBaseRule=%(vo)s)"
+    "(GlueVOInfoAccessControlBaseRule=VO:%(vo)s)))"
+    "(&(GlueServiceUniqueID=%(service)s)(GlueServiceVersion=%(version)s.*)"
+    "(GlueServiceType=srm*)))"
+)
+
+# GLUE 2 attributes the SURLs are built from, and the ones joining SRM
+# endpoints, storage shares and VO mapping policies
+BDII_GLUE2_SURL_ATTRS = ["GLUE2EndpointURL", "GLUE2StorageSharePath"]
+BDII_GLUE2_ENDPOINT_ATTRS = ["GLUE2EndpointURL", "GLUE2EndpointServiceForeignKey"]
+BDII_GLUE2_SHARE_ATTRS = [
+    "GLUE2ShareID",
+    "GLUE2StorageSharePath",
+    "GLUE2ShareServiceForeignKey",
+    "GLUE2MappingPolicyShareForeignKey",
+]
+BDII_GLUE2_BASE = "o=glue"
+
+# TURL protocols asked to the SRM, in order of preference
+TURL_PROTOCOLS = ("gsiftp", "https", "root", "rfio", "gsidcap", "dcap", "kdcap")
+
+# Seconds of the -t budget of a run kept to report its results, and part of
+# the rest, at least a second, kept to delete the test files (VODel), see
+# run_deadline()
+DEADLINE_MARGIN = 2
+DEADLINE_CLEANUP = 0.1
+
+# Block the sized payload is generated from, see write_payload()
+PAYLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Weight of the last timing in the latency baselines, see history.ewma_update()
+ADAPTIVE_ALPHA = 0.1
+
+# Timings a baseline needs before thresholds are derived from it
+ADAPTIVE_MIN_SAMPLES = 10
+
+# Smallest deviation used for thresholds: a fraction of the baseline mean,
+# and seconds, so that steady or very fast operations don't alert on noise
+ADAPTIVE_MIN_SPREAD = 0.1
+ADAPTIVE_MIN_SPREAD_SECONDS = 0.01
+
+# Order of statuses when per-path results are combined, worst last
+STATUS_SEVERITY = (nap.OK, nap.UNKNOWN, nap.WARNING, nap.CRITICAL)
 
 # Service version(s)
 svcVers = ["1", "2"]
 svcVer = "2"
-workdir_metric = tempfile.mkdtemp()
 
 # files and patterns
-_fileTest = workdir_metric + "/testFile.txt"
-_fileTestIn = workdir_metric + "/testFileIn.txt"
+_fileTest = "testFile.txt"
+_fileTestIn = "testFileIn.txt"
 _fileSRMPattern = "testfile-put-%s-%s.txt"  # time, uuid
+_fileSRMRegex = re.compile(r"^testfile-put-(\d+)-[0-9a-f]+\.txt$")
+
+# BDII answer for all storage elements of the VO, see prefetch_bdii()
+_bdiiIndex = None
+
+# gfal2 module and version, set by load_gfal2()
+gfal2 = None
+gfal2_ver = None
+
+
+def load_gfal2():
+    "Import and set up gfal2 on first use, loading it and its plugins is slow"
+    global gfal2, gfal2_ver
+    if gfal2 is None:
+        import gfal2 as module
+
+        module.set_verbose(module.verbose_level.normal)
+        gfal2_ver = "gfal2 " + module.get_version()
+        gfal2 = module
+    return gfal2
+
+
+class _RunState(threading.local):
+    """State of the metrics run for one storage element.
 
-_voInfoDictionary = {}
+    The state is per thread: in batch mode every worker thread checks its
+    storage elements one after the other, reusing its gfal2 contexts.
+    """
+
+    def __init__(self):
+        # gfal2 contexts by settings, see get_context()
+        self.contexts = {}
+        self.reset(app.metric_results())
+
+    def reset(self, results):
+        self.results = results
+        self.started = time.monotonic()
+        self.deadline = None
+        self.circuit = None
+        self.timeout = None
+        self.timed_out = None
+        self.reachable = False
+        self.voInfoDictionary = {}
+        self.timings = {}
+        self.glue = None
+        self.bdii_truncated = False
+        self.operations = {}
+        self.succeeded = {}
+        self.samples = {}
+        self.baselines = None
+        self.payload_checksum = None
+        self.payload_block = None
+        self.workdir = None
+
+    def workfile(self, name):
+        "Path of a local work file, the work directory is created on demand"
+        if self.workdir is None:
+            import tempfile
+
+            self.workdir = tempfile.mkdtemp()
+        return os.path.join(self.workdir, name)
+
+    def cleanup(self):
+        if self.workdir is not None:
+            import shutil
+
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+
+_run = _RunState()
+
+
+def get_context(args, protocols=TURL_PROTOCOLS, timeout=None):
+    """Return the gfal2 context of the current thread asking the SRM for
+    C{protocols} TURLs, created on first use. With C{timeout}, SRM
+    operations and connections time out after that many seconds.
+
+    The X509 credential is loaded again when the proxy file has changed
+    since it was set on the context.
+    """
+    key = (tuple(protocols), timeout)
+    if key not in _run.contexts:
+        ctx = load_gfal2().creat_context()
+        ctx.set_opt_string_list("SRM PLUGIN", "TURL_PROTOCOLS", list(protocols))
+        if timeout:
+            ctx.set_opt_integer("SRM PLUGIN", "OPERATION_TIMEOUT", timeout)
+            ctx.set_opt_integer("SRM PLUGIN", "CONN_TIMEOUT", timeout)
+        # context and mtime of the proxy it uses
+        _run.contexts[key] = [ctx, None]
+    entry = _run.contexts[key]
+    ctx = entry[0]
+    if args.x509:
+        try:
+            mtime = os.stat(args.x509).st_mtime
+        except OSError:
+            mtime = None
+        if entry[1] is None or mtime != entry[1]:
+            cred = ctx.cred_new("X509_CERT", args.x509)
+            ctx.cred_set("srm://", cred)
+            ctx.cred_set("gsiftp://", cred)
+            ctx.cred_set("https://", cred)
+            ctx.cred_set("root://", cred)
+            entry[1] = mtime
+    return ctx
+
+
+class Stopwatch(object):
+    """Time a block with a monotonic clock, C{elapsed} (seconds) is set when
+    the block is left, also by an exception."""
+
+    def __init__(self):
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.monotonic() - self._start
+        return False
+
+
+class Deadline(object):
+    """Time budget of a run: C{budget} seconds from C{start}, a
+    time.monotonic() value (now by default), the last C{reserve} seconds of
+    which are only available once released. Thread-safe."""
+
+    def __init__(self, budget, start=None, reserve=0):
+        self.budget = budget
+        self.end = (time.monotonic() if start is None else start) + budget
+        self.reserve = reserve
+
+    def release(self):
+        "Make the reserved time available"
+        self.reserve = 0
+
+    def remaining(self):
+        return max(0.0, self.end - self.reserve - time.monotonic())
+
+    def timeout(self, limit):
+        """Timeout of an operation: C{limit} seconds, or the whole seconds
+        left if less. gfal2 timeouts are whole seconds, 0 meaning none: the
+        budget is exhausted below one second."""
+        return min(limit, int(self.remaining()))
+
+    def exhausted(self):
+        return self.timeout(1) < 1
+
+
+class PayloadChecksum(object):
+    "Incremental ADLER32 or MD5 checksum, hexdigest() as gfal2 reports it"
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm.upper()
+        if self.algorithm == "ADLER32":
+            self._adler = 1
+        else:
+            import hashlib
+
+            self._md5 = hashlib.md5()
+
+    def update(self, data):
+        if self.algorithm == "ADLER32":
+            self._adler = zlib.adler32(data, self._adler)
+        else:
+            self._md5.update(data)
+
+    def hexdigest(self):
+        if self.algorithm == "ADLER32":
+            return "%08x" % (self._adler & 0xFFFFFFFF)
+        return self._md5.hexdigest()
+
+
+def checksums_match(expected, actual):
+    "Compare hex checksums, storages may drop leading zeros or use upper case"
+    try:
+        return int(expected, 16) == int(actual, 16)
+    except (TypeError, ValueError):
+        return False
+
+
+def payload_block(size=None):
+    """Block the test payload of C{size} bytes is made of: random, or the
+    legacy 20 bytes "1\\n2\\n...0\\n" if C{size} is None."""
+    if size is None:
+        return "".join(s + "\n" for s in "1234567890").encode()
+    return os.urandom(min(size, PAYLOAD_BLOCK_SIZE))
+
+
+def payload_chunks(block, size=None):
+    """Generate the test payload: C{size} bytes of repeated C{block}, so that
+    large payloads are never held in memory, or C{block} once if C{size} is
+    None."""
+    if size is None:
+        yield block
+        return
+    for _ in range(size // len(block)):
+        yield block
+    if size % len(block):
+        yield block[: size % len(block)]
+
+
+def write_payload(path, size=None, checksum=None):
+    """Write the test file of C{size} bytes, see L{payload_chunks}. The data
+    is also fed to the C{checksum} L{PayloadChecksum}, if any."""
+    with open(path, "wb") as fp:
+        for chunk in payload_chunks(payload_block(size), size):
+            fp.write(chunk)
+            if checksum is not None:
+                checksum.update(chunk)
+
+
+def stream_upload(ctx, surl, chunks):
+    "Write C{chunks} to a remote file with gfal2 open()/write()"
+    fd = ctx.open(surl, "w")
+    for chunk in chunks:
+        fd.write(chunk)
+    # gfal2 files have no close(), they are closed once released
+    del fd
+
+
+def stream_compare(ctx, surl, chunks):
+    """Whether a remote file read with gfal2 open()/read() holds exactly
+    C{chunks}, no local copy."""
+    fd = ctx.open(surl, "r")
+    chunks = iter(chunks)
+    expected = b""
+    while True:
+        data = fd.read(PAYLOAD_BLOCK_SIZE)
+        if not data:
+            break
+        while len(expected) < len(data):
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            expected += chunk
+        if data != expected[: len(data)]:
+            return False
+        expected = expected[len(data) :]
+    return not expected and next(chunks, None) is None
+
+
+def stream_checksum(ctx, surl, algorithm):
+    "Checksum of a remote file read with gfal2 open()/read(), no local copy"
+    checksum = PayloadChecksum(algorithm)
+    fd = ctx.open(surl, "r")
+    while True:
+        data = fd.read(PAYLOAD_BLOCK_SIZE)
+        if not data:
+            break
+        checksum.update(data)
+    return checksum.hexdigest()
+
+
+class TransferEvents(object):
+    """gfal2 transfer event_callback recording when the data movement
+    started and ended (gfal2 event timestamps are in milliseconds)."""
+
+    def __init__(self):
+        self.enter = None
+        self.exit = None
+
+    def __call__(self, event):
+        if event.stage == "TRANSFER:ENTER" and self.enter is None:
+            self.enter = event.timestamp
+        elif event.stage == "TRANSFER:EXIT":
+            self.exit = event.timestamp
+
+    def transfer_time(self):
+        "Data movement time in seconds, None without transfer events"
+        if self.enter is None or self.exit is None or self.exit < self.enter:
+            return None
+        return (self.exit - self.enter) / 1000.0
+
+
+def transfer_perf_data(args, operation, events, elapsed):
+    """Perfdata for a transfer that took C{elapsed} seconds: negotiation and
+    data movement times when gfal2 reported transfer events, and throughput
+    in MB/s with --payload-size, unitless as MB/s isn't a nagios unit of
+    measure: the unit is in the label instead.
+
+    @return: list of C{(label, value, uom)} for L{run_per_path}.
+    """
+    perf_data = []
+    moving = events.transfer_time()
+    if moving is not None:
+        negotiation = max(elapsed - moving, 0.0)
+        perf_data.append((operation + "_negotiation", "%.3f" % negotiation, "s"))
+        perf_data.append((operation + "_transfer", "%.3f" % moving, "s"))
+    if args.payload_size:
+        seconds = moving or elapsed
+        if seconds > 0:
+            rate = args.payload_size / seconds / 1e6
+            perf_data.append((operation + "_throughput_MBps", "%.3f" % rate, ""))
+    return perf_data
+
+
+def query_turl(ctx, surl):
+    "Ask for a TURL of C{surl}, return the seconds it took"
+    with Stopwatch() as watch:
+        ctx.getxattr(surl, "user.replicas")
+    return watch.elapsed
+
+
+def turl_matrix(surl, contexts, timeout):
+    """Ask for a TURL of C{surl} for every protocol concurrently, with the
+    C{(protocol, context)} C{contexts}, waiting at most C{timeout} seconds.
+
+    @return: C{(status, summary, elapsed, perf_data)} for L{run_per_path}:
+      OK if all protocols worked, WARNING if some did, CRITICAL if none did.
+      C{elapsed} is the time of the slowest working protocol.
+    """
+    import concurrent.futures
+
+    pool = concurrent.futures.ThreadPoolExecutor(len(contexts))
+    futures = [(p, pool.submit(query_turl, ctx, surl)) for p, ctx in contexts]
+    done, _ = concurrent.futures.wait([f for _, f in futures], timeout)
+    # requests still running are left behind, the context timeouts end them
+    pool.shutdown(wait=False)
+
+    working, failed, perf_data = [], [], []
+    for protocol, future in futures:
+        if future not in done:
+            failed.append("%s [timeout]" % protocol)
+            continue
+        try:
+            elapsed = future.result()
+        except gfal2.GError as e:
+            failed.append("%s [Err:%s]" % (protocol, e.message))
+            continue
+        except Exception as e:
+            failed.append("%s [%s]" % (protocol, e))
+            continue
+        working.append((protocol, elapsed))
+        perf_data.append(("turl_" + protocol, "%.3f" % elapsed, "s"))
+
+    scheme = urlparse(surl).scheme
+    if not working:
+        return (
+            nap.CRITICAL,
+            "protocol FAILED-[%s] %s" % (scheme, ", ".join(failed)),
+            None,
+        )
+    summary = "protocol OK-[%s] TURLs: %s" % (
+        scheme,
+        ", ".join("%s %.3fs" % w for w in working),
+    )
+    if failed:
+        return (
+            nap.WARNING,
+            summary + "; FAILED: " + ", ".join(failed),
+            max(e for _, e in working),
+            perf_data,
+        )
+    return nap.OK, summary, max(e for _, e in working), perf_data
+
+
+def run_deadline(args):
+    """Deadline of the current run: -t seconds from its start, less
+    L{DEADLINE_MARGIN}, and L{DEADLINE_CLEANUP} of it reserved to VODel,
+    rounded up to whole seconds as gfal2 timeouts are."""
+    if _run.deadline is None:
+        import math
+
+        budget = args.timeout - DEADLINE_MARGIN
+        reserve = max(1, math.ceil(budget * DEADLINE_CLEANUP))
+        _run.deadline = Deadline(budget, _run.started, reserve)
+    return _run.deadline
+
+
+def budget_exhausted(args, metric):
+    "Status and summary of C{metric} when it was skipped for lack of time"
+    return nap.UNKNOWN, "%s skipped: time budget exhausted (-t %ds)" % (
+        metric,
+        args.timeout,
+    )
+
+
+def operation_timeout(args, io, metric, limit, *contexts):
+    """Timeout of the storage operations of C{metric}: C{limit} seconds, or
+    what is left of the run's budget if less. It is set as the gfal2 core and
+    SRM timeouts of C{contexts}, transfers take it from L{run_deadline}
+    through params.timeout.
+
+    While the circuit of the storage element is open (see L{load_circuit})
+    the timeout is --breaker-timeout until an operation works, and once one
+    timed out the metric fails right away.
+
+    @return: the timeout, or None if the metric must not run (C{io} is set
+      accordingly).
+    """
+    circuit = load_circuit(args)
+    if circuit_open(args, circuit) and not _run.reachable:
+        if _run.timed_out:
+            io.set_status(
+                nap.CRITICAL,
+                "%s skipped: circuit open after %d runs with timeouts since %s, "
+                "last error: %s"
+                % (
+                    metric,
+                    circuit["timeouts"],
+                    time.strftime(
+                        "%Y-%m-%d %H:%M:%S", time.localtime(circuit["since"])
+                    ),
+                    circuit["error"],
+                ),
+            )
+            return None
+        limit = min(limit, args.breaker_timeout)
+    timeout = run_deadline(args).timeout(limit)
+    if timeout < 1:
+        io.set_status(*budget_exhausted(args, metric))
+        return None
+    _run.timeout = timeout
+    for ctx in contexts:
+        ctx.set_opt_integer("CORE", "NAMESPACE_TIMEOUT", timeout)
+        ctx.set_opt_integer("SRM PLUGIN", "OPERATION_TIMEOUT", timeout)
+        ctx.set_opt_integer("SRM PLUGIN", "CONN_TIMEOUT", timeout)
+    return timeout
+
+
+def timed_out(status, summary, elapsed, timeout):
+    "Whether a storage operation failed by timing out"
+    if status != nap.CRITICAL or elapsed is None:
+        return False
+    if timeout and elapsed >= 0.9 * timeout:
+        return True
+    return "timed out" in summary.lower() or "timeout" in summary.lower()
+
+
+def load_circuit(args):
+    """Circuit breaker state of the -H host, read once per run.
+
+    The circuit opens after --breaker-threshold consecutive runs in which
+    storage operations timed out and none worked, and closes again after a
+    run in which one worked. See L{update_circuit}.
+
+    @return: C{{'timeouts': consecutive runs with timeouts, 'since': time of
+      the first one, 'error': the last timeout}}.
+    """
+    if _run.circuit is None:
+        _run.circuit = {"timeouts": 0}
+        if args.breaker_threshold > 0:
+            cache = gridutils.FileCache(args.cache_dir, "circuit")
+            _, circuit = cache.load(args.hostname)
+            if isinstance(circuit, dict) and circuit.get("timeouts"):
+                _run.circuit = circuit
+    return _run.circuit
 
-# Instantiate gfal2
-ctx = gfal2.creat_context()
 
-# GFAL version
-gfal2_ver = "gfal2 " + gfal2.get_version()
+def circuit_open(args, circuit):
+    return 0 < args.breaker_threshold <= circuit["timeouts"]
+
+
+def update_circuit(args):
+    "Record the outcome of this run in the circuit breaker state"
+    if args.breaker_threshold <= 0:
+        return
+    circuit = load_circuit(args)
+    if _run.reachable:
+        if not circuit["timeouts"]:
+            return
+        if circuit_open(args, circuit):
+            nap.core.log.info("Circuit of %s closed" % args.hostname)
+        circuit = {"timeouts": 0}
+    elif _run.timed_out:
+        circuit = {
+            "timeouts": circuit["timeouts"] + 1,
+            "since": circuit.get("since") or time.time(),
+            "error": _run.timed_out,
+        }
+        if (
+            circuit_open(args, circuit)
+            and circuit["timeouts"] == args.breaker_threshold
+        ):
+            nap.core.log.info("Circuit of %s opened" % args.hostname)
+    else:
+        return
+    gridutils.FileCache(args.cache_dir, "circuit").store(args.hostname, circuit)
+
+
+def latency_thresholds(args, label):
+    """WARNING and CRITICAL thresholds (seconds, None if unset) of the
+    operation timed as C{label}, and the baseline C{(n, mean, mad)} they were
+    derived from if any.
+
+    With --adaptive they are the baseline mean plus --adaptive-warning and
+    --adaptive-critical times its mean absolute deviation, or -w/-c if these
+    are lower.
+    """
+    warning, critical = args.warning, args.critical
+    baseline = args.adaptive and load_baselines(args).get(label)
+    if not baseline or baseline[0] < ADAPTIVE_MIN_SAMPLES:
+        return warning, critical, None
+    _, mean, mad = baseline
+    spread = max(mad, ADAPTIVE_MIN_SPREAD * mean, ADAPTIVE_MIN_SPREAD_SECONDS)
+    warning = min(
+        t for t in (warning, mean + args.adaptive_warning * spread) if t is not None
+    )
+    critical = min(
+        t for t in (critical, mean + args.adaptive_critical * spread) if t is not None
+    )
+    return warning, critical, baseline
+
+
+def latency_status(elapsed, warning, critical):
+    "Status for an operation that took C{elapsed} seconds"
+    if critical is not None and elapsed >= critical:
+        return nap.CRITICAL
+    if warning is not None and elapsed >= warning:
+        return nap.WARNING
+    return nap.OK
+
+
+def threshold(value):
+    "Perfdata threshold field for an optional threshold"
+    return "" if value is None else "%.3f" % value
+
+
+def worst_status(statuses):
+    "Worst of the given nagios statuses, UNKNOWN for anything unexpected"
+    severity = [
+        STATUS_SEVERITY.index(st if st in STATUS_SEVERITY else nap.UNKNOWN)
+        for st in statuses
+    ]
+    return STATUS_SEVERITY[max(severity)]
+
+
+def succeeded_paths(operation):
+    """The numbers and the storage paths (items of L{run_per_path}) the
+    storage C{operation} worked on, possibly with a warning, regardless of
+    its latency: later metrics depend on what it did, not on how fast it
+    was."""
+    succeeded = _run.succeeded.get(operation, [])
+    return [n for n, _ in succeeded], [item for _, item in succeeded]
+
+
+def run_per_path(args, io, check, items, operation, numbers=None):
+    """Run C{check(item)} for every storage path item, C{args.path_workers}
+    of them concurrently, and set the worst of their results on C{io}.
+    C{numbers} are the numbers of the storage paths of the items, 1 to
+    C{len(items)} by default.
+
+    C{check} returns C{(status, summary, elapsed)}, C{elapsed} being the
+    seconds the gfal2 C{operation} took (None if it wasn't called), and runs
+    in a pool thread: it must not use the per-thread run state (C{_run},
+    L{get_context}). A fourth item, if any, is a list of additional
+    C{(label, value, uom)} perfdata.
+
+    Every timing is added as perfdata, labelled C{operation} (suffixed with
+    the path number if the SE has several paths, as are additional perfdata),
+    and turns a successful path into WARNING/CRITICAL when it crosses the
+    thresholds of L{latency_thresholds}. The baseline they come from, if any,
+    is added as C{<label>_baseline} perfdata.
+
+    With several paths the summary is the one of the worst path(s), followed
+    by how many paths were OK. Paths not checked yet when the run's deadline
+    is reached are UNKNOWN.
+    """
+    deadline = run_deadline(args)
+    skipped = budget_exhausted(args, operation)
+
+    def check_in_time(item):
+        if deadline.exhausted():
+            return skipped + (None,)
+        return check(item)
+
+    if len(items) == 1 or args.path_workers <= 1:
+        outcomes = [check_in_time(item) for item in items]
+    else:
+        import concurrent.futures
+
+        workers = min(args.path_workers, len(items))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            outcomes = list(pool.map(check_in_time, items))
+
+    extra_perf_data = [len(o) > 3 and o[3] or () for o in outcomes]
+    outcomes = [tuple(o[:3]) for o in outcomes]
+    for st, summary, elapsed in outcomes:
+        if st in (nap.OK, nap.WARNING):
+            _run.reachable = True
+        elif not _run.timed_out and timed_out(st, summary, elapsed, _run.timeout):
+            _run.timed_out = summary
+    _run.operations[operation] = worst_status([st for st, _, _ in outcomes])
+    if numbers is None:
+        numbers = list(range(1, len(items) + 1))
+    _run.succeeded[operation] = [
+        (number, item)
+        for number, item, (st, _, _) in zip(numbers, items, outcomes)
+        if st in (nap.OK, nap.WARNING)
+    ]
+    several = len(outcomes) > 1 or len(_run.voInfoDictionary) > 1
+    for n, (st, summary, elapsed) in enumerate(outcomes):
+        suffix = "_%d" % numbers[n] if several else ""
+        for label, value, uom in extra_perf_data[n]:
+            io.add_perf_data(label + suffix, value, uom, vmin=0)
+        if elapsed is None:
+            continue
+        label = operation + suffix
+        _run.timings[label] = elapsed
+        if st in (nap.OK, nap.WARNING):
+            # failures time out or fail fast, they would skew the baseline
+            _run.samples[label] = elapsed
+        warning, critical, baseline = latency_thresholds(args, label)
+        io.add_perf_data(
+            label, "%.3f" % elapsed, "s", threshold(warning), threshold(critical), 0
+        )
+        if baseline:
+            io.add_perf_data(label + "_baseline", "%.3f" % baseline[1], "s", vmin=0)
+        slow = latency_status(elapsed, warning, critical)
+        if st == nap.OK and slow != nap.OK:
+            summary += " [%s took %.3fs" % (operation, elapsed)
+            if baseline:
+                summary += ", baseline %.3fs +/- %.3fs" % baseline[1:]
+            summary += "]"
+            outcomes[n] = (slow, summary, elapsed)
+
+    status = worst_status([st for st, _, _ in outcomes])
+    summaries = []
+    for st, summary, _ in outcomes:
+        if st == status and summary not in summaries:
+            summaries.append(summary)
+    summary = " ".join(summaries)
+    if len(outcomes) > 1:
+        summary += " (%d of %d storage paths OK)" % (
+            len([st for st, _, _ in outcomes if st == nap.OK]),
+            len(outcomes),
+        )
+    io.set_status(status, summary)
 
 
 def parse_args(args, io):
@@ -89,78 +1057,316 @@ def parse_args(args, io):
         io.set_status(nap.CRITICAL, errstr)
         return 1
     os.environ["LCG_GFAL_INFOSYS"] = args.ldap_url
+    configure_gridutils(args)
+
+
+def configure_gridutils(args):
+    "Set the gridutils caches, lookups and BDII queries from the command line"
+    gridutils.LDAP_HEALTH_CACHE_DIR = args.cache_dir
+    gridutils.DNS_CACHE_DIR = args.cache_dir
+    gridutils.DNS_CACHE_TTL = args.dns_cache_ttl
+    gridutils.LDAP_SIZELIMIT = args.bdii_sizelimit
+    gridutils.LDAP_PAGE_SIZE = args.bdii_page_size
+    # IP addresses in messages are only resolved to hostnames when debugging
+    gridutils.DNS_REVERSE_LOOKUPS = args.debug
+
+
+def query_bdii(
+    ldap_filter, ldap_attrlist, ldap_url="", ldap_client=None, ldap_base="o=grid"
+):
+    """Local wrapper for gridutils.query_bdii(), the queries of a run are
+    timed and answers truncated at the size limit noted"""
+    with Stopwatch() as watch:
+        rc, qres = gridutils.query_bdii(
+            ldap_filter,
+            ldap_attrlist,
+            ldap_url=ldap_url,
+            ldap_base=ldap_base,
+            ldap_timelimit=LCG_GFAL_BDII_TIMEOUT,
+            ldap_client=ldap_client,
+        )
+    _run.timings["bdii_query"] = _run.timings.get("bdii_query", 0) + watch.elapsed
+    if rc == 2:
+        _run.bdii_truncated = True
 
-    if args.x509:
-        cred = ctx.cred_new("X509_CERT", args.x509)
-        ctx.cred_set("srm://", cred)
-        ctx.cred_set("gsiftp://", cred)
-        ctx.cred_set("https://", cred)
-        ctx.cred_set("root://", cred)
-        # gfal2.cred_set(ctx,"srm://",cred)
-        # gfal2.cred_set(ctx,"gsiftp://",cred)
-        # gfal2.cred_set(ctx,"https://",cred)
-        # gfal2.cred_set(ctx,"root://",cred)
-    ctx.set_opt_string_list(
-        "SRM PLUGIN",
-        "TURL_PROTOCOLS",
-        ["gsiftp", "https", "root", "rfio", "gsidcap", "dcap", "kdcap"],
-    )
+    return rc, qres
+
+
+def query_bdii_cached(args, ldap_filter, ldap_attrlist, key=None, ldap_base="o=grid"):
+    """Query the BDII through the on-disk cache.
+
+    Fresh cached answers are returned without contacting the BDII, stale ones
+    only if the BDII could not be queried. The answer is cached under C{key},
+    by default (hostname, voname, srmv, ldap_url), which must tell apart
+    queries under different C{ldap_base}, unless it was truncated at the size
+    limit (rc 2).
+
+    @return: C{(rc, qres, cache_status)}, C{cache_status} being one of
+      'hit', 'miss', 'stale' or 'off'.
+    @rtype: L{tuple}
+    """
+    if args.bdii_cache_ttl <= 0:
+        rc, qres = query_bdii(
+            ldap_filter, ldap_attrlist, args.ldap_url, args.ldap_client, ldap_base
+        )
+        return rc, qres, "off"
 
+    cache = gridutils.FileCache(args.cache_dir, "bdii")
+    key = key or (args.hostname, args.voname, args.srmv, args.ldap_url)
+    timestamp, entries = cache.load(key)
+    age = time.time() - timestamp if timestamp else 0
+    if entries and 0 <= age < args.bdii_cache_ttl:
+        return 1, entries, "hit"
 
-def query_bdii(ldap_filter, ldap_attrlist, ldap_url=""):
-    "Local wrapper for gridutils.query_bdii()"
-    rc, qres = gridutils.query_bdii(
-        ldap_filter,
-        ldap_attrlist,
-        ldap_url=ldap_url,
-        ldap_timelimit=LCG_GFAL_BDII_TIMEOUT,
+    rc, qres = query_bdii(
+        ldap_filter, ldap_attrlist, args.ldap_url, args.ldap_client, ldap_base
     )
+    if rc == 1:
+        cache.store(key, qres)
+    if rc:
+        return rc, qres, "miss"
+    # fall back to a stale answer only if the BDII could not be queried
+    bdii_failed = qres[0] != gridutils.LDAP_QE_EMPTYSET
+    if entries and bdii_failed and age < BDII_CACHE_MAX_STALE:
+        return 1, entries, "stale"
+    return rc, qres, "miss"
+
+
+def _collect_bdii_attributes(entries, res=None, attrs=BDII_SURL_ATTRS):
+    """Merge values of C{attrs} found in BDII C{entries} into C{res}
+    ({attribute: [unique values]})."""
+    if res is None:
+        res = dict((k, []) for k in attrs)
+    for entry in entries:
+        for attr in res.keys():
+            try:
+                for val in entry[1][attr]:
+                    if val not in res[attr]:
+                        res[attr].append(val)
+            except KeyError:
+                pass
+    return res
 
-    return rc, qres
 
+def _collect_glue2_attributes(entries, index=None):
+    """Join the GLUE 2 SRM endpoints, storage shares and VO mapping policies
+    found in BDII C{entries} by storage service, and merge the values of
+    L{BDII_GLUE2_SURL_ATTRS} of every storage element into C{index}
+    ({hostname: {attribute: [unique values]}}).
 
-def getSURLFromBDII(args, io):
-    ldap_f = (
-        "(|(&(GlueChunkKey=GlueSEUniqueID=%s)(|(GlueSAAccessControlBaseRule=%s)(GlueSAAccessControlBaseRule=VO:%s)))"
-        + "(&(GlueChunkKey=GlueSEUniqueID=%s)(|(GlueVOInfoAccessControlBaseRule=%s)(GlueVOInfoAccessControlBaseRule=VO:%s)))"
-        + "(&(GlueServiceUniqueID=*://%s*)(GlueServiceVersion=%s.*)(GlueServiceType=srm*)))"
+    Only the storage shares a mapping policy in C{entries} refers to are
+    kept, so the policies must be the ones of the VO.
+    """
+    if index is None:
+        index = {}
+    endpoints = []
+    shares = []
+    mapped = set()
+    for _, attrs in entries:
+        if "GLUE2EndpointURL" in attrs:
+            endpoints.append(attrs)
+        elif "GLUE2MappingPolicyShareForeignKey" in attrs:
+            mapped.update(attrs["GLUE2MappingPolicyShareForeignKey"])
+        elif "GLUE2StorageSharePath" in attrs:
+            shares.append(attrs)
+    paths = {}
+    for attrs in shares:
+        if mapped.intersection(attrs.get("GLUE2ShareID", [])):
+            for service in attrs.get("GLUE2ShareServiceForeignKey", []):
+                paths.setdefault(service, []).extend(attrs["GLUE2StorageSharePath"])
+    for attrs in endpoints:
+        service_paths = []
+        for service in attrs.get("GLUE2EndpointServiceForeignKey", []):
+            service_paths.extend(paths.get(service, []))
+        for url in attrs["GLUE2EndpointURL"]:
+            host = gridutils.parse_uri(url)[0].lower()
+            entry = (
+                None,
+                {"GLUE2EndpointURL": [url], "GLUE2StorageSharePath": service_paths},
+            )
+            index[host] = _collect_bdii_attributes(
+                [entry], index.get(host), BDII_GLUE2_SURL_ATTRS
+            )
+    return index
+
+
+def _parent_dn(dn):
+    "DN of the parent entry of C{dn}"
+    return re.split(r"(?<!\\),", dn, 1)[-1].strip()
+
+
+def prefetch_bdii(args):
+    """Query the BDII once for the SRM endpoints and storage paths of all
+    storage elements supporting the VO, in GLUE 2 with --glue 2 and in GLUE
+    1.3 otherwise.
+
+    @return: index of the answer, C{{hostname: {attribute: [values]}}}, or
+      None if the BDII could not be queried or the answer was truncated at
+      the size limit: it may lack storage elements, or some of their entries.
+    """
+    if args.glue == "2":
+        ldap_filter = (
+            "(|(&(objectClass=GLUE2Endpoint)(GLUE2EndpointInterfaceName=SRM)"
+            "(GLUE2EndpointInterfaceVersion=%s.*))"
+            "(&(objectClass=GLUE2MappingPolicy)"
+            "(|(GLUE2PolicyRule=VO:%s)(GLUE2PolicyRule=%s)))"
+            "(objectClass=GLUE2StorageShare))" % (svcVer, args.voname, args.voname)
+        )
+        key = ("*", args.voname, args.srmv, args.ldap_url, "glue2")
+        rc, qres, _ = query_bdii_cached(
+            args,
+            ldap_filter,
+            BDII_GLUE2_ENDPOINT_ATTRS + BDII_GLUE2_SHARE_ATTRS,
+            key,
+            BDII_GLUE2_BASE,
+        )
+        if rc != 1:
+            return None
+        return _collect_glue2_attributes(qres)
+
+    ldap_filter = glue13_filter(args.voname)
+    ldap_attrlist = BDII_SURL_ATTRS + ["GlueChunkKey"]
+    key = ("*", args.voname, args.srmv, args.ldap_url)
+
+    rc, qres, _ = query_bdii_cached(args, ldap_filter, ldap_attrlist, key)
+    if rc != 1:
+        return None
+
+    index = {}
+    for entry in qres:
+        hosts = set()
+        for endpoint in entry[1].get("GlueServiceEndpoint", []):
+            hosts.add(gridutils.parse_uri(endpoint)[0].lower())
+        for chunk_key in entry[1].get("GlueChunkKey", []):
+            if chunk_key.startswith("GlueSEUniqueID="):
+                hosts.add(chunk_key.split("=", 1)[1].lower())
+        for host in hosts:
+            index[host] = _collect_bdii_attributes([entry], index.get(host))
+    return index
+
+
+def glue13_filter(voname, host="*"):
+    "GLUE 1.3 filter of the storage element C{host}, all of them for '*'"
+    return BDII_GLUE13_FILTER % {
+        "host": host,
+        "vo": voname,
+        "service": host == "*" and "*" or "*://%s*" % host,
+        "version": svcVer,
+    }
+
+
+def query_glue13(args):
+    """Query the GLUE 1.3 SRM endpoint and storage paths of the storage
+    element for the VO.
+
+    @return: C{(rc, res, cache_status)}, C{res} being C{{attribute: [values]}}
+      or the query error, see L{query_bdii_cached}.
+    @rtype: L{tuple}
+    """
+    ldap_filter = glue13_filter(args.voname, args.hostname)
+    ldap_attrlist = BDII_SURL_ATTRS
+
+    rc, qres, cache_status = query_bdii_cached(args, ldap_filter, ldap_attrlist)
+    if rc:
+        qres = _collect_bdii_attributes(qres)
+    return rc, qres, cache_status
+
+
+def query_glue2(args):
+    """GLUE 2 counterpart of L{query_glue13}.
+
+    The SRM endpoints of the storage element are looked up under o=glue
+    first, then the storage shares and the mapping policies of the VO only
+    under the entry of the storage service of every endpoint, with the
+    attributes needed to join them.
+    """
+    key = (args.hostname, args.voname, args.srmv, args.ldap_url, "glue2")
+    ldap_filter = (
+        "(&(objectClass=GLUE2Endpoint)(GLUE2EndpointInterfaceName=SRM)"
+        "(GLUE2EndpointInterfaceVersion=%s.*)(GLUE2EndpointURL=*://%s*))"
+        % (svcVer, args.hostname)
     )
-    ldap_filter = ldap_f % (
-        args.hostname,
-        args.voname,
-        args.voname,
-        args.hostname,
-        args.voname,
-        args.voname,
-        args.hostname,
-        svcVer,
+    rc, endpoints, cache_status = query_bdii_cached(
+        args, ldap_filter, BDII_GLUE2_ENDPOINT_ATTRS, key, BDII_GLUE2_BASE
     )
-    ldap_attrlist = ["GlueServiceEndpoint", "GlueSAPath", "GlueVOInfoPath"]
+    if not rc:
+        return rc, endpoints, cache_status
+
+    entries = list(endpoints)
+    ldap_filter = (
+        "(|(objectClass=GLUE2StorageShare)(&(objectClass=GLUE2MappingPolicy)"
+        "(|(GLUE2PolicyRule=VO:%s)(GLUE2PolicyRule=%s))))" % (args.voname, args.voname)
+    )
+    for service in sorted(set(_parent_dn(dn) for dn, _ in endpoints)):
+        rc, shares, status = query_bdii_cached(
+            args, ldap_filter, BDII_GLUE2_SHARE_ATTRS, key + (service,), service
+        )
+        if rc:
+            entries.extend(shares)
+        elif shares[0] != gridutils.LDAP_QE_EMPTYSET:
+            return rc, shares, status
+        if cache_status == "hit":
+            cache_status = status
 
-    rc, qres = query_bdii(ldap_filter, ldap_attrlist, args.ldap_url)
+    res = _collect_glue2_attributes(entries).get(args.hostname.lower())
+    if res is None:
+        res = dict((k, []) for k in BDII_GLUE2_SURL_ATTRS)
+    return 1, res, cache_status
+
+
+def getSURLFromBDII(args, io):
+    host = args.hostname.lower()
+    if _bdiiIndex is not None and (host in _bdiiIndex or args.glue != "auto"):
+        # storage elements of the VO were prefetched in batch mode
+        attrs = args.glue == "2" and BDII_GLUE2_SURL_ATTRS or BDII_SURL_ATTRS
+        res = _collect_bdii_attributes([], _bdiiIndex.get(host), attrs)
+        _run.glue = "GLUE2EndpointURL" in res and "2" or "1"
+        return _surls_from_bdii_attributes(args, io, res), "prefetch"
+
+    schemas = [args.glue]
+    if args.glue == "auto":
+        # the schema which worked last time for the storage element first
+        glue_cache = gridutils.FileCache(args.cache_dir, "glue")
+        _, remembered = glue_cache.load(host)
+        if _bdiiIndex is not None:
+            # not found in the GLUE 1.3 prefetch
+            schemas = ["2"]
+        else:
+            schemas = remembered == "2" and ["2", "1"] or ["1", "2"]
+    for schema in schemas:
+        query = schema == "2" and query_glue2 or query_glue13
+        rc, res, cache_status = query(args)
+        if rc or res[0] != gridutils.LDAP_QE_EMPTYSET:
+            break
     if not rc:
-        if qres[0] == 0:  # empty set
+        if res[0] == 0:  # empty set
             io.status = nap.CRITICAL
         else:  # all other problems
             io.status = nap.UNKNOWN
         io.summary = "Error querying the BDII"
-        return []
+        return [], cache_status
 
-    res = {}
-    for k in ldap_attrlist:
-        res[k] = []
+    if args.glue == "auto" and schema != remembered:
+        glue_cache.store(host, schema)
+    _run.glue = schema
+    return _surls_from_bdii_attributes(args, io, res), cache_status
 
-    for entry in qres:
-        for attr in res.keys():
-            try:
-                for val in entry[1][attr]:
-                    if val not in res[attr]:
-                        res[attr].append(val)
-            except KeyError:
-                pass
 
-    # GlueServiceEndpoint is not published
-    k = "GlueServiceEndpoint"
+def _surls_from_bdii_attributes(args, io, res):
+    """Build the SURLs to test from the BDII attributes of a storage element,
+    L{BDII_SURL_ATTRS} or L{BDII_GLUE2_SURL_ATTRS}.
+
+    @return: list of SURLs, empty if the published information is not usable
+      (io status is set accordingly).
+    """
+    if "GLUE2EndpointURL" in res:
+        k = "GLUE2EndpointURL"
+        path_attrs = ["GLUE2StorageSharePath"]
+    else:
+        k = "GlueServiceEndpoint"
+        path_attrs = ["GlueVOInfoPath", "GlueSAPath"]
+
+    # the endpoint is not published
     if not res[k]:
         io.set_status(
             nap.CRITICAL,
@@ -183,18 +1389,16 @@ def getSURLFromBDII(args, io):
     else:
         endpoint = res[k][0]
 
-    if res["GlueVOInfoPath"]:
-        storpaths = res["GlueVOInfoPath"]
-
-    elif res["GlueSAPath"]:
-        storpaths = res["GlueSAPath"]
-
+    for attr in path_attrs:
+        if res[attr]:
+            storpaths = res[attr]
+            break
     else:
-        # GlueSAPath or GlueVOInfoPath is not published
+        # no storage path is published
         io.set_status(
             nap.CRITICAL,
-            "GlueVOInfoPath or GlueSAPath not published for %s in %s"
-            % (res["GlueServiceEndpoint"][0], args.ldap_url),
+            "%s not published for %s in %s"
+            % (" or ".join(path_attrs), endpoint, args.ldap_url),
         )
         return []
 
@@ -211,33 +1415,69 @@ def getSURLs(args, io):
     if parse_args(args, io):
         return
     eps = []
+    cache_status = None
     if args.endpoint is None:
-        eps = getSURLFromBDII(args, io)
+        eps, cache_status = getSURLFromBDII(args, io)
     else:
         eps.append(args.endpoint)
+    truncated = " [BDII answer truncated at the size limit]"
     if len(eps) == 0:
+        if _run.bdii_truncated:
+            io.summary += truncated
         return
     for ep in eps:
-        _voInfoDictionary[ep] = {}
+        _run.voInfoDictionary[ep] = {}
     io.summary = "SURLs successfully retrieved"
+    if _run.glue == "2":
+        io.summary += " from GLUE 2"
+    if cache_status:
+        io.summary += " (BDII cache: %s)" % cache_status
     io.status = nap.OK
+    if _run.bdii_truncated:
+        # storage paths may be missing, the ones found are still tested
+        io.summary += truncated
+    if "bdii_query" in _run.timings:
+        io.add_perf_data("bdii_query", "%.3f" % _run.timings["bdii_query"], "s", vmin=0)
+
+
+def read_directory(ctx, surl, limit):
+    """Read up to C{limit} entries (all of them if C{limit} is 0) of the
+    directory C{surl} with gfal2 opendir()/read(), which lists it in
+    chunks, so that the cost doesn't depend on the size of the directory.
+
+    @return: C{(entries, seconds to the first entry)}, the latter None if the
+      directory is empty.
+    @rtype: L{tuple}
+    """
+    start = time.monotonic()
+    first = None
+    entries = 0
+    directory = ctx.opendir(surl)
+    while limit <= 0 or entries < limit:
+        if directory.read() is None:
+            break
+        if first is None:
+            first = time.monotonic() - start
+        entries += 1
+    return entries, first
 
 
 @app.metric(seq=2, metric_name="VOLsDir", passive=True)
 def metricVOLsDir(args, io):
     """
-    List content of VO's top level space area(s) in SRM using gfal2.listdir().
+    List content of VO's top level space area(s) in SRM using gfal2.listdir(),
+    or read its first entries with gfal2.opendir()/read(), or stat it.
     """
 
     # verify previous test succeeded
-    results = app.metric_results()
+    results = _run.results
     if results[0][1] != nap.OK:
         io.set_status(nap.WARNING, "VOLsDir skipped")
         return
 
     srms = []
     try:
-        for srm in _voInfoDictionary.keys():
+        for srm in _run.voInfoDictionary.keys():
             srms.append(srm)
         if not srms:
             io.set_status(nap.WARNING, "No SRM endpoints found to test")
@@ -246,282 +1486,452 @@ def metricVOLsDir(args, io):
         io.set_status("UNKNOWN", "Error reading SRM to test")
         return
 
-    for surl in srms:
+    ctx = get_context(args)
+    if operation_timeout(args, io, "VOLsDir", args.se_timeout, ctx) is None:
+        return
+
+    # timing label and gfal2 call of every mode
+    operation, call = {
+        "listdir": ("listdir", "listdir"),
+        "stream": ("readdir", "opendir/read"),
+        "stat": ("statdir", "stat"),
+    }[args.lsdir_mode]
+
+    def listdir(surl):
+        watch = Stopwatch()
+        perf_data = []
         try:
-            ctx.listdir(str(surl))
-            io.summary = "Storage Path[%s] Directory successfully listed" % str(surl)
-            io.status = nap.OK
+            with watch:
+                if args.lsdir_mode == "stat":
+                    ctx.stat(str(surl))
+                elif args.lsdir_mode == "stream":
+                    entries, first = read_directory(ctx, str(surl), args.lsdir_limit)
+                else:
+                    ctx.listdir(str(surl))
+            if args.lsdir_mode == "stat":
+                message = "Directory successfully stat'ed"
+            elif args.lsdir_mode == "stream":
+                message = "%d directory entries successfully read" % entries
+                perf_data.append((operation + "_entries", entries, ""))
+                if first is not None:
+                    perf_data.append((operation + "_first", "%.3f" % first, "s"))
+                if watch.elapsed > 0:
+                    rate = entries / watch.elapsed
+                    perf_data.append((operation + "_rate", "%.1f" % rate, ""))
+            else:
+                message = "Directory successfully listed"
+            return (
+                nap.OK,
+                "Storage Path[%s] %s" % (str(surl), message),
+                watch.elapsed,
+                perf_data,
+            )
         except gfal2.GError as e:
             er = e.message
             if er:
                 # SRM_TOO_MANY_RESULTS is handled as an error in gfal2, we don't want to report it as Critical here
                 if "SRM_TOO_MANY_RESULTS" in er:
-                    io.summary = "[WARN:%s];" % str(er)
-                    io.status = nap.WARNING
-                else:
-                    io.status = nap.CRITICAL
-                    io.summary = "[Err:%s];" % str(er)
-            else:
-                io.status = nap.CRITICAL
-                io.summary = "Error"
+                    return nap.WARNING, "[WARN:%s];" % str(er), watch.elapsed
+                return nap.CRITICAL, "[Err:%s];" % str(er), watch.elapsed
+            return nap.CRITICAL, "Error", watch.elapsed
         except Exception as e:
-            io.set_status(
+            return (
                 nap.CRITICAL,
-                "problem invoking gfal2 listdir(): %s:%s" % (str(e), sys.exc_info()[0]),
+                "problem invoking gfal2 %s(): %s:%s"
+                % (call, str(e), sys.exc_info()[0]),
+                watch.elapsed,
             )
 
+    run_per_path(args, io, listdir, srms, operation)
+
 
 @app.metric(seq=3, metric_name="VOPut", passive=True)
 def metricVOPut(args, io):
-    """Copy a local file to the SRM into space area(s) defined by VO."""
+    """Copy the test file to the SRM into space area(s) defined by VO, from a
+    local file or streamed from memory (--payload-io)."""
+    import datetime
 
     # verify VOGetSurls test succeeded
-    results = app.metric_results()
+    results = _run.results
     if results[0][1] != nap.OK:
         io.set_status(nap.WARNING, "VOLsDir skipped")
         return
 
-    if len(_voInfoDictionary.keys()) == 0:
+    if len(_run.voInfoDictionary.keys()) == 0:
         io.set_status(nap.WARNING, "No SRM endpoints found to test")
         return
 
     # multiple 'SAPath's are possible
     dest_files = []
-    # generate source file
+    in_memory = args.payload_io == "memory"
+    # generate source file, or only its block if it's streamed from memory
     try:
-        src_file = _fileTest
-        fp = open(src_file, "w")
-        for s in "1234567890":
-            fp.write(s + "\n")
-        fp.close()
+        checksum = None
+        if "checksum" in args.verify or "stream" in args.verify:
+            checksum = PayloadChecksum(args.checksum_type)
+        if in_memory:
+            src_file = None
+            _run.payload_block = payload_block(args.payload_size)
+            if checksum is not None:
+                for chunk in payload_chunks(_run.payload_block, args.payload_size):
+                    checksum.update(chunk)
+        else:
+            src_file = _run.workfile(_fileTest)
+            write_payload(src_file, args.payload_size, checksum)
+        _run.payload_checksum = checksum and checksum.hexdigest()
 
         fn = _fileSRMPattern % (str(int(time.time())), gridutils.uuidstr())
-        for srmendpt in _voInfoDictionary.keys():
+        for srmendpt in _run.voInfoDictionary.keys():
             dest_files.append(srmendpt + "/" + fn)
-            _voInfoDictionary[srmendpt]["fn"] = fn
+            _run.voInfoDictionary[srmendpt]["fn"] = fn
         if not dest_files:
             io.set_status(nap.CRITICAL, "No SRM endpoints found to test")
             return
     except IOError as e:
         io.set_status(nap.CRITICAL, "Error creating source file")
+        return
+
+    ctx = get_context(args)
+    timeout = operation_timeout(args, io, "VOPut", args.se_timeout, ctx)
+    if timeout is None:
+        return
+    deadline = run_deadline(args)
+    block = _run.payload_block
 
-    for dest_file in dest_files:
+    def put(dest_file):
         # Set transfer parameters
         params = ctx.transfer_parameters()
         params.create_parent = True
-        params.timeout = args.se_timeout
-        start_transfer = datetime.datetime.now()
+        params.timeout = deadline.timeout(timeout)
+        params.event_callback = events = TransferEvents()
+        watch = Stopwatch()
 
         stMsg = "File was%s copied to SRM."
+        call = "filecopy"
 
         try:
-            ctx.filecopy(params, "file://" + str(src_file), str(dest_file))
-            total_transfer = datetime.datetime.now() - start_transfer
-            io.summary = stMsg % "" + " Transfer time: " + str(total_transfer)
-            io.status = nap.OK
+            if in_memory:
+                stMsg, call = "File was%s written to SRM.", "open/write"
+                chunks = payload_chunks(block, args.payload_size)
+                with watch:
+                    stream_upload(ctx, str(dest_file), chunks)
+            else:
+                with watch:
+                    ctx.filecopy(params, "file://" + str(src_file), str(dest_file))
+            total_transfer = datetime.timedelta(seconds=watch.elapsed)
+            return (
+                nap.OK,
+                stMsg % "" + " Transfer time: " + str(total_transfer),
+                watch.elapsed,
+                transfer_perf_data(args, "put", events, watch.elapsed),
+            )
         except gfal2.GError as e:
-            io.status = nap.CRITICAL
             er = e.message
             if er:
-                io.summary = stMsg % (" NOT") + " [Err:%s]" % str(er)
-            else:
-                io.summary = stMsg % " NOT"
+                return (
+                    nap.CRITICAL,
+                    stMsg % (" NOT") + " [Err:%s]" % str(er),
+                    watch.elapsed,
+                )
+            return nap.CRITICAL, stMsg % " NOT", watch.elapsed
         except Exception as e:
-            io.set_status(
+            return (
                 nap.CRITICAL,
-                "problem invoking gfal2 filecopy(): %s:%s"
-                % (str(e), sys.exc_info()[0]),
+                "problem invoking gfal2 %s(): %s:%s"
+                % (call, str(e), sys.exc_info()[0]),
+                watch.elapsed,
             )
 
+    run_per_path(args, io, put, dest_files, "put")
+
 
 @app.metric(seq=4, metric_name="VOLs", passive=True)
 def metricVOLs(args, io):
     """Stat (previously copied) file(s) on the SRM."""
 
-    # verify previous test succeeded
-    results = app.metric_results()
-    if results[2][1] != nap.OK:
+    # only the files which were copied
+    numbers, srms = succeeded_paths("put")
+    if not srms:
         io.set_status(nap.WARNING, "VOLs skipped")
         return
 
-    if len(_voInfoDictionary.keys()) == 0:
-        io.set_status(nap.WARNING, "No SRM endpoints found to test")
+    ctx = get_context(args)
+    if operation_timeout(args, io, "VOLs", args.se_timeout, ctx) is None:
         return
 
-    srms = []
-
-    for srmendpt in _voInfoDictionary.keys():
-        dest_filename = (_voInfoDictionary[srmendpt])["fn"]
-        dest_file = srmendpt + "/" + dest_filename
-        srms.append(dest_file)
-
-    for surl in srms:
+    def stat(surl):
+        watch = Stopwatch()
         try:
-            statp = ctx.stat(str(surl))
+            with watch:
+                statp = ctx.stat(str(surl))
 
-            io.summary = "File successfully listed"
-            io.status = nap.OK
+            return nap.OK, "File successfully listed", watch.elapsed
         except gfal2.GError as e:
             er = e.message
-            io.status = nap.CRITICAL
             if er:
-                io.summary = "[Err:%s];" % str(er)
-            else:
-                io.summary = "Error"
+                return nap.CRITICAL, "[Err:%s];" % str(er), watch.elapsed
+            return nap.CRITICAL, "Error", watch.elapsed
 
         except Exception as e:
-            io.set_status(
+            return (
                 nap.CRITICAL,
                 "problem invoking gfal2 stat(): %s:%s" % (str(e), sys.exc_info()[0]),
+                watch.elapsed,
             )
 
+    run_per_path(args, io, stat, srms, "stat", numbers)
+
 
 @app.metric(seq=5, metric_name="VOGetTurl", passive=True)
-def metricVOGetTURLs(ags, io):
+def metricVOGetTURLs(args, io):
     """Get Transport URLs for the file copied to storage"""
 
-    # verify previous test succeeded
-    results = app.metric_results()
-    if results[3][1] != nap.OK:
+    # only the files which were listed
+    numbers, src_files = succeeded_paths("stat")
+    if not src_files:
         io.set_status(nap.WARNING, "VOGetTurl skipped")
         return
 
-    if len(_voInfoDictionary.keys()) == 0:
-        io.set_status(nap.WARNING, "No SRM endpoints found to test")
+    ctx = get_context(args)
+    if operation_timeout(args, io, "VOGetTurl", args.se_timeout, ctx) is None:
         return
+    matrix = None
+    turl_timeout = args.turl_timeout
+    if args.turl_matrix:
+        # one context per protocol, each only asks for its protocol
+        matrix = [
+            (p, get_context(args, (p,), args.turl_timeout)) for p in TURL_PROTOCOLS
+        ]
+        turl_timeout = operation_timeout(
+            args, io, "VOGetTurl", args.turl_timeout, *[c for _, c in matrix]
+        )
+        if turl_timeout is None:
+            return
 
-    for srmendpt in _voInfoDictionary.keys():
-
-        src_filename = (_voInfoDictionary[srmendpt])["fn"]
-        src_file = srmendpt + "/" + src_filename
+    def getturl(src_file):
+        watch = Stopwatch()
         try:
             scheme = urlparse(src_file).scheme
             if scheme in ["gsiftp", "https"]:
                 # If protocol is gsiftp or https it's already a transport URL
                 replicas = src_file
+            elif matrix:
+                return turl_matrix(str(src_file), matrix, turl_timeout)
             else:
-                replicas = ctx.getxattr(str(src_file), "user.replicas")
+                with watch:
+                    replicas = ctx.getxattr(str(src_file), "user.replicas")
 
-            io.summary = "protocol OK-[%s]" % scheme + " replicas [%s]" % str(replicas)
-            io.status = nap.OK
+            return (
+                nap.OK,
+                "protocol OK-[%s]" % scheme + " replicas [%s]" % str(replicas),
+                watch.elapsed,
+            )
 
         except gfal2.GError as e:
-            io.status = nap.CRITICAL
             er = e.message
             if er:
-                io.summary = "protocol FAILED-[%s]" % scheme + " [Err:%s]" % str(er)
-            else:
-                io.summary = "protocol FAILED-[%s]" % scheme
+                return (
+                    nap.CRITICAL,
+                    "protocol FAILED-[%s]" % scheme + " [Err:%s]" % str(er),
+                    watch.elapsed,
+                )
+            return nap.CRITICAL, "protocol FAILED-[%s]" % scheme, watch.elapsed
         except Exception as e:
-            io.set_status(
+            return (
                 nap.CRITICAL,
                 "problem invoking gfal2 getxattr(): %s:%s"
                 % (str(e), sys.exc_info()[0]),
+                watch.elapsed,
             )
 
+    run_per_path(args, io, getturl, src_files, "getxattr", numbers)
+
 
 @app.metric(seq=6, metric_name="VOGet", passive=True)
 def metricVOGet(args, io):
-    """Copy given remote file(s) from SRM to a local file."""
-
-    # verify previous test succeeded
-    results = app.metric_results()
-    if results[4][1] != nap.OK:
+    """Verify given remote file(s) on the SRM: copy them to a local file and
+    compare (diff), and/or compare their checksum computed by the SRM
+    (checksum) or while reading them (stream) with the one of the payload."""
+    import datetime
+    import filecmp
+
+    # only the files whose TURLs were obtained
+    numbers, src_files = succeeded_paths("getxattr")
+    if not src_files:
         io.set_status(nap.WARNING, "VOGet skipped")
         return
 
-    if len(_voInfoDictionary.keys()) == 0:
-        io.set_status(nap.WARNING, "No SRM endpoints found to test")
+    # one local copy per storage path, they are fetched concurrently; only
+    # diff against a payload on disk needs them
+    in_memory = args.payload_io == "memory"
+    local_copy = "diff" in args.verify and not in_memory
+    copies = []
+    for n, src_file in enumerate(src_files):
+        local_file = None
+        if local_copy:
+            local_file = _run.workfile("%s.%d" % (_fileTestIn, n))
+        copies.append((src_file, local_file))
+    test_file = _run.workfile(_fileTest) if local_copy else None
+    block = _run.payload_block
+    expected = _run.payload_checksum
+    algorithm = args.checksum_type
+    download = "diff" in args.verify or "stream" in args.verify
+
+    ctx = get_context(args)
+    timeout = operation_timeout(args, io, "VOGet", args.se_timeout, ctx)
+    if timeout is None:
         return
+    deadline = run_deadline(args)
 
-    for srmendpt in _voInfoDictionary.keys():
-
-        src_filename = (_voInfoDictionary[srmendpt])["fn"]
-        src_file = srmendpt + "/" + src_filename
-
-        dest_file = "file://" + _fileTestIn
+    def get(copy):
+        src_file, local_file = copy
 
         # Set transfer parameters
         params = ctx.transfer_parameters()
-        params.timeout = args.se_timeout
+        params.timeout = deadline.timeout(timeout)
 
         params.overwrite = True
+        params.event_callback = events = TransferEvents()
 
         stMsg = "File was%s copied from SRM."
-        start_transfer = datetime.datetime.now()
+        call = "filecopy"
+        watch = Stopwatch()
+        checksum_watch = Stopwatch()
+        verified = []
         try:
-            ctx.filecopy(params, str(src_file), str(dest_file))
-            if filecmp.cmp(_fileTest, _fileTestIn):
-                # Files match
-                io.status = nap.OK
-                total_transfer = datetime.datetime.now() - start_transfer
-                io.summary = (
-                    stMsg % ("")
-                    + " Diff successful."
-                    + " Transfer time: "
-                    + str(total_transfer)
-                )
-            else:
-                # Files do not match
-                io.status = nap.CRITICAL
-                io.summary = stMsg % ("") + " Files differ!"
+            if "checksum" in args.verify:
+                stMsg, call = "Checksum was%s computed by SRM.", "checksum"
+                with checksum_watch:
+                    remote = ctx.checksum(str(src_file), algorithm)
+                if not checksums_match(expected, remote):
+                    return (
+                        nap.CRITICAL,
+                        "%s mismatch on SRM: expected %s, got %s"
+                        % (algorithm, expected, remote),
+                        watch.elapsed if download else checksum_watch.elapsed,
+                    )
+                verified.append("checksum")
+            if "stream" in args.verify:
+                stMsg, call = "File was%s read from SRM.", "open/read"
+                with watch:
+                    streamed = stream_checksum(ctx, str(src_file), algorithm)
+                if not checksums_match(expected, streamed):
+                    return (
+                        nap.CRITICAL,
+                        stMsg % ("")
+                        + " %s mismatch: expected %s, got %s"
+                        % (algorithm, expected, streamed),
+                        watch.elapsed,
+                    )
+                verified.append("stream")
+            if "diff" in args.verify and in_memory:
+                stMsg, call = "File was%s read from SRM.", "open/read"
+                with watch:
+                    same = stream_compare(
+                        ctx, str(src_file), payload_chunks(block, args.payload_size)
+                    )
+                if not same:
+                    return nap.CRITICAL, stMsg % ("") + " Files differ!", watch.elapsed
+            elif "diff" in args.verify:
+                stMsg, call = "File was%s copied from SRM.", "filecopy"
+                dest_file = "file://%s" % local_file
+                with watch:
+                    ctx.filecopy(params, str(src_file), str(dest_file))
+                if not filecmp.cmp(test_file, local_file):
+                    # Files do not match
+                    return nap.CRITICAL, stMsg % ("") + " Files differ!", watch.elapsed
 
         except gfal2.GError as e:
-            io.status = nap.CRITICAL
+            elapsed = watch.elapsed if download else checksum_watch.elapsed
             er = e.message
             if er:
-                io.summary = stMsg % (" NOT") + " [Err:%s]" % str(er)
-            else:
-                io.summary = stMsg % " NOT"
+                return (
+                    nap.CRITICAL,
+                    stMsg % (" NOT") + " [Err:%s]" % str(er),
+                    elapsed,
+                )
+            return nap.CRITICAL, stMsg % " NOT", elapsed
         except Exception as e:
-            io.set_status(
+            return (
                 nap.CRITICAL,
-                "problem invoking gfal2 filecopy(): %s:%s"
-                % (str(e), sys.exc_info()[0]),
+                "problem invoking gfal2 %s(): %s:%s"
+                % (call, str(e), sys.exc_info()[0]),
+                watch.elapsed if download else checksum_watch.elapsed,
             )
 
+        if not download:
+            return (
+                nap.OK,
+                "%s verified by SRM (checksum)." % algorithm,
+                checksum_watch.elapsed,
+            )
+        summary = stMsg % ("")
+        if "diff" in args.verify:
+            summary += " Diff successful."
+        if verified:
+            summary += " %s verified (%s)." % (algorithm, ", ".join(verified))
+        total_transfer = datetime.timedelta(seconds=watch.elapsed)
+        perf_data = transfer_perf_data(args, "get", events, watch.elapsed)
+        if checksum_watch.elapsed is not None:
+            perf_data.append(("checksum", "%.3f" % checksum_watch.elapsed, "s"))
+        return (
+            nap.OK,
+            summary + " Transfer time: " + str(total_transfer),
+            watch.elapsed,
+            perf_data,
+        )
+
+    operation = download and "get" or "checksum"
+    run_per_path(args, io, get, copies, operation, numbers)
+
 
 @app.metric(seq=7, metric_name="VODel", passive=True)
 def metricVODel(args, io):
     """Delete given file(s) from SRM."""
 
-    # skip only if the put failed
-    results = app.metric_results()
-    if results[2][1] != nap.OK:
+    # delete every file which was copied, whatever the metrics in between did
+    numbers, src_files = succeeded_paths("put")
+    if not src_files:
         io.set_status(nap.WARNING, "VODel skipped")
         return
 
-    if len(_voInfoDictionary.keys()) == 0:
-        io.set_status(nap.CRITICAL, "No SRM endpoints found to test")
-
-    for srmendpt in _voInfoDictionary.keys():
+    ctx = get_context(args)
+    # test files are deleted even if the other metrics used up their time
+    run_deadline(args).release()
+    if operation_timeout(args, io, "VODel", args.se_timeout, ctx) is None:
+        return
 
-        src_filename = (_voInfoDictionary[srmendpt])["fn"]
-        src_file = srmendpt + "/" + src_filename
+    def unlink(src_file):
         stMsg = "File was%s deleted from SRM."
+        watch = Stopwatch()
         try:
-            ctx.unlink(str(src_file))
-            io.status = nap.OK
-            io.summary = stMsg % ""
+            with watch:
+                ctx.unlink(str(src_file))
+            return nap.OK, stMsg % "", watch.elapsed
         except gfal2.GError as e:
             er = e.message
             if er:
-                io.summary = stMsg % " NOT" + " [Err:%s]" % str(er)
-            else:
-                io.summary = stMsg % " NOT"
-            io.status = nap.CRITICAL
+                return (
+                    nap.CRITICAL,
+                    stMsg % " NOT" + " [Err:%s]" % str(er),
+                    watch.elapsed,
+                )
+            return nap.CRITICAL, stMsg % " NOT", watch.elapsed
         except Exception as e:
-            io.set_status(
+            return (
                 nap.CRITICAL,
                 "problem invoking gfal2 unlink(): %s:%s" % (str(e), sys.exc_info()[0]),
+                watch.elapsed,
             )
 
+    run_per_path(args, io, unlink, src_files, "unlink", numbers)
+
 
 @app.metric(seq=8, metric_name="VOAll", passive=False)
 def metricVOAlll(args, io):
     """Active metric to combine the result from the previous passive ones"""
 
-    results = app.metric_results()
+    results = _run.results
 
     statuses = [e[1] for e in results]
 
@@ -532,11 +1942,586 @@ def metricVOAlll(args, io):
     else:
         io.set_status(nap.WARNING, "Some of the tests returned a warning")
 
+    # nap leaves through os._exit() after the last metric, remove the work
+    # directory here whatever happens
     try:
-        shutil.rmtree(workdir_metric)
-    except OSError as e:
-        pass
+        update_circuit(args)
+        names = dict((f.__name__, name) for f, name, _ in app.sequence)
+        record_history(
+            args,
+            [(names.get(e[0], e[0]), e[1]) for e in results] + [("VOAll", io.status)],
+        )
+    finally:
+        _run.cleanup()
 
 
-if __name__ == "__main__":
+# ########################################################################### #
+# Results history
+
+
+def history_path(args):
+    return args.history_db or os.path.join(args.cache_dir, "history.sqlite")
+
+
+def record_history(args, statuses):
+    """Append this run's metric C{statuses} (list of C{(metric, status)}) and
+    timings to the history, and with --adaptive add the timings of the
+    operations which worked to their baselines. The probe result doesn't
+    depend on it, errors are only logged."""
+    if args.history_retention <= 0:
+        return
+    import sqlite3
+    import history
+
+    try:
+        with history.History(history_path(args)) as store:
+            store.record(args.hostname, statuses, _run.timings)
+            if args.adaptive:
+                store.update_baselines(args.hostname, _run.samples, ADAPTIVE_ALPHA)
+            store.prune(args.history_retention * 86400)
+    except (sqlite3.Error, OSError) as e:
+        nap.core.log.debug("Can't record results history: %s" % e)
+
+
+def load_baselines(args):
+    """Latency baselines of the -H host from the history, read once per run.
+
+    @return: dictionary C{{label: (n, mean, mad)}}, empty if there is no
+      history.
+    """
+    if _run.baselines is None:
+        _run.baselines = {}
+        if args.history_retention <= 0:
+            return _run.baselines
+        import sqlite3
+        import history
+
+        try:
+            with history.History(history_path(args)) as store:
+                _run.baselines = store.baselines(args.hostname)
+        except (sqlite3.Error, OSError) as e:
+            nap.core.log.debug("Can't read latency baselines: %s" % e)
+    return _run.baselines
+
+
+def given_hostname(argv=None):
+    """The -H host of the command line C{argv}, None if there is none: nap
+    defaults it to localhost."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-H", "--hostname")
+    return parser.parse_known_args(argv)[0].hostname
+
+
+def run_history_query(args, host=None):
+    """Print failure rates and timing percentiles from the history.
+
+    @param host: storage element, None for all of them
+    @return: exit code
+    """
+    import sqlite3
+    import history
+
+    since = time.time() - args.history_window
+    try:
+        with history.History(history_path(args)) as store:
+            rates = store.failure_rates(since, host)
+            percentiles = store.percentiles(since, host)
+    except (sqlite3.Error, OSError) as e:
+        print("UNKNOWN - Can't read results history: %s" % e)
+        return nap.UNKNOWN
+
+    print(
+        "Results history of the last %ds in %s"
+        % (args.history_window, history_path(args))
+    )
+    print()
+    print("%-40s %-12s %8s %8s %8s" % ("ENDPOINT", "METRIC", "RUNS", "FAILED", "RATE"))
+    for (endpoint, metric), (runs, failures) in sorted(rates.items()):
+        print(
+            "%-40s %-12s %8d %8d %7.1f%%"
+            % (endpoint, metric, runs, failures, 100.0 * failures / runs)
+        )
+    print()
+    print(
+        "%-40s %-20s %8s %8s %8s %8s"
+        % ("ENDPOINT", "TIMING", "COUNT", "P50", "P95", "P99")
+    )
+    for (endpoint, label), (count, values) in sorted(percentiles.items()):
+        print(
+            "%-40s %-20s %8d %7.3fs %7.3fs %7.3fs"
+            % ((endpoint, label, count) + tuple(values))
+        )
+    return nap.OK
+
+
+# ########################################################################### #
+# Test files sweeper
+
+
+def stale_test_files(directory, before):
+    """Yield the names of the test files written before C{before} (seconds
+    since the epoch), according to their name, as the C{directory} opened
+    with gfal2 opendir() is read.
+
+    The directory is listed in chunks and never held in memory, so that
+    directories too large for listdir() can be swept.
+    """
+    while True:
+        entry = directory.read()
+        if entry is None:
+            return
+        m = _fileSRMRegex.match(entry.d_name)
+        if m and int(m.group(1)) < before:
+            yield entry.d_name
+
+
+class RateLimiter(object):
+    """Spaces out operations to at most C{rate} per second on average, no
+    limit if C{rate} is not positive."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.count = 0
+
+    def wait(self, count, deadline):
+        "Account for C{count} operations, sleep until the rate allows more"
+        self.count += count
+        if self.rate > 0:
+            ahead = self.count / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(min(ahead, deadline.remaining()))
+
+
+def unlink_in_batches(args, ctx, surls, deadline, limiter):
+    """Delete C{surls}, taken from the iterable as they come, with gfal2 bulk
+    unlink(), --sweep-batch at a time, as fast as C{limiter} allows, until
+    C{deadline}; with --sweep-dry-run only count them. Files a listing misses
+    as it shifts under the deletions are left to the next sweep.
+
+    @return: C{(found, deleted, errors)}, C{errors} being a list of messages,
+      with the gfal2 error which ended C{surls} if any.
+    """
+    import itertools
+
+    found = deleted = 0
+    errors = []
+    surls = iter(surls)
+    while True:
+        if deadline.exhausted():
+            errors.append("time budget exhausted, the rest is left")
+            break
+        try:
+            batch = list(itertools.islice(surls, max(args.sweep_batch, 1)))
+        except gfal2.GError as e:
+            errors.append("listing failed [Err:%s]" % e.message)
+            break
+        if not batch:
+            break
+        found += len(batch)
+        if args.sweep_dry_run:
+            continue
+        try:
+            results = ctx.unlink(batch)
+        except gfal2.GError as e:
+            results = [e] * len(batch)
+        for surl, error in zip(batch, results):
+            if error is None:
+                deleted += 1
+            else:
+                errors.append("%s: %s" % (surl, getattr(error, "message", error)))
+        limiter.wait(len(batch), deadline)
+    return found, deleted, errors
+
+
+def run_sweep(args):
+    """Delete the test files older than --sweep-age left in the storage paths
+    of the -H host by runs killed before VODel, or with --sweep-dry-run only
+    count them, and print the result.
+
+    @return: exit code
+    """
+    io = PassiveIO("Sweep", args.hostname)
+    if parse_args(args, io):
+        print("%s - %s" % (nap.core.get_status(io.status), io.summary))
+        return io.status
+    if args.endpoint is None:
+        surls, _ = getSURLFromBDII(args, io)
+    else:
+        surls = [args.endpoint]
+    ctx = surls and get_context(args)
+    if not surls or operation_timeout(args, io, "Sweep", args.se_timeout, ctx) is None:
+        print("%s - %s" % (nap.core.get_status(io.status), io.summary))
+        return io.status
+    deadline = run_deadline(args)
+    # the time kept for VODel is of no use here
+    deadline.release()
+    limiter = RateLimiter(args.sweep_rate)
+
+    before = time.time() - args.sweep_age
+    details = []
+    found = deleted = failed = 0
+    listed = 0
+    incomplete = False
+    with Stopwatch() as watch:
+        for surl in surls:
+            try:
+                directory = ctx.opendir(surl)
+            except gfal2.GError as e:
+                details.append("%s: listing failed [Err:%s]" % (surl, e.message))
+                continue
+            listed += 1
+            # deleted as they are read, a batch at a time
+            names = stale_test_files(directory, before)
+            n, done, errors = unlink_in_batches(
+                args, ctx, (surl + "/" + name for name in names), deadline, limiter
+            )
+            found += n
+            incomplete = incomplete or bool(errors)
+            if args.sweep_dry_run:
+                details.append("%s: %d test files to delete" % (surl, n))
+            else:
+                deleted += done
+                failed += n - done
+                details.append("%s: %d of %d test files deleted" % (surl, done, n))
+            details.extend(errors[:10])
+            if len(errors) > 10:
+                details.append("... %d more errors" % (len(errors) - 10))
+
+    if not listed:
+        status = nap.CRITICAL
+    elif listed < len(surls) or failed or incomplete:
+        status = nap.WARNING
+    else:
+        status = nap.OK
+    if args.sweep_dry_run:
+        summary = "%d test files older than %ds to delete" % (found, args.sweep_age)
+    else:
+        summary = "%d of %d test files older than %ds deleted" % (
+            deleted,
+            found,
+            args.sweep_age,
+        )
+    print(
+        "%s - %s in %d of %d storage paths | found=%d deleted=%d failed=%d "
+        "sweep=%.3fs"
+        % (
+            nap.core.get_status(status),
+            summary,
+            listed,
+            len(surls),
+            found,
+            deleted,
+            failed,
+            watch.elapsed,
+        )
+    )
+    for line in details:
+        print(line)
+    return status
+
+
+# ########################################################################### #
+# Batch mode
+
+_command_pipe_lock = threading.Lock()
+
+
+class PassiveIO(nap.core.PluginIO):
+    """nap.core.PluginIO for metrics run from batch worker threads.
+
+    Unlike PluginIO it leaves sys.stdout alone; results can only be
+    submitted passively.
+    """
+
+    def __init__(self, metric_name, hostname, command_pipe=None, dry_run=False):
+        self._stdout = _io.StringIO()
+        self._perf_container = list()
+        self.metric_name = metric_name
+        self.hostname = hostname
+        self.summary = "Plugin didn't set summary message"
+        self.status = nap.UNKNOWN
+        self.command_pipe = command_pipe
+        self.dry_run = dry_run
+        self.pass_to_stdout = False
+
+    def plugin_passive_out(self):
+        # one result at a time, long results don't fit in an atomic pipe write
+        with _command_pipe_lock:
+            return nap.core.PluginIO.plugin_passive_out(self)
+
+
+def read_batch_targets(path):
+    """Read storage elements to check in batch or daemon mode.
+
+    One 'HOSTNAME [ENDPOINT] [interval=SECONDS]' per line, empty lines and
+    '#' comments are ignored. Without ENDPOINT the SURLs are taken from the
+    BDII. The interval is only used in daemon mode.
+
+    @return: list of C{(hostname, endpoint, interval)}, endpoint and interval
+      are None if not given.
+    @raise ValueError: for an invalid interval.
+    """
+    fp = path == "-" and sys.stdin or open(path)
+    try:
+        targets = []
+        seen = set()
+        for line in fp:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            endpoint, interval = None, None
+            for field in fields[1:]:
+                if field.startswith("interval="):
+                    interval = int(field[len("interval=") :])
+                    if interval <= 0:
+                        raise ValueError("invalid interval: %s" % field)
+                else:
+                    endpoint = field
+            if (fields[0], endpoint) not in seen:
+                seen.add((fields[0], endpoint))
+                targets.append((fields[0], endpoint, interval))
+        return targets
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def check_storage_element(args, hostname, endpoint=None):
+    """Run all metrics against one storage element in the current thread and
+    submit their results passively, VOAll included.
+
+    @return: status of the last (VOAll) metric.
+    """
+    args = argparse.Namespace(**vars(args))
+    args.hostname = hostname
+    if endpoint:
+        args.endpoint = endpoint
+    _run.reset([])
+    try:
+        for function, metric_name, _ in app.sequence:
+            # same naming as nap.core.Plugin.run()
+            if args.prefix:
+                metric_name = args.prefix + "-" + metric_name
+            if args.suffix:
+                metric_name = metric_name + "-" + args.suffix
+            io = PassiveIO(metric_name, hostname, args.command, args.dry_run)
+            try:
+                function(args, io)
+            except Exception as e:
+                io.status = nap.UNKNOWN
+                io.summary = "Exception caught while executing plugin (%s)" % e
+            _run.results.append((function.__name__, io.status, io.summary, "passive"))
+            io.plugin_passive_out()
+            io.close()
+    finally:
+        _run.cleanup()
+    return _run.results[-1][1]
+
+
+def setup_logging(level):
+    "Log to stdout, nap.core.Plugin.run() does it in single check mode"
+    handler = logging.StreamHandler(stream=sys.stdout)
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(levelname)s %(module)s[%(process)d]: %(message)s",
+            datefmt="%b %d %H:%M:%S",
+        )
+    )
+    nap.core.log.addHandler(handler)
+    nap.core.log.setLevel(level)
+
+
+def load_batch_targets(args):
+    """Read C{args.batch}, printing an UNKNOWN result if it can't be used.
+
+    @return: list of targets (see L{read_batch_targets}) or None.
+    """
+    try:
+        targets = read_batch_targets(args.batch)
+    except (IOError, OSError, ValueError) as e:
+        print("UNKNOWN - Can't read storage elements list: %s" % e)
+        return None
+    if not targets:
+        print("UNKNOWN - No storage elements to check in %s" % args.batch)
+        return None
+    return targets
+
+
+def refresh_bdii_prefetch(args, targets):
+    """Prefetch the BDII answer for all storage elements of the VO if some
+    C{targets} need it. A failed prefetch keeps the previous answer, if any.
+    """
+    global _bdiiIndex
+    if args.bdii_prefetch and not all(endpoint for _, endpoint, _ in targets):
+        configure_gridutils(args)
+        index = prefetch_bdii(args)
+        if index is not None:
+            _bdiiIndex = index
+        elif _bdiiIndex is None:
+            nap.core.log.warning(
+                "BDII prefetch failed or truncated, querying the BDII per "
+                "storage element"
+            )
+        else:
+            nap.core.log.warning(
+                "BDII prefetch failed or truncated, keeping the previous one"
+            )
+
+
+def run_batch(args):
+    """Check all storage elements listed in C{args.batch} with a pool of
+    C{args.workers} threads.
+
+    @return: exit code
+    """
+    import concurrent.futures
+
+    if args.debug:
+        setup_logging(logging.DEBUG)
+    targets = load_batch_targets(args)
+    if targets is None:
+        return nap.UNKNOWN
+
+    refresh_bdii_prefetch(args, targets)
+
+    counts = {nap.OK: 0, nap.WARNING: 0, nap.CRITICAL: 0, nap.UNKNOWN: 0}
+    with concurrent.futures.ThreadPoolExecutor(max(1, args.workers)) as pool:
+        futures = [
+            pool.submit(check_storage_element, args, hostname, endpoint)
+            for hostname, endpoint, _ in targets
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                status = future.result()
+            except Exception:
+                status = nap.UNKNOWN
+            counts[status if status in counts else nap.UNKNOWN] += 1
+
+    print(
+        "OK - %d storage elements checked: %d OK, %d WARNING, %d CRITICAL, "
+        "%d UNKNOWN"
+        % (
+            len(targets),
+            counts[nap.OK],
+            counts[nap.WARNING],
+            counts[nap.CRITICAL],
+            counts[nap.UNKNOWN],
+        )
+    )
+    return nap.OK
+
+
+# ########################################################################### #
+# Daemon mode
+
+
+def run_daemon(args):
+    """Check the storage elements listed in C{args.batch} every
+    C{args.interval} (or their own interval) seconds plus up to
+    C{args.jitter} seconds, on a pool of C{args.workers} threads, until
+    SIGTERM or SIGINT.
+
+    A storage element is scheduled again only once its check is over, so
+    slow checks never overlap. The BDII prefetch is refreshed every
+    C{args.bdii_cache_ttl} seconds (C{args.interval} if the cache is off).
+
+    @return: exit code
+    """
+    import concurrent.futures
+    import heapq
+    import itertools
+    import random
+
+    setup_logging(args.debug and logging.DEBUG or logging.INFO)
+    targets = load_batch_targets(args)
+    if targets is None:
+        return nap.UNKNOWN
+
+    stopping = threading.Event()
+    wakeup = threading.Condition()
+
+    def stop(signum, frame):
+        nap.core.log.info("Signal %d received, stopping" % signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def jitter():
+        return random.uniform(0, max(args.jitter, 0))
+
+    # ties on time are broken by order of scheduling, n (None for the
+    # prefetch) is never compared
+    sequence = itertools.count()
+
+    def schedule(when, n):
+        with wakeup:
+            heapq.heappush(queue, (when, next(sequence), n))
+            wakeup.notify()
+
+    def check(n):
+        hostname, endpoint, interval = targets[n]
+        started = time.monotonic()
+        try:
+            status = check_storage_element(args, hostname, endpoint)
+            nap.core.log.info(
+                "%s checked: %s in %.1fs"
+                % (hostname, nap.core.get_status(status), time.monotonic() - started)
+            )
+        except Exception as e:
+            nap.core.log.error("%s check failed: %s" % (hostname, e))
+        schedule(started + (interval or args.interval) + jitter(), n)
+
+    def prefetch(n):
+        try:
+            refresh_bdii_prefetch(args, targets)
+        finally:
+            ttl = args.bdii_cache_ttl > 0 and args.bdii_cache_ttl or args.interval
+            schedule(time.monotonic() + ttl, n)
+
+    # the first checks are spread over the jitter, the prefetch goes first
+    now = time.monotonic()
+    queue = [(now + jitter(), next(sequence), n) for n in range(len(targets))]
+    if args.bdii_prefetch and not all(endpoint for _, endpoint, _ in targets):
+        queue.append((now, next(sequence), None))
+    heapq.heapify(queue)
+    nap.core.log.info(
+        "Checking %d storage elements every %ds" % (len(targets), args.interval)
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, args.workers)) as pool:
+        while not stopping.is_set():
+            with wakeup:
+                delay = 1
+                if queue:
+                    delay = queue[0][0] - time.monotonic()
+                if delay > 0:
+                    # wake up regularly to notice a stop signal
+                    wakeup.wait(min(delay, 1))
+                    continue
+                _, _, n = heapq.heappop(queue)
+            if n is None:
+                pool.submit(prefetch, n)
+            else:
+                pool.submit(check, n)
+    return nap.OK
+
+
+def main():
+    args = app._parser.parse_args()
+    if args.daemon and not args.batch:
+        app._parser.error("--daemon needs the storage elements list (--batch)")
+    if args.history_query:
+        sys.exit(run_history_query(args, given_hostname()))
+    if args.sweep:
+        sys.exit(run_sweep(args))
+    if args.daemon:
+        sys.exit(run_daemon(args))
+    if args.batch:
+        sys.exit(run_batch(args))
     app.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Tests of the BER codec and search filter encoder of ldapclient."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import ldapclient as lc  # noqa: E402
+
+
+def decode_filter(data):
+    """Decode an encoded filter back to a nested structure, the inverse of
+    encode_filter() for the tests."""
+    tag, content, end = lc.ber_decode(data)
+    assert end == len(data)
+    if tag in (lc.FILTER_AND, lc.FILTER_OR):
+        return (
+            tag,
+            [decode_filter(lc.ber_tlv(*item)) for item in lc.ber_decode_all(content)],
+        )
+    if tag == lc.FILTER_NOT:
+        return (tag, decode_filter(content))
+    if tag == lc.FILTER_PRESENT:
+        return (tag, content)
+    attr, value = lc.ber_decode_all(content)
+    if tag == lc.FILTER_SUBSTRINGS:
+        return (tag, attr[1], lc.ber_decode_all(value[1]))
+    return (tag, attr[1], value[1])
+
+
+class BERTest(unittest.TestCase):
+    def test_length(self):
+        for length, encoded in [
+            (0, b"\x00"),
+            (0x7F, b"\x7f"),
+            (0x80, b"\x81\x80"),
+            (0xFF, b"\x81\xff"),
+            (0x100, b"\x82\x01\x00"),
+            (0x12345, b"\x83\x01\x23\x45"),
+        ]:
+            self.assertEqual(lc.ber_length(length), encoded)
+
+    def test_integer_round_trip(self):
+        for value in (0, 1, 0x7F, 0x80, 0xFF, 0x100, 0x7FFF, 0x8000, 2**31 - 1):
+            tag, content, end = lc.ber_decode(lc.ber_integer(value))
+            self.assertEqual(tag, lc.TAG_INTEGER)
+            # positive integers never have the sign bit set
+            self.assertFalse(content[0] & 0x80)
+            self.assertEqual(lc.ber_to_int(content), value)
+
+    def test_enumerated_and_boolean(self):
+        self.assertEqual(lc.ber_enumerated(2), b"\x0a\x01\x02")
+        self.assertEqual(lc.ber_boolean(True), b"\x01\x01\xff")
+        self.assertEqual(lc.ber_boolean(False), b"\x01\x01\x00")
+
+    def test_string_round_trip(self):
+        for value in ("", "o=grid", "dé" * 200):
+            tag, content, end = lc.ber_decode(lc.ber_string(value))
+            self.assertEqual(tag, lc.TAG_OCTET_STRING)
+            self.assertEqual(content.decode("utf-8"), value)
+        self.assertEqual(lc.ber_string(b"\x00\xff", 0x80), b"\x80\x02\x00\xff")
+
+    def test_sequence_round_trip(self):
+        items = [lc.ber_integer(7), lc.ber_string("x" * 300), lc.ber_boolean(True)]
+        data = lc.ber_sequence(items) + lc.ber_integer(1)
+        tag, content, end = lc.ber_decode(data)
+        self.assertEqual(tag, lc.TAG_SEQUENCE)
+        self.assertEqual(data[end:], lc.ber_integer(1))
+        decoded = lc.ber_decode_all(content)
+        self.assertEqual([t for t, _ in decoded], [0x02, 0x04, 0x01])
+        self.assertEqual(lc.ber_to_int(decoded[0][1]), 7)
+        self.assertEqual(decoded[1][1], b"x" * 300)
+
+    def test_truncated(self):
+        data = lc.ber_string("x" * 300)
+        for cut in (1, 2, 3, len(data) - 1):
+            self.assertRaises(lc.LDAPError, lc.ber_decode, data[:cut])
+
+    def test_message_length(self):
+        data = lc.ber_sequence([lc.ber_string("x" * 300)])
+        self.assertIsNone(lc.ber_message_length(data[:1]))
+        self.assertIsNone(lc.ber_message_length(data[:3]))
+        for cut in (4, 10, len(data)):
+            self.assertEqual(lc.ber_message_length(data[:cut]), len(data))
+        self.assertEqual(lc.ber_message_length(b"\x30\x03abc"), 5)
+        self.assertRaises(lc.LDAPError, lc.ber_message_length, b"\x30\x80")
+
+    def test_paged_results_cookie(self):
+        control = lc.paged_results_control(100, b"cookie")
+        self.assertEqual(lc.decode_paged_results_cookie(control), b"cookie")
+        self.assertEqual(
+            lc.decode_paged_results_cookie(lc.paged_results_control(0)), b""
+        )
+        self.assertEqual(lc.decode_paged_results_cookie(b""), b"")
+
+    def test_entry(self):
+        attributes = lc.ber_sequence(
+            [
+                lc.ber_sequence(
+                    [
+                        lc.ber_string("GlueSAPath"),
+                        lc.ber_sequence(
+                            [lc.ber_string("/a"), lc.ber_string("/b")], lc.TAG_SET
+                        ),
+                    ]
+                ),
+                lc.ber_sequence(
+                    [
+                        lc.ber_string("GlueSALocalID"),
+                        lc.ber_sequence([lc.ber_string("dteam")], lc.TAG_SET),
+                    ]
+                ),
+            ]
+        )
+        content = lc.ber_string("GlueSALocalID=dteam,o=grid") + attributes
+        self.assertEqual(
+            lc.decode_entry(content),
+            (
+                "GlueSALocalID=dteam,o=grid",
+                {"GlueSAPath": ["/a", "/b"], "GlueSALocalID": ["dteam"]},
+            ),
+        )
+        self.assertEqual(
+            lc.decode_entry(content, {"gluesapath"}),
+            ("GlueSALocalID=dteam,o=grid", {"GlueSAPath": ["/a", "/b"]}),
+        )
+
+
+class FilterTest(unittest.TestCase):
+    def test_equality(self):
+        self.assertEqual(
+            decode_filter(lc.encode_filter("(GlueSALocalID=dteam)")),
+            (lc.FILTER_EQUALITY, b"GlueSALocalID", b"dteam"),
+        )
+
+    def test_without_parentheses(self):
+        self.assertEqual(
+            lc.encode_filter("objectClass=*"), lc.encode_filter(" (objectClass=*) ")
+        )
+
+    def test_present(self):
+        self.assertEqual(
+            decode_filter(lc.encode_filter("(objectClass=*)")),
+            (lc.FILTER_PRESENT, b"objectClass"),
+        )
+
+    def test_substrings(self):
+        self.assertEqual(
+            decode_filter(lc.encode_filter("(GlueServiceUniqueID=*://se*.org*)")),
+            (
+                lc.FILTER_SUBSTRINGS,
+                b"GlueServiceUniqueID",
+                [(lc.SUBSTRING_ANY, b"://se"), (lc.SUBSTRING_ANY, b".org")],
+            ),
+        )
+        self.assertEqual(
+            decode_filter(lc.encode_filter("(GlueServiceVersion=2.*)")),
+            (
+                lc.FILTER_SUBSTRINGS,
+                b"GlueServiceVersion",
+                [(lc.SUBSTRING_INITIAL, b"2.")],
+            ),
+        )
+        self.assertEqual(
+            decode_filter(lc.encode_filter("(cn=a*b)")),
+            (
+                lc.FILTER_SUBSTRINGS,
+                b"cn",
+                [(lc.SUBSTRING_INITIAL, b"a"), (lc.SUBSTRING_FINAL, b"b")],
+            ),
+        )
+
+    def test_ordering_and_approx(self):
+        for text, tag in [
+            ("(size>=10)", lc.FILTER_GREATER_OR_EQUAL),
+            ("(size<=10)", lc.FILTER_LESS_OR_EQUAL),
+            ("(size~=10)", lc.FILTER_APPROX),
+        ]:
+            self.assertEqual(
+                decode_filter(lc.encode_filter(text)), (tag, b"size", b"10")
+            )
+
+    def test_escapes(self):
+        self.assertEqual(
+            decode_filter(lc.encode_filter(r"(cn=a\2ab\28\29\5c)")),
+            (lc.FILTER_EQUALITY, b"cn", b"a*b()\\"),
+        )
+        self.assertEqual(
+            decode_filter(lc.encode_filter("(cn=dé)")),
+            (lc.FILTER_EQUALITY, b"cn", "dé".encode("utf-8")),
+        )
+
+    def test_and_or_not(self):
+        self.assertEqual(
+            decode_filter(
+                lc.encode_filter("(&(objectClass=GlueSA)(|(rule=dteam)(!(rule=ops))))")
+            ),
+            (
+                lc.FILTER_AND,
+                [
+                    (lc.FILTER_EQUALITY, b"objectClass", b"GlueSA"),
+                    (
+                        lc.FILTER_OR,
+                        [
+                            (lc.FILTER_EQUALITY, b"rule", b"dteam"),
+                            (lc.FILTER_NOT, (lc.FILTER_EQUALITY, b"rule", b"ops")),
+                        ],
+                    ),
+                ],
+            ),
+        )
+
+    def test_bad_filters(self):
+        for text in (
+            "",
+            "(",
+            "(cn=a",
+            "(&)",
+            "(!(a=1)(b=2))",
+            "(=a)",
+            "(cn=a))",
+            "(&(cn=a)",
+        ):
+            self.assertRaises(lc.LDAPError, lc.encode_filter, text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Tests of gridutils.parse_ldif()."""
+
+import base64
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+)
+
+import gridutils  # noqa: E402
+
+
+def parse(text, attrlist=None):
+    return list(gridutils.parse_ldif(io.BytesIO(text.encode("utf-8")), attrlist))
+
+
+class ParseLDIFTest(unittest.TestCase):
+    def test_entries(self):
+        entries = parse(
+            "dn: GlueSALocalID=dteam,o=grid\n"
+            "GlueSAPath: /dpm/example.org/home/dteam\n"
+            "\n"
+            "dn: GlueSEUniqueID=se.example.org,o=grid\n"
+            "GlueSEImplementationName: DPM\n"
+        )
+        self.assertEqual(
+            entries,
+            [
+                (
+                    "GlueSALocalID=dteam,o=grid",
+                    {"GlueSAPath": ["/dpm/example.org/home/dteam"]},
+                ),
+                (
+                    "GlueSEUniqueID=se.example.org,o=grid",
+                    {"GlueSEImplementationName": ["DPM"]},
+                ),
+            ],
+        )
+
+    def test_folding(self):
+        entries = parse(
+            "dn: GlueServiceUniqueID=httpg://se.example.org:8446/srm/managerv2,Mds\n"
+            " -Vo-name=resource,o=grid\n"
+            "GlueServiceEndpoint: httpg://se.example.org:8446/srm/man\n"
+            " agerv2\n"
+            "\n"
+        )
+        self.assertEqual(
+            entries,
+            [
+                (
+                    "GlueServiceUniqueID=httpg://se.example.org:8446/srm/managerv2,"
+                    "Mds-Vo-name=resource,o=grid",
+                    {
+                        "GlueServiceEndpoint": [
+                            "httpg://se.example.org:8446/srm/managerv2"
+                        ]
+                    },
+                )
+            ],
+        )
+
+    def test_folded_base64(self):
+        value = "/dpm/example.org/home/dteam/été"
+        encoded = base64.b64encode(value.encode("utf-8")).decode("ascii")
+        entries = parse(
+            "dn: GlueSALocalID=dteam,o=grid\n"
+            "GlueSAPath:: %s\n"
+            " %s\n" % (encoded[:10], encoded[10:])
+        )
+        self.assertEqual(entries[0][1], {"GlueSAPath": [value]})
+
+    def test_base64_dn(self):
+        dn = "GlueSALocalID=déteam,o=grid"
+        encoded = base64.b64encode(dn.encode("utf-8")).decode("ascii")
+        entries = parse("dn:: %s\nGlueSAPath: /p\n" % encoded)
+        self.assertEqual(entries, [(dn, {"GlueSAPath": ["/p"]})])
+
+    def test_dn_inside_value(self):
+        entries = parse(
+            "dn: GlueSALocalID=dteam,o=grid\n"
+            "GlueChunkKey: dn: GlueSEUniqueID=se.example.org\n"
+            "GlueSAPath: /dpm/example.org/home/\n"
+            " dn: dteam\n"
+        )
+        self.assertEqual(
+            entries,
+            [
+                (
+                    "GlueSALocalID=dteam,o=grid",
+                    {
+                        "GlueChunkKey": ["dn: GlueSEUniqueID=se.example.org"],
+                        "GlueSAPath": ["/dpm/example.org/home/dn: dteam"],
+                    },
+                )
+            ],
+        )
+
+    def test_multi_valued_and_comments(self):
+        entries = parse(
+            "# extended LDIF\n"
+            "dn: GlueSALocalID=dteam,o=grid\n"
+            "GlueSAAccessControlBaseRule: dteam\n"
+            "# a comment between values\n"
+            "GlueSAAccessControlBaseRule: VO:dteam\n"
+            "\n"
+            "# search result\n"
+        )
+        self.assertEqual(
+            entries,
+            [
+                (
+                    "GlueSALocalID=dteam,o=grid",
+                    {"GlueSAAccessControlBaseRule": ["dteam", "VO:dteam"]},
+                )
+            ],
+        )
+
+    def test_url_value(self):
+        entries = parse("dn: o=grid\njpegPhoto:< file:///tmp/photo.jpg\n")
+        self.assertEqual(entries[0][1], {"jpegPhoto": ["file:///tmp/photo.jpg"]})
+
+    def test_attrlist(self):
+        entries = parse(
+            "dn: GlueSALocalID=dteam,o=grid\n"
+            "GlueSAPath: /p\n"
+            "GlueSALocalID: dteam\n",
+            ["gluesapath"],
+        )
+        self.assertEqual(
+            entries, [("GlueSALocalID=dteam,o=grid", {"GlueSAPath": ["/p"]})]
+        )
+
+    def test_crlf_and_str_lines(self):
+        lines = ["dn: o=grid\r\n", "GlueSAPath: /p\r\n", "\r\n"]
+        entries = list(gridutils.parse_ldif(lines))
+        self.assertEqual(entries, [("o=grid", {"GlueSAPath": ["/p"]})])
+
+    def test_incremental(self):
+        def lines():
+            yield b"dn: o=grid\n"
+            yield b"GlueSAPath: /p\n"
+            yield b"\n"
+            raise AssertionError("read past the first entry")
+
+        entries = gridutils.parse_ldif(lines())
+        self.assertEqual(next(entries), ("o=grid", {"GlueSAPath": ["/p"]}))
+
+
+if __name__ == "__main__":
+    unittest.main()